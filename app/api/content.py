@@ -1,14 +1,20 @@
 from datetime import datetime
-from fastapi import APIRouter, Query
+from functools import lru_cache
+from fastapi import APIRouter, Depends, Query, Response
 from pydantic import BaseModel, validator
+from sqlalchemy.ext.asyncio import AsyncSession
 from uuid import UUID
 from typing import Dict, Any, List, Optional
 
-from app.models.content import ContentType, ContentLanguage
+from app.database import db_read_session
+from app.models.content import Content, ContentType, ContentLanguage
 from app.services import content as content_service
-from app.services.integrations.gcp import get_url_for_public_content_obj
+from app.services.content_pool import ContentPool, content_pool_factory
+from app.services.seen_items import SeenItemsTracker, seen_items_tracker_factory
+from app.services.utils import get_url_for_public_content_obj
 
 router = APIRouter()
+MAX_RANDOM_ITEMS = 50
 
 
 class ContentItem(BaseModel):
@@ -31,8 +37,55 @@ class ContentItem(BaseModel):
 
 @router.get("/random-item", response_model=ContentItem | None, summary="Return random content item.")
 async def random_item(
-    content_type: ContentType, lang: ContentLanguage, exclude_ids: Optional[List[UUID]] = Query(default=None)
+    content_type: ContentType,
+    lang: ContentLanguage,
+    exclude_ids: Optional[List[UUID]] = Query(default=None),
+    session_id: Optional[str] = Query(
+        default=None, max_length=128, description="Skip items already served to this session."
+    ),
+    db: AsyncSession = Depends(db_read_session),
 ):
-    db_item = await content_service.get_random_content_item(content_type, lang, exclude_ids)
+    pool = get_content_pool()
+    if pool.ready:
+        seen = get_seen_items_tracker().get(session_id) if session_id else None
+        payload = pool.pick(content_type, lang, exclude_ids, seen)
+        return Response(content=payload or b"null", media_type="application/json")
+
+    db_item = await content_service.get_random_content_item(content_type, lang, exclude_ids, db)
     if db_item:
         return ContentItem.from_orm(db_item)
+
+
+@router.get("/random-items", response_model=List[ContentItem], summary="Return distinct random content items.")
+async def random_items(
+    content_type: ContentType,
+    lang: ContentLanguage,
+    count: int = Query(default=10, ge=1, le=MAX_RANDOM_ITEMS),
+    exclude_ids: Optional[List[UUID]] = Query(default=None),
+    session_id: Optional[str] = Query(
+        default=None, max_length=128, description="Skip items already served to this session."
+    ),
+    db: AsyncSession = Depends(db_read_session),
+):
+    pool = get_content_pool()
+    if pool.ready:
+        seen = get_seen_items_tracker().get(session_id) if session_id else None
+        payloads = pool.pick_many(content_type, lang, count, exclude_ids, seen)
+    else:
+        db_items = await content_service.get_random_content_items(content_type, lang, count, exclude_ids, db)
+        payloads = [serialize_content_item(db_item) for db_item in db_items]
+    return Response(content=b"[" + b",".join(payloads) + b"]", media_type="application/json")
+
+
+def serialize_content_item(content: Content) -> bytes:
+    return ContentItem.from_orm(content).json().encode()
+
+
+@lru_cache
+def get_content_pool() -> ContentPool:
+    return content_pool_factory(serializer=serialize_content_item)
+
+
+@lru_cache
+def get_seen_items_tracker() -> SeenItemsTracker:
+    return seen_items_tracker_factory()
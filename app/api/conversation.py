@@ -1,50 +1,146 @@
+import asyncio
 import traceback
 
+from contextlib import AsyncExitStack, aclosing
+from functools import lru_cache
+
 from websockets import exceptions as WSExceptions
 from os.path import basename
 from fastapi import APIRouter, UploadFile, HTTPException
-from fastapi import WebSocket
+from fastapi import WebSocket, WebSocketDisconnect, status
 from pydantic import BaseModel
 from app.api.exceptions import APIException
 from collections.abc import AsyncIterator
 
+from typing import TYPE_CHECKING, Dict, Optional, Set
+
+from app.api.profiling import is_profile_requested
+from app.api.send_buffer import SendBuffer, SendBufferClosed, send_buffer_factory
+from app.api.stream_protocol import (
+    FrameType,
+    ProtocolException,
+    StreamProtocol,
+    decode_frame,
+    encode_frame,
+    encode_json_frame,
+    encode_text_frame,
+)
+from app.config import get_settings
+from app.logger import correlation_id, logger_factory, new_correlation_id
 from app.models.content import ContentLanguage
 from app.services import factories, utils
+from app.services.audio import AudioEncoding, AudioQuality
+from app.services.admission import (
+    AdmissionController,
+    AdmissionPriority,
+    AdmissionRejected,
+    admission_controller_factory,
+)
+from app.services.conversation import Conversation, Degradation, ReplyEvent, ReplyEventType
+from app.services.deadline import Deadline, DeadlineExceeded, degradation_counts
+from app.services.integrations.circuit_breaker import CircuitOpenException
+from app.services.lifecycle import server_state
+from app.services.profiler import profiled
+
+if TYPE_CHECKING:
+    from app.services.integrations.gcp import StreamTextToVoice, TextToVoice
 
 STREAMING_AUDIO_START_MESSAGE = bytes("==[START]==", "utf-8")
 STREAMING_AUDIO_END_MESSAGE = bytes("==[END]==", "utf-8")
+MAX_PIPELINED_TURNS = 4
 router = APIRouter()
 
 
 class AIReplyWithURL(BaseModel):
-    reply_url: str
+    # None when the reply could only be given as text within the turn deadline
+    reply_url: Optional[str]
+    reply_text: str
 
 
 @router.post("/ask-ai", response_model=AIReplyWithURL, summary="Main endpoint for conversations.")
-async def conversation(lang: ContentLanguage, user_audio_reply: UploadFile):
+async def conversation(
+    lang: ContentLanguage,
+    user_audio_reply: UploadFile,
+    audio_format: AudioEncoding = AudioEncoding.OGG_OPUS,
+    audio_quality: Optional[AudioQuality] = None,
+):
     if user_audio_reply.content_type != "audio/ogg":
         raise HTTPException(status_code=400, detail="Only OGG format is supported for user replies.")
 
+    new_correlation_id()
     conv_service = factories.conversation()
-    reply_file_path = await conv_service.get_and_log_reply_for_audio(lang, user_audio_reply.file)
-    upload_service = factories.upload()
-    reply_upload_name = basename(reply_file_path)
-    await upload_service.upload_ai_reply(reply_file_path, reply_upload_name)
-    return AIReplyWithURL(reply_url=utils.get_url_for_ai_reply_obj(reply_upload_name))
+    deadline = turn_deadline()
+    ttv = reply_text_to_voice(audio_format, audio_quality)
+    try:
+        async with get_admission_controller().admit(AdmissionPriority.REQUEST, deadline.expires_at):
+            reply = await conv_service.get_and_log_reply_for_audio(lang, user_audio_reply.file, deadline, ttv)
+    except (AdmissionRejected, CircuitOpenException) as exc:
+        raise HTTPException(status_code=503, detail=str(exc), headers={"Retry-After": str(exc.retry_after)})
+    except DeadlineExceeded as exc:
+        raise HTTPException(status_code=504, detail=str(exc))
+
+    reply_url = None
+    if reply.audio_path is not None:
+        upload_service = factories.upload()
+        reply_upload_name = basename(reply.audio_path)
+        try:
+            await upload_service.upload_ai_reply(reply.audio_path, reply_upload_name, deadline)
+            reply_url = utils.get_url_for_ai_reply_obj(reply_upload_name)
+        except (DeadlineExceeded, CircuitOpenException):
+            degradation_counts[Degradation.TEXT_ONLY.value] += 1
+    return AIReplyWithURL(reply_url=reply_url, reply_text=reply.text)
 
 
 @router.websocket("/ask-ai-stream")
-async def conversation_stream(lang: ContentLanguage, websocket: WebSocket):
+async def conversation_stream(
+    lang: ContentLanguage,
+    websocket: WebSocket,
+    protocol: StreamProtocol = StreamProtocol.LEGACY,
+    audio_format: AudioEncoding = AudioEncoding.MP3,
+    audio_quality: Optional[AudioQuality] = None,
+):
     await websocket.accept()
+    new_correlation_id()
+    if server_state.draining:
+        await websocket.close(code=status.WS_1012_SERVICE_RESTART)
+        return
+    admission = get_admission_controller()
+    if admission.is_overloaded():
+        await websocket.close(code=status.WS_1013_TRY_AGAIN_LATER, reason=retry_hint(admission.retry_after()))
+        return
 
     conv_service = factories.conversation()
+    ttv = reply_text_to_voice(audio_format, audio_quality, stream=True)
+    profile_turns = is_profile_requested(websocket.headers, websocket.query_params)
+    send_buffer = send_buffer_factory(websocket, on_downgrade=lambda: downgrade_reply_audio(ttv))
+    send_buffer.start()
+    server_state.conversations.add(websocket)
     try:
+        if protocol == StreamProtocol.FRAMED:
+            await FramedConversationStream(websocket, lang, conv_service, ttv, send_buffer, profile_turns).run()
+            return
+
         while True:
             audio_data = await websocket.receive_bytes()
             if audio_data == STREAMING_AUDIO_START_MESSAGE:
-                reply_stream = conv_service.get_and_log_stream_reply(lang, websocket_user_input_stream(websocket))
-                async for reply_data in reply_stream:
-                    await websocket.send_bytes(reply_data)
+                if server_state.draining:
+                    await websocket.close(code=status.WS_1012_SERVICE_RESTART)
+                    return
+                new_correlation_id()
+                deadline = turn_deadline(started=False)
+                user_input = deadline.start_after(websocket_user_input_stream(websocket))
+                async with profiled(profile_turns):
+                    events = admit_after_input(
+                        conv_service.stream_reply_events(lang, user_input, ttv, deadline), deadline
+                    )
+                    try:
+                        async with aclosing(events):
+                            async for event in events:
+                                if event.event_type == ReplyEventType.AUDIO:
+                                    await send_buffer.put(event.data)
+                    except DeadlineExceeded:
+                        # nothing to reply with, the client can talk again
+                        continue
             # else:
             #     raise APIException(
             #         f"""
@@ -52,23 +148,194 @@ async def conversation_stream(lang: ContentLanguage, websocket: WebSocket):
             #          and \"{STREAMING_AUDIO_END_MESSAGE}\" to end the stream.
             #     """
             #     )
-    except WSExceptions.ConnectionClosedError:
+    except (WSExceptions.ConnectionClosedError, WebSocketDisconnect, SendBufferClosed):
         # TODO: should we care if the connection was closed on the user side?
         pass
+    except (AdmissionRejected, CircuitOpenException) as exc:
+        # the legacy protocol has no way to refuse a single turn
+        await websocket.close(code=status.WS_1013_TRY_AGAIN_LATER, reason=retry_hint(exc.retry_after))
     except Exception:
         raise APIException(f"Could not get reply: \n {traceback.format_exc()}")
     finally:
+        server_state.conversations.discard(websocket)
+        await send_buffer.close(drain_timeout=send_buffer.send_timeout)
         try:
             await websocket.close()
         except Exception:
             pass
 
 
+@lru_cache
+def get_admission_controller() -> AdmissionController:
+    return admission_controller_factory()
+
+
+def turn_deadline(started: bool = True) -> Deadline:
+    return Deadline(get_settings().conversation_turn_budget, started)
+
+
+def retry_hint(retry_after: int) -> str:
+    return f"retry-after={retry_after}"
+
+
+async def admit_after_input(events: AsyncIterator[ReplyEvent], deadline: Deadline) -> AsyncIterator[ReplyEvent]:
+    # A turn is admitted once the user stopped talking and the transcript is in, a slow talker would hold a slot
+    # otherwise. Its deadline is running by then, the wait in the queue counts against it and ends with it.
+    async with AsyncExitStack() as turn_scope, aclosing(events):
+        ticket = None
+        async for event in events:
+            if event.event_type == ReplyEventType.TRANSCRIPT and ticket is None:
+                admission = get_admission_controller()
+                ticket = await turn_scope.enter_async_context(
+                    admission.admit(AdmissionPriority.STREAM_TURN, deadline.expires_at)
+                )
+            elif event.event_type == ReplyEventType.METRICS and ticket is not None:
+                ticket.observe(upstream_reply_time(event.data))
+            yield event
+
+
+def upstream_reply_time(metrics: dict) -> float:
+    # the speech to text part of a streamed turn lasts as long as the user talks
+    return metrics["ai_reply_time"] + metrics["ttv_time"]
+
+
+def reply_text_to_voice(
+    audio_format: AudioEncoding, audio_quality: Optional[AudioQuality], stream: bool = False
+) -> "TextToVoice":
+    # without a quality the service picks the sample rate, which is what clients got before they could choose
+    sample_rate_hertz = audio_quality.sample_rate_hertz if audio_quality is not None else None
+    return factories.text_to_voice(stream=stream, audio_encoding=audio_format, sample_rate_hertz=sample_rate_hertz)
+
+
+def downgrade_reply_audio(ttv: "StreamTextToVoice"):
+    ttv.sample_rate_hertz = min(ttv.sample_rate_hertz, get_settings().stream_downgraded_sample_rate)
+
+
 async def websocket_user_input_stream(websocket: WebSocket) -> AsyncIterator[bytes]:
     while (audio_data := await websocket.receive_bytes()) != STREAMING_AUDIO_END_MESSAGE:
         yield audio_data
 
 
+class FramedConversationStream:
+    """
+    Versioned, length-prefixed frames (see app/api/stream_protocol.py). The client opens a turn with TURN_START,
+    streams AUDIO_IN and closes its input with TURN_END. Every reply frame carries the turn id, and the server sends
+    TURN_END once the reply is complete, so a new turn can start while the previous reply is still streaming.
+    """
+
+    def __init__(
+        self,
+        websocket: WebSocket,
+        lang: ContentLanguage,
+        conv_service: Conversation,
+        ttv: "StreamTextToVoice",
+        send_buffer: SendBuffer,
+        profile_turns: bool = False,
+    ):
+        self.websocket = websocket
+        self.lang = lang
+        self.conv_service = conv_service
+        self.ttv = ttv
+        self.send_buffer = send_buffer
+        self.profile_turns = profile_turns
+        self.logger = logger_factory("Conversation Stream")
+        self.connection_id = correlation_id.get()
+        self.turn_inputs: Dict[int, asyncio.Queue] = {}
+        self.turn_tasks: Set[asyncio.Task] = set()
+
+    async def run(self):
+        try:
+            while True:
+                try:
+                    self.handle_frame(decode_frame(await self.websocket.receive_bytes()))
+                except ProtocolException as exc:
+                    await self.send_error(0, str(exc))
+        except (WebSocketDisconnect, WSExceptions.ConnectionClosed, SendBufferClosed):
+            pass
+        finally:
+            for task in self.turn_tasks:
+                task.cancel()
+            await asyncio.gather(*self.turn_tasks, return_exceptions=True)
+
+    def handle_frame(self, frame):
+        turn_input: Optional[asyncio.Queue] = self.turn_inputs.get(frame.turn_id)
+        match frame.frame_type:
+            case FrameType.TURN_START:
+                if server_state.draining:
+                    raise ProtocolException("The server is restarting, reconnect to start new turns.")
+                if frame.turn_id == 0 or turn_input is not None:
+                    raise ProtocolException(f"Turn id {frame.turn_id} is reserved or already in use.")
+                if len(self.turn_inputs) >= MAX_PIPELINED_TURNS:
+                    raise ProtocolException(f"At most {MAX_PIPELINED_TURNS} turns can be in flight.")
+                self.turn_inputs[frame.turn_id] = asyncio.Queue()
+                task = asyncio.create_task(self.run_turn(frame.turn_id, self.turn_inputs[frame.turn_id]))
+                self.turn_tasks.add(task)
+                task.add_done_callback(self.turn_tasks.discard)
+            case FrameType.AUDIO_IN | FrameType.TURN_END if turn_input is None:
+                raise ProtocolException(f"Turn {frame.turn_id} was not started.")
+            case FrameType.AUDIO_IN:
+                turn_input.put_nowait(frame.payload)
+            case FrameType.TURN_END:
+                turn_input.put_nowait(None)
+            case _:
+                raise ProtocolException(f"Clients can not send {frame.frame_type.name} frames.")
+
+    async def run_turn(self, turn_id: int, turn_input: asyncio.Queue):
+        try:
+            await self.stream_turn(turn_id, turn_input)
+        except SendBufferClosed:
+            # the client was dropped, nothing left to tell it
+            pass
+        finally:
+            self.turn_inputs.pop(turn_id, None)
+
+    async def stream_turn(self, turn_id: int, turn_input: asyncio.Queue):
+        # turns run in their own tasks, so this only applies to this turn
+        correlation_id.set(f"{self.connection_id}/{turn_id}")
+        try:
+            deadline = turn_deadline(started=False)
+            user_input = deadline.start_after(queue_stream(turn_input))
+            async with profiled(self.profile_turns):
+                events = admit_after_input(
+                    self.conv_service.stream_reply_events(self.lang, user_input, self.ttv, deadline), deadline
+                )
+                async with aclosing(events):
+                    async for event in events:
+                        await self.send(event_to_frame(turn_id, event))
+        except (asyncio.CancelledError, SendBufferClosed):
+            raise
+        except (AdmissionRejected, CircuitOpenException) as exc:
+            # other turns of the connection go on, only this one is refused
+            await self.send_error(turn_id, f"{exc} {retry_hint(exc.retry_after)}")
+        except Exception as exc:
+            self.logger.log_error(f"Turn {turn_id} failed: \n {traceback.format_exc()}")
+            await self.send_error(turn_id, str(exc))
+        await self.send(encode_frame(FrameType.TURN_END, turn_id))
+
+    async def send(self, frame: bytes):
+        await self.send_buffer.put(frame)
+
+    async def send_error(self, turn_id: int, message: str):
+        await self.send(encode_text_frame(FrameType.ERROR, turn_id, message))
+
+
+def event_to_frame(turn_id: int, event: ReplyEvent) -> bytes:
+    match event.event_type:
+        case ReplyEventType.TRANSCRIPT:
+            return encode_text_frame(FrameType.TRANSCRIPT, turn_id, event.data)
+        case ReplyEventType.TEXT:
+            return encode_text_frame(FrameType.TEXT_DELTA, turn_id, event.data)
+        case ReplyEventType.AUDIO:
+            return encode_frame(FrameType.AUDIO_OUT, turn_id, event.data)
+        case ReplyEventType.METRICS:
+            return encode_json_frame(FrameType.METRICS, turn_id, event.data)
+
+
+async def queue_stream(queue: asyncio.Queue) -> AsyncIterator[bytes]:
+    while (audio_data := await queue.get()) is not None:
+        yield audio_data
+
+
 async def reply_and_upload_to_cloud(reply_to: str, lang: ContentLanguage):
     ai = factories.ai()
     ttv = factories.text_to_voice(stream=True)
@@ -0,0 +1,42 @@
+import asyncio
+
+from time import monotonic
+from typing import Callable
+from fastapi import APIRouter, Response, status
+
+from app.api.conversation import get_admission_controller
+from app.services.lifecycle import server_state
+
+router = APIRouter()
+
+
+@router.get("/ready", summary="Whether this worker is warmed up and takes new conversations.")
+async def ready(response: Response) -> dict:
+    if server_state.draining:
+        response.status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+        return {"status": "draining"}
+    if not server_state.warmed_up:
+        response.status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+        return {"status": "warming_up"}
+    if server_state.failed_required_steps():
+        server_state.recheck_required_steps()
+        response.status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+        return {"status": "not_ready", "warm_up": server_state.warm_up_report}
+    return {"status": "ready", "warm_up": server_state.warm_up_report}
+
+
+async def drain_conversations(timeout: float, force_exit: Callable[[], bool]):
+    """
+    Refuses new conversation turns and waits for the ones in progress to finish, then asks the clients that are
+    still connected to reconnect, which gets them to another worker.
+    """
+    server_state.draining = True
+    admission = get_admission_controller()
+    drain_until = monotonic() + timeout
+    while (admission.in_flight or admission.waiters) and monotonic() < drain_until and not force_exit():
+        await asyncio.sleep(0.1)
+    for websocket in list(server_state.conversations):
+        try:
+            await websocket.close(code=status.WS_1012_SERVICE_RESTART)
+        except Exception:
+            pass
@@ -0,0 +1,32 @@
+from functools import lru_cache
+from fastapi import APIRouter
+
+from app.api.conversation import get_admission_controller
+from app.api.send_buffer import send_buffer_stats
+from app.database.database import get_pool_status
+from app.logger import get_log_status
+from app.services.deadline import degradation_counts
+from app.services.integrations.circuit_breaker import get_circuit_breakers_status
+from app.services.loop_monitor import LoopMonitor, loop_monitor_factory
+from app.services.profiler import get_profiler
+
+router = APIRouter()
+
+
+@router.get("", summary="Runtime metrics of this worker.")
+async def metrics() -> dict:
+    return {
+        "db_pool": get_pool_status(),
+        "send_buffer": send_buffer_stats.as_dict(),
+        "admission": get_admission_controller().get_status(),
+        "degradations": dict(degradation_counts),
+        "circuit_breakers": get_circuit_breakers_status(),
+        "logging": get_log_status(),
+        "profiler": get_profiler().get_status(),
+        "event_loop": get_loop_monitor().get_status(),
+    }
+
+
+@lru_cache
+def get_loop_monitor() -> LoopMonitor:
+    return loop_monitor_factory()
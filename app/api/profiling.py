@@ -0,0 +1,35 @@
+import secrets
+
+from starlette.datastructures import Headers, QueryParams
+from starlette.requests import HTTPConnection
+from starlette.types import ASGIApp, Receive, Scope, Send
+
+from app.config import get_settings
+from app.services.profiler import profiled
+
+PROFILE_HEADER = "x-profile"
+# browsers can't set headers on websockets
+PROFILE_QUERY_PARAM = "profile"
+PROFILED_PATHS = ("/conversation/", "/content/")
+
+
+def is_profile_requested(headers: Headers, query_params: QueryParams) -> bool:
+    # whoever has the token is an admin
+    token = get_settings().profiler_token
+    given = headers.get(PROFILE_HEADER) or query_params.get(PROFILE_QUERY_PARAM)
+    return bool(token) and given is not None and secrets.compare_digest(given.encode(), token.encode())
+
+
+class ProfilingMiddleware:
+    """Profiles HTTP requests, websocket turns are profiled one by one in app/api/conversation.py."""
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http" or not scope["path"].startswith(PROFILED_PATHS):
+            await self.app(scope, receive, send)
+            return
+        connection = HTTPConnection(scope)
+        async with profiled(is_profile_requested(connection.headers, connection.query_params)):
+            await self.app(scope, receive, send)
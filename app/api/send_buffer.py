@@ -0,0 +1,191 @@
+import asyncio
+
+from collections import deque
+from enum import Enum
+from typing import Callable, Deque, Optional
+
+from fastapi import WebSocket, status
+
+from app.api.exceptions import APIException
+from app.config import Config
+from app.logger import logger_factory
+
+
+class SendBufferPolicy(Enum):
+    # what to do when a client can't keep up and the buffer is full
+    BLOCK = "block"
+    DISCONNECT = "disconnect"
+    DOWNGRADE = "downgrade"
+
+
+class SendBufferClosed(APIException):
+    pass
+
+
+class SendBufferStats:
+    def __init__(self):
+        self.open_buffers = 0
+        self.buffered_bytes = 0
+        self.buffered_frames = 0
+        self.max_buffered_bytes = 0
+        self.max_buffered_frames = 0
+        self.blocked = 0
+        self.downgrades = 0
+        self.overflow_disconnects = 0
+        self.timeout_disconnects = 0
+
+    def observe_depth(self, buffered_bytes: int, buffered_frames: int):
+        self.max_buffered_bytes = max(self.max_buffered_bytes, buffered_bytes)
+        self.max_buffered_frames = max(self.max_buffered_frames, buffered_frames)
+
+    def as_dict(self) -> dict:
+        return dict(vars(self))
+
+
+send_buffer_stats = SendBufferStats()
+
+
+class SendBuffer:
+    """
+    Bounded outbound queue of one websocket, drained by its own sender task. Producers wait in put() once the
+    buffer is full, so a slow client stops the upstream OpenAI and GCP streams from being pulled further.
+    """
+
+    def __init__(
+        self,
+        websocket: WebSocket,
+        max_bytes: int,
+        max_frames: int,
+        policy: SendBufferPolicy,
+        send_timeout: float,
+        on_downgrade: Optional[Callable[[], None]] = None,
+    ):
+        self.websocket = websocket
+        self.max_bytes = max_bytes
+        self.max_frames = max_frames
+        self.policy = policy
+        self.send_timeout = send_timeout
+        self.on_downgrade = on_downgrade
+        self.logger = logger_factory("Send Buffer")
+        self.frames: Deque[bytes] = deque()
+        self.buffered_bytes = 0
+        self.closed = False
+        # dropped connections are closed by the buffer itself, the endpoint closes the rest
+        self.dropped = False
+        self.disconnected = False
+        self.downgraded = False
+        self._changed = asyncio.Condition()
+        self._sender: Optional[asyncio.Task] = None
+
+    def start(self):
+        send_buffer_stats.open_buffers += 1
+        self._sender = asyncio.create_task(self._send_buffered())
+
+    async def put(self, frame: bytes):
+        async with self._changed:
+            if not self.closed and self._is_full(len(frame)):
+                await self._handle_overflow(len(frame))
+            if not self.closed:
+                self.frames.append(frame)
+                self._add_depth(len(frame), 1)
+                self._changed.notify_all()
+                return
+        await self._disconnect_if_dropped()
+        raise SendBufferClosed("The connection is closed.")
+
+    async def close(self, drain_timeout: Optional[float] = None):
+        # Lets the buffered frames go out first, unless the peer is not reading them.
+        if self._sender is None:
+            return
+        try:
+            async with self._changed:
+                await asyncio.wait_for(self._changed.wait_for(lambda: not self.frames or self.closed), drain_timeout)
+        except asyncio.TimeoutError:
+            pass
+        async with self._changed:
+            self._mark_closed()
+        self._sender.cancel()
+        await asyncio.gather(self._sender, return_exceptions=True)
+        self._sender = None
+        send_buffer_stats.open_buffers -= 1
+        await self._disconnect_if_dropped()
+
+    def _is_full(self, frame_size: int) -> bool:
+        # a single frame bigger than max_bytes still goes through once the buffer is empty
+        over_bytes = self.frames and self.buffered_bytes + frame_size > self.max_bytes
+        return bool(over_bytes or len(self.frames) >= self.max_frames)
+
+    async def _handle_overflow(self, frame_size: int):
+        if self.policy == SendBufferPolicy.DISCONNECT:
+            send_buffer_stats.overflow_disconnects += 1
+            self.logger.log_debug(f"Dropping a client with {self.buffered_bytes} bytes of replies not read.")
+            self.dropped = True
+            self._mark_closed()
+            return
+        if self.policy == SendBufferPolicy.DOWNGRADE and not self.downgraded and self.on_downgrade is not None:
+            self.downgraded = True
+            send_buffer_stats.downgrades += 1
+            self.on_downgrade()
+        send_buffer_stats.blocked += 1
+        await self._changed.wait_for(lambda: self.closed or not self._is_full(frame_size))
+
+    async def _send_buffered(self):
+        while True:
+            async with self._changed:
+                await self._changed.wait_for(lambda: self.frames or self.closed)
+                if self.closed:
+                    return
+                frame = self.frames[0]
+            sent = False
+            try:
+                await asyncio.wait_for(self.websocket.send_bytes(frame), self.send_timeout)
+                sent = True
+            except asyncio.TimeoutError:
+                send_buffer_stats.timeout_disconnects += 1
+                self.logger.log_debug(f"Client did not read a reply frame in {self.send_timeout} sec, disconnecting.")
+                self.dropped = True
+            except Exception:
+                # the client went away, the receiving side of the endpoint will notice it too
+                pass
+            async with self._changed:
+                if not sent or self.closed:
+                    self._mark_closed()
+                    break
+                self.frames.popleft()
+                self._add_depth(-len(frame), -1)
+                self._changed.notify_all()
+        await self._disconnect_if_dropped()
+
+    async def _disconnect_if_dropped(self):
+        if not self.dropped or self.disconnected:
+            return
+        self.disconnected = True
+        try:
+            await self.websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+        except Exception:
+            pass
+
+    def _mark_closed(self):
+        if self.closed:
+            return
+        self.closed = True
+        self._add_depth(-self.buffered_bytes, -len(self.frames))
+        self.frames.clear()
+        self._changed.notify_all()
+
+    def _add_depth(self, size: int, frames: int):
+        self.buffered_bytes += size
+        send_buffer_stats.buffered_bytes += size
+        send_buffer_stats.buffered_frames += frames
+        send_buffer_stats.observe_depth(self.buffered_bytes, len(self.frames))
+
+
+def send_buffer_factory(websocket: WebSocket, on_downgrade: Optional[Callable[[], None]] = None) -> SendBuffer:
+    return SendBuffer(
+        websocket,
+        max_bytes=Config.get_int("STREAM_SEND_BUFFER_MAX_BYTES", 1024 * 1024),
+        max_frames=Config.get_int("STREAM_SEND_BUFFER_MAX_FRAMES", 64),
+        policy=SendBufferPolicy(Config.get("STREAM_SEND_BUFFER_POLICY", SendBufferPolicy.BLOCK.value)),
+        send_timeout=Config.get_float("STREAM_SEND_TIMEOUT", 10.0),
+        on_downgrade=on_downgrade,
+    )
@@ -0,0 +1,29 @@
+from datetime import datetime, timedelta
+from functools import lru_cache
+from fastapi import APIRouter, HTTPException
+from typing import Optional
+
+from app.models.content import ContentLanguage
+from app.services.metrics_rollup import LatencyStats, MetricsRollup, RollupMetric, metrics_rollup_factory
+
+router = APIRouter()
+DEFAULT_STATS_WINDOW = timedelta(hours=1)
+
+
+@router.get("/latency", response_model=LatencyStats, summary="Percentiles of a reply metric over a time window.")
+async def latency(
+    metric: RollupMetric,
+    lang: Optional[ContentLanguage] = None,
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+):
+    end = end or datetime.utcnow()
+    start = start or end - DEFAULT_STATS_WINDOW
+    if start >= end:
+        raise HTTPException(status_code=400, detail="start must be before end.")
+    return await get_metrics_rollup().get_latency_stats(metric, lang, start, end)
+
+
+@lru_cache
+def get_metrics_rollup() -> MetricsRollup:
+    return metrics_rollup_factory()
@@ -0,0 +1,70 @@
+import struct
+import ujson
+
+from enum import Enum, IntEnum
+from typing import NamedTuple
+
+from app.api.exceptions import APIException
+
+PROTOCOL_VERSION = 1
+# version, frame type, turn id, payload length
+FRAME_HEADER = struct.Struct("!BBII")
+
+
+class StreamProtocol(Enum):
+    LEGACY = "legacy"
+    FRAMED = "framed"
+
+
+class FrameType(IntEnum):
+    AUDIO_IN = 1
+    AUDIO_OUT = 2
+    TRANSCRIPT = 3
+    TEXT_DELTA = 4
+    TURN_START = 5
+    TURN_END = 6
+    METRICS = 7
+    ERROR = 8
+
+
+class Frame(NamedTuple):
+    frame_type: FrameType
+    turn_id: int
+    payload: bytes = b""
+
+    def text(self) -> str:
+        return self.payload.decode("utf-8")
+
+    def json(self):
+        return ujson.loads(self.payload)
+
+
+class ProtocolException(APIException):
+    pass
+
+
+def encode_frame(frame_type: FrameType, turn_id: int, payload: bytes = b"") -> bytes:
+    return FRAME_HEADER.pack(PROTOCOL_VERSION, frame_type, turn_id, len(payload)) + payload
+
+
+def encode_text_frame(frame_type: FrameType, turn_id: int, text: str) -> bytes:
+    return encode_frame(frame_type, turn_id, text.encode("utf-8"))
+
+
+def encode_json_frame(frame_type: FrameType, turn_id: int, data) -> bytes:
+    return encode_frame(frame_type, turn_id, ujson.dumps(data).encode("utf-8"))
+
+
+def decode_frame(message: bytes) -> Frame:
+    if len(message) < FRAME_HEADER.size:
+        raise ProtocolException(f"Frame is shorter than its {FRAME_HEADER.size} byte header.")
+    version, frame_type, turn_id, length = FRAME_HEADER.unpack_from(message)
+    if version != PROTOCOL_VERSION:
+        raise ProtocolException(f"Unsupported protocol version {version}, expected {PROTOCOL_VERSION}.")
+    if len(message) - FRAME_HEADER.size != length:
+        raise ProtocolException(f"Frame payload is {len(message) - FRAME_HEADER.size} bytes, header says {length}.")
+    try:
+        frame_type = FrameType(frame_type)
+    except ValueError:
+        raise ProtocolException(f"Unknown frame type {frame_type}.")
+    return Frame(frame_type, turn_id, message[FRAME_HEADER.size :])
@@ -0,0 +1,68 @@
+import sys
+import click
+import subprocess
+
+from statistics import median
+from time import perf_counter
+from typing import Dict, List, Tuple
+
+DEFAULT_MODULES = (
+    "fastapi_app",
+    "app.cli.generate_content",
+    "app.cli.keep_content_stock",
+    "app.cli.maintain_reply_log",
+    "app.cli.rollup_reply_metrics",
+    # loaded on the first use of a service, not at startup
+    "app.services.integrations.gcp",
+    "app.services.integrations.openai",
+)
+IMPORT_SNIPPET = "import time; start = time.perf_counter(); import {module}; print(time.perf_counter() - start)"
+
+
+def time_cold_import(module: str) -> Tuple[float, float]:
+    # a fresh interpreter every run, so nothing is imported yet
+    start_time = perf_counter()
+    result = subprocess.run(
+        [sys.executable, "-c", IMPORT_SNIPPET.format(module=module)], capture_output=True, text=True
+    )
+    process_time = perf_counter() - start_time
+    if result.returncode != 0:
+        raise click.ClickException(f"Could not import {module}:\n{result.stderr}")
+    return float(result.stdout.strip().splitlines()[-1]), process_time
+
+
+def slowest_imports(module: str, top: int) -> List[Tuple[float, str]]:
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"], capture_output=True, text=True
+    )
+    # lines look like "import time:       self [us] |  cumulative | imported package"
+    imports: Dict[str, float] = {}
+    for line in result.stderr.splitlines():
+        fields = line.removeprefix("import time:").split("|")
+        if len(fields) != 3 or not fields[0].strip().isdigit():
+            continue
+        # own import time of every module adds up per top level package
+        package = fields[2].strip().split(".")[0]
+        imports[package] = imports.get(package, 0.0) + int(fields[0]) / 1e6
+    return sorted(((import_time, package) for package, import_time in imports.items()), reverse=True)[:top]
+
+
+@click.command()
+@click.option(
+    "--module", "modules", multiple=True, help="Module to import, can be repeated. Defaults to all entrypoints."
+)
+@click.option("--runs", default=5, help="Cold imports per module.", type=int)
+@click.option("--top", default=0, help="Also list this many modules that take the longest to import.", type=int)
+def command(modules: Tuple[str, ...], runs: int, top: int):
+    click.echo(f"{'module':<40}{'import min':>12}{'import med':>12}{'process med':>13}")
+    for module in modules or DEFAULT_MODULES:
+        import_times, process_times = zip(*(time_cold_import(module) for _ in range(runs)))
+        click.echo(
+            f"{module:<40}{min(import_times):>11.3f}s{median(import_times):>11.3f}s{median(process_times):>12.3f}s"
+        )
+        for import_time, imported in slowest_imports(module, top):
+            click.echo(f"    {import_time:.3f}s {imported}")
+
+
+if __name__ == "__main__":
+    command()
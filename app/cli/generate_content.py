@@ -1,18 +1,187 @@
+import os
+import json
 import click
 import anyio
 
-from app.models.content import ContentLanguage, ContentType
-from app.services.content import generate_new_content_and_store_in_db
+from functools import partial
+from time import perf_counter
+from typing import Callable, List, Optional, Tuple
+
+from app.models.content import Content, ContentLanguage, ContentType
+from app.services.content import (
+    generate_new_content_and_store_in_db,
+    generate_content_in_chunks,
+    gen_new_content_and_upload_for_public_access,
+)
+from app.services import factories
+from app.services.integrations.clients import close_shared_clients
 
 
 @click.command()
 @click.option("--content-type", help="Content type. Must be one of ContentType enum values.", required=True)
 @click.option("--count", default=1, help="Number of entries to generate.", type=int)
 @click.option("--lang", default=ContentLanguage.ENGLISH, help="Language to generate content in.", type=ContentLanguage)
-def command(content_type: str, count: int, lang: ContentLanguage):
+@click.option(
+    "--stream", is_flag=True, default=False, help="Generate with a bounded worker pool, committing in chunks."
+)
+@click.option("--concurrency", default=8, help="Stream mode: number of items generated at once.", type=int)
+@click.option("--chunk-size", default=50, help="Stream mode: number of items committed per transaction.", type=int)
+@click.option("--checkpoint", default=None, help="Stream mode: file to record progress in and resume from.")
+@click.option(
+    "--dry-run", is_flag=True, default=False, help="Stream mode: generate with the stub backends, store nothing."
+)
+@click.option("--stub-latency", default=1.0, help="Dry run: seconds the stub OpenAI takes to reply.", type=float)
+@click.option(
+    "--tts-batch-size",
+    default=0,
+    help="Stream mode: texts synthesized per text to speech request, the audio is stored as WAV then. At most "
+    "--concurrency texts are pending at once, so it should not be higher.",
+    type=int,
+)
+def command(
+    content_type: str,
+    count: int,
+    lang: ContentLanguage,
+    stream: bool,
+    concurrency: int,
+    chunk_size: int,
+    checkpoint: Optional[str],
+    dry_run: bool,
+    stub_latency: float,
+    tts_batch_size: int,
+):
     content_type = ContentType(content_type)
-    models = anyio.run(generate_new_content_and_store_in_db, content_type, lang, count)
-    click.echo(click.style(f"Successfully generated {len(models)} models.", fg="green"))
+    if not stream:
+        models = anyio.run(generate_new_content_and_store_in_db, content_type, lang, count)
+        click.echo(click.style(f"Successfully generated {len(models)} models.", fg="green"))
+        return
+
+    already_stored = read_checkpoint(checkpoint, content_type, lang, count)
+    if already_stored >= count:
+        click.echo(click.style(f"Checkpoint {checkpoint} says all {count} models are already stored.", fg="green"))
+        return
+    if already_stored:
+        click.echo(f"Resuming from checkpoint, {already_stored} of {count} already stored.")
+    progress = ProgressReporter(already_stored, count, checkpoint, content_type, lang)
+
+    async def generate_in_chunks():
+        if not dry_run:
+            # one service for all the workers, so their texts are batched together
+            tts_service = factories.batch_text_to_voice(tts_batch_size) if tts_batch_size > 1 else None
+            return await generate_content_in_chunks(
+                content_type,
+                lang,
+                count - already_stored,
+                concurrency,
+                chunk_size,
+                generate=partial(gen_new_content_and_upload_for_public_access, tts_service=tts_service),
+                on_chunk_stored=progress.report,
+            )
+        return await dry_run_in_chunks(
+            content_type,
+            lang,
+            count - already_stored,
+            concurrency,
+            chunk_size,
+            stub_latency,
+            tts_batch_size,
+            progress.report,
+        )
+
+    stored, failed = anyio.run(generate_in_chunks)
+    click.echo()
+    elapsed = max(perf_counter() - progress.started_at, 1e-9)
+    click.echo(
+        click.style(
+            f"Successfully generated {stored} models in {elapsed:.1f}s ({stored / elapsed:.2f} items/s), {failed} failed.",
+            fg="green" if not failed else "yellow",
+        )
+    )
+
+
+async def dry_run_in_chunks(
+    content_type: ContentType,
+    lang: ContentLanguage,
+    count: int,
+    concurrency: int,
+    chunk_size: int,
+    stub_latency: float,
+    tts_batch_size: int,
+    on_chunk_stored: Callable[[int, int], None],
+) -> Tuple[int, int]:
+    # the whole generation runs, only against local stand-ins, see app/services/integrations/stubs.py
+    from app.services.integrations import stubs
+
+    server = stubs.get_stub_openai_server()
+    server.first_token, server.token_interval = stubs.LatencyModel(stub_latency), stubs.LatencyModel(0.0)
+    await server.start()
+    batch_tts = stubs.stub_batch_text_to_voice(tts_batch_size) if tts_batch_size > 1 else None
+
+    async def stub_generate(content_type: ContentType, lang: ContentLanguage) -> Content:
+        return await gen_new_content_and_upload_for_public_access(
+            content_type, lang, stubs.stub_ai(), batch_tts or stubs.stub_text_to_voice(), stubs.stub_upload()
+        )
+
+    async def stub_store(models: List[Content]) -> List[Content]:
+        return models
+
+    try:
+        return await generate_content_in_chunks(
+            content_type,
+            lang,
+            count,
+            concurrency,
+            chunk_size,
+            generate=stub_generate,
+            store=stub_store,
+            on_chunk_stored=on_chunk_stored,
+        )
+    finally:
+        await close_shared_clients()
+        await server.stop()
+
+
+class ProgressReporter:
+    def __init__(
+        self,
+        already_stored: int,
+        count: int,
+        checkpoint: Optional[str],
+        content_type: ContentType,
+        lang: ContentLanguage,
+    ):
+        self.already_stored = already_stored
+        self.count = count
+        self.checkpoint = checkpoint
+        self.content_type = content_type
+        self.lang = lang
+        self.started_at = perf_counter()
+
+    def report(self, stored: int, failed: int):
+        total_stored = self.already_stored + stored
+        if self.checkpoint:
+            write_checkpoint(self.checkpoint, self.content_type, self.lang, self.count, total_stored)
+        elapsed = perf_counter() - self.started_at
+        rate = stored / elapsed if elapsed else 0.0
+        eta = f"{(self.count - total_stored) / rate:.0f}s" if rate else "?"
+        click.echo(f"\r{total_stored}/{self.count} stored, {failed} failed, {rate:.2f} items/s, ETA {eta}   ", nl=False)
+
+
+def read_checkpoint(path: Optional[str], content_type: ContentType, lang: ContentLanguage, count: int) -> int:
+    if not path or not os.path.exists(path):
+        return 0
+    with open(path) as f:
+        data = json.load(f)
+    if (data["content_type"], data["lang"], data["count"]) != (content_type.value, lang.value, count):
+        raise click.ClickException(f"Checkpoint {path} belongs to a different run: {data}")
+    return data["stored"]
+
+
+def write_checkpoint(path: str, content_type: ContentType, lang: ContentLanguage, count: int, stored: int):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump({"content_type": content_type.value, "lang": lang.value, "count": count, "stored": stored}, f)
+    os.replace(tmp_path, path)
 
 
 if __name__ == "__main__":
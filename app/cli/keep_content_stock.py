@@ -0,0 +1,27 @@
+import click
+import anyio
+
+from app.services.stock_keeper import stock_keeper_factory
+
+
+async def keep_content_stock_once() -> int:
+    return await stock_keeper_factory().run_once()
+
+
+async def keep_content_stock():
+    await stock_keeper_factory().run()
+
+
+@click.command()
+@click.option("--once", is_flag=True, default=False, help="Run a single check instead of the background loop.")
+def command(once: bool):
+    if not once:
+        # runs until stopped, every run logs what it generated
+        anyio.run(keep_content_stock)
+        return
+    generated = anyio.run(keep_content_stock_once)
+    click.echo(click.style(f"Successfully generated {generated} models.", fg="green"))
+
+
+if __name__ == "__main__":
+    command()
@@ -0,0 +1,341 @@
+import asyncio
+import os
+import random
+import socket
+import subprocess
+import sys
+import aiohttp
+import click
+import websockets
+
+from collections import Counter
+from time import perf_counter
+from typing import List, NamedTuple, Optional, Tuple
+
+from app.api.conversation import STREAMING_AUDIO_END_MESSAGE, STREAMING_AUDIO_START_MESSAGE
+from app.api.stream_protocol import FrameType, StreamProtocol, decode_frame, encode_frame
+from app.config import Config
+from app.services.audio import AudioEncoding, AudioQuality
+
+# a few seconds of audio per turn, for the stub backends that don't listen to it
+SYNTHETIC_SESSION = [bytes(48000), bytes(32000), bytes(64000)]
+LOCAL_READY_TIMEOUT = 60.0
+
+
+class TurnResult(NamedTuple):
+    # seconds after the user audio ended
+    first_audio: Optional[float]
+    total: Optional[float]
+    bytes_sent: int
+    bytes_received: int
+    error: Optional[str] = None
+
+
+class TurnBytes:
+    # counted as the turn goes, so a turn cut short still reports what it transferred
+    def __init__(self):
+        self.sent = 0
+        self.received = 0
+
+
+class LoadStats:
+    def __init__(self):
+        self.turns: List[TurnResult] = []
+        self.connected = 0
+        self.connect_errors: Counter = Counter()
+        self.started_at = perf_counter()
+        self.finished_at: Optional[float] = None
+
+    def report(self):
+        ok = [turn for turn in self.turns if turn.error is None]
+        failed = len(self.turns) - len(ok)
+        elapsed = (self.finished_at or perf_counter()) - self.started_at
+        click.echo(f"{'connections':<14}{self.connected} opened, {sum(self.connect_errors.values())} failed")
+        click.echo(f"{'turns':<14}{len(ok)} ok, {failed} failed ({failed / max(len(self.turns), 1):.1%})")
+        for error, count in (Counter(turn.error for turn in self.turns if turn.error) + self.connect_errors).items():
+            click.echo(f"{'':<14}{error}: {count}")
+        click.echo(f"{'first audio':<14}{format_percentiles([turn.first_audio for turn in ok])}")
+        click.echo(f"{'turn time':<14}{format_percentiles([turn.total for turn in ok])}")
+        sent, received = sum(turn.bytes_sent for turn in self.turns), sum(turn.bytes_received for turn in self.turns)
+        click.echo(f"{'transferred':<14}{sent / 1e6:.1f} MB sent, {received / 1e6:.1f} MB received")
+        click.echo(f"{'throughput':<14}{len(ok) / elapsed:.2f} turns/s over {elapsed:.1f}s")
+
+
+def percentile(values: List[float], share: float) -> float:
+    # nearest rank
+    return sorted(values)[min(len(values) - 1, int(len(values) * share))]
+
+
+def format_percentiles(values: List[float]) -> str:
+    if not values:
+        return "-"
+    return "  ".join(f"p{int(share * 100)} {percentile(values, share):.3f}s" for share in (0.5, 0.95, 0.99))
+
+
+def load_session(path: str) -> List[bytes]:
+    # a directory holds one file of user audio per turn, in name order, a file is a session of one turn
+    paths = [os.path.join(path, name) for name in sorted(os.listdir(path))] if os.path.isdir(path) else [path]
+    turns = []
+    for turn_path in paths:
+        with open(turn_path, "rb") as f:
+            turns.append(f.read())
+    return turns
+
+
+def split_chunks(audio: bytes, chunk_bytes: int) -> List[bytes]:
+    return [audio[start : start + chunk_bytes] for start in range(0, len(audio), chunk_bytes)]
+
+
+class TurnReplayer:
+    def __init__(self, chunk_bytes: int, chunk_interval: float, idle_timeout: float, turn_timeout: float):
+        self.chunk_bytes = chunk_bytes
+        self.chunk_interval = chunk_interval
+        self.idle_timeout = idle_timeout
+        self.turn_timeout = turn_timeout
+
+    async def send_audio(self, ws, audio: bytes, turn_bytes: TurnBytes, to_message=lambda chunk: chunk):
+        # paced like a client recording, the server gets the audio as fast as the user talks
+        for chunk in split_chunks(audio, self.chunk_bytes):
+            message = to_message(chunk)
+            await ws.send(message)
+            turn_bytes.sent += len(message)
+            await asyncio.sleep(self.chunk_interval)
+
+    async def replay_legacy(self, ws, audio: bytes, turn_bytes: TurnBytes) -> TurnResult:
+        await ws.send(STREAMING_AUDIO_START_MESSAGE)
+        await self.send_audio(ws, audio, turn_bytes)
+        await ws.send(STREAMING_AUDIO_END_MESSAGE)
+        input_ended = perf_counter()
+
+        # the legacy protocol has no end of turn, the reply is over when no audio came for a while
+        first_audio, last_audio = None, None
+        while True:
+            if first_audio is None:
+                timeout = self.turn_timeout - (perf_counter() - input_ended)
+            else:
+                timeout = self.idle_timeout
+            try:
+                message = await asyncio.wait_for(ws.recv(), max(timeout, 0.0))
+            except asyncio.TimeoutError:
+                break
+            last_audio = perf_counter() - input_ended
+            first_audio = first_audio if first_audio is not None else last_audio
+            turn_bytes.received += len(message)
+        if first_audio is None:
+            return TurnResult(None, None, turn_bytes.sent, turn_bytes.received, f"no reply in {self.turn_timeout}s")
+        return TurnResult(first_audio, last_audio, turn_bytes.sent, turn_bytes.received)
+
+    async def replay_framed(self, ws, audio: bytes, turn_id: int, turn_bytes: TurnBytes) -> TurnResult:
+        await ws.send(encode_frame(FrameType.TURN_START, turn_id))
+        await self.send_audio(ws, audio, turn_bytes, lambda chunk: encode_frame(FrameType.AUDIO_IN, turn_id, chunk))
+        await ws.send(encode_frame(FrameType.TURN_END, turn_id))
+        input_ended = perf_counter()
+
+        first_audio, error = None, None
+        while True:
+            timeout = self.turn_timeout - (perf_counter() - input_ended)
+            try:
+                message = await asyncio.wait_for(ws.recv(), max(timeout, 0.0))
+            except asyncio.TimeoutError:
+                timeout_error = f"no turn end in {self.turn_timeout}s"
+                return TurnResult(first_audio, None, turn_bytes.sent, turn_bytes.received, timeout_error)
+            turn_bytes.received += len(message)
+            frame = decode_frame(message)
+            if frame.turn_id not in (turn_id, 0):
+                continue
+            if frame.frame_type == FrameType.AUDIO_OUT and first_audio is None:
+                first_audio = perf_counter() - input_ended
+            elif frame.frame_type == FrameType.ERROR:
+                error = f"error frame: {frame.payload.decode()[:60]}"
+            elif frame.frame_type == FrameType.TURN_END:
+                total = perf_counter() - input_ended
+                return TurnResult(first_audio, total, turn_bytes.sent, turn_bytes.received, error)
+
+
+async def run_connection(
+    index: int,
+    url: str,
+    session: List[bytes],
+    protocol: StreamProtocol,
+    replayer: TurnReplayer,
+    loops: int,
+    think_time: float,
+    ramp_up_delay: float,
+    stats: LoadStats,
+):
+    await asyncio.sleep(ramp_up_delay)
+    try:
+        ws = await websockets.connect(url, max_size=None, open_timeout=replayer.turn_timeout)
+    except (OSError, asyncio.TimeoutError, websockets.InvalidHandshake) as exc:
+        stats.connect_errors[f"connect: {type(exc).__name__}"] += 1
+        return
+    stats.connected += 1
+    turn_id, turn_bytes = 0, TurnBytes()
+    try:
+        for _ in range(loops):
+            for audio in session:
+                turn_id, turn_bytes = turn_id + 1, TurnBytes()
+                if protocol == StreamProtocol.FRAMED:
+                    result = await replayer.replay_framed(ws, audio, turn_id, turn_bytes)
+                else:
+                    result = await replayer.replay_legacy(ws, audio, turn_bytes)
+                stats.turns.append(result)
+                # spread around the mean so connections don't turn in lockstep
+                await asyncio.sleep(think_time * random.uniform(0.5, 1.5))
+    except websockets.ConnectionClosed as exc:
+        stats.turns.append(TurnResult(None, None, turn_bytes.sent, turn_bytes.received, f"closed {exc.code}"))
+    except Exception as exc:
+        # a bad frame or a broken socket ends this connection, not the whole run
+        stats.turns.append(TurnResult(None, None, turn_bytes.sent, turn_bytes.received, type(exc).__name__))
+    finally:
+        await ws.close()
+
+
+async def run_load(
+    url: str,
+    sessions: List[List[bytes]],
+    protocol: StreamProtocol,
+    replayer: TurnReplayer,
+    connections: int,
+    loops: int,
+    think_time: float,
+    ramp_up: float,
+) -> LoadStats:
+    stats = LoadStats()
+    await asyncio.gather(
+        *(
+            run_connection(
+                index,
+                url,
+                sessions[index % len(sessions)],
+                protocol,
+                replayer,
+                loops,
+                think_time,
+                ramp_up * index / connections,
+                stats,
+            )
+            for index in range(connections)
+        )
+    )
+    stats.finished_at = perf_counter()
+    return stats
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+async def wait_until_ready(base_url: str, server: subprocess.Popen):
+    async with aiohttp.ClientSession() as session:
+        ready_by = perf_counter() + LOCAL_READY_TIMEOUT
+        while perf_counter() < ready_by and server.poll() is None:
+            try:
+                async with session.get(f"{base_url}/ready") as resp:
+                    if resp.status == 200:
+                        return
+            except aiohttp.ClientError:
+                pass
+            await asyncio.sleep(0.5)
+    if server.poll() is not None:
+        raise click.ClickException(f"The local server exited with code {server.returncode} before it got ready.")
+    raise click.ClickException(f"The local server did not get ready in {LOCAL_READY_TIMEOUT}s.")
+
+
+@click.command()
+@click.option("--url", default="ws://localhost:8000", help="Deployment to load, ignored with --local.")
+@click.option("--local", is_flag=True, default=False, help="Start a server on the stub backends and load it.")
+@click.option("--local-workers", default=1, help="Local: worker processes of the server.", type=int)
+@click.option("--lang", default="en", help="Conversation language.")
+@click.option(
+    "--audio-format",
+    default=AudioEncoding.MP3.value,
+    type=click.Choice([encoding.value for encoding in AudioEncoding]),
+    help="Reply audio the connections ask for.",
+)
+@click.option(
+    "--audio-quality",
+    default=None,
+    type=click.Choice([quality.value for quality in AudioQuality]),
+    help="Reply audio quality tier, the server's default without it.",
+)
+@click.option(
+    "--protocol",
+    default=StreamProtocol.LEGACY.value,
+    type=click.Choice([protocol.value for protocol in StreamProtocol]),
+    help="Legacy turns end after --idle-timeout without reply audio, framed ones on the server's turn end.",
+)
+@click.option(
+    "--session",
+    "session_paths",
+    multiple=True,
+    help="Recorded session, a directory with one audio file per turn or a single file. Can be repeated. Defaults "
+    "to silence, which only the stub backends can reply to.",
+)
+@click.option("--connections", default=10, help="Concurrent websocket sessions.", type=int)
+@click.option("--ramp-up", default=10.0, help="Seconds over which the connections are opened.", type=float)
+@click.option("--loops", default=1, help="Times every connection replays its session.", type=int)
+@click.option("--think-time", default=2.0, help="Mean seconds between a reply and the next turn.", type=float)
+@click.option("--chunk-bytes", default=4096, help="Bytes of audio per message.", type=int)
+@click.option("--chunk-interval", default=0.1, help="Seconds between audio messages.", type=float)
+@click.option("--idle-timeout", default=1.0, help="Legacy: seconds without audio that end a reply.", type=float)
+@click.option("--turn-timeout", default=30.0, help="Seconds a turn may take before it counts as failed.", type=float)
+def command(
+    url: str,
+    local: bool,
+    local_workers: int,
+    lang: str,
+    audio_format: str,
+    audio_quality: Optional[str],
+    protocol: str,
+    session_paths: Tuple[str, ...],
+    connections: int,
+    ramp_up: float,
+    loops: int,
+    think_time: float,
+    chunk_bytes: int,
+    chunk_interval: float,
+    idle_timeout: float,
+    turn_timeout: float,
+):
+    """Replays conversation sessions over concurrent /conversation/ask-ai-stream websockets."""
+    sessions = [load_session(path) for path in session_paths] or [SYNTHETIC_SESSION]
+    replayer = TurnReplayer(chunk_bytes, chunk_interval, idle_timeout, turn_timeout)
+    protocol = StreamProtocol(protocol)
+
+    server = None
+    if local:
+        port = free_port()
+        url = f"ws://127.0.0.1:{port}"
+        # its debug log would bury the report
+        env = {"LOG_LEVEL": "INFO", **os.environ, "STUB_BACKENDS": "true"}
+        if not Config.get("ASYNC_DB_CONNECT", ""):
+            click.echo("ASYNC_DB_CONNECT is not set, the local server runs without the database.")
+            # a turn only needs the database to log its reply
+            env.update(SERVER_WARM_UP_REQUIRED="", CONTENT_POOL_ENABLED="false", CONVERSATION_LOG_REPLIES="false")
+        server = subprocess.Popen(
+            [sys.executable, "-m", "app.cli.serve", "--host", "127.0.0.1", "--port", str(port)]
+            + ["--workers", str(local_workers)],
+            env=env,
+        )
+    try:
+        if server is not None:
+            asyncio.run(wait_until_ready(url.replace("ws://", "http://"), server))
+        stream_url = (
+            f"{url}/conversation/ask-ai-stream?lang={lang}&protocol={protocol.value}&audio_format={audio_format}"
+        )
+        if audio_quality is not None:
+            stream_url += f"&audio_quality={audio_quality}"
+        click.echo(f"Replaying {len(sessions)} session(s) over {connections} connections to {stream_url}")
+        stats = asyncio.run(run_load(stream_url, sessions, protocol, replayer, connections, loops, think_time, ramp_up))
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+    stats.report()
+
+
+if __name__ == "__main__":
+    command()
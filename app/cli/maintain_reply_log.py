@@ -0,0 +1,39 @@
+import click
+import anyio
+
+from typing import Optional
+
+from app.services.reply_log_partitions import partition_name, reply_log_partitions_factory
+
+
+async def maintain_reply_log(
+    months_ahead: Optional[int], retention_months: Optional[int], archive_dir: Optional[str], dry_run: bool
+):
+    partitions = reply_log_partitions_factory(months_ahead, retention_months, archive_dir)
+    existing = await partitions.list_partitions()
+
+    for month in partitions.get_missing_months(existing):
+        click.echo(f"Creating partition {partition_name(month)}")
+        if not dry_run:
+            await partitions.create_partition(month)
+
+    for month in partitions.get_expired_months(existing):
+        click.echo(f"Archiving and dropping partition {partition_name(month)}")
+        if not dry_run:
+            archive_path = await partitions.archive_partition(month)
+            await partitions.drop_partition(month)
+            click.echo(f"  archived to {archive_path}")
+
+
+@click.command()
+@click.option("--months-ahead", default=None, help="Months of partitions to keep created ahead.", type=int)
+@click.option("--retention-months", default=None, help="Months of partitions to keep in the database.", type=int)
+@click.option("--archive-dir", default=None, help="Directory for compressed archives of dropped partitions.")
+@click.option("--dry-run", is_flag=True, default=False, help="Only print what would be done.")
+def command(months_ahead: Optional[int], retention_months: Optional[int], archive_dir: Optional[str], dry_run: bool):
+    anyio.run(maintain_reply_log, months_ahead, retention_months, archive_dir, dry_run)
+    click.echo(click.style("Reply log partitions are up to date.", fg="green"))
+
+
+if __name__ == "__main__":
+    command()
@@ -0,0 +1,26 @@
+import click
+import anyio
+
+from typing import Optional
+
+from app.services.metrics_rollup import metrics_rollup_factory
+
+
+async def rollup_reply_metrics(interval: Optional[float]):
+    rollup = metrics_rollup_factory()
+    while True:
+        folded = await rollup.fold_new_reply_logs()
+        click.echo(f"Folded {folded} reply logs into rollups")
+        if interval is None:
+            return
+        await anyio.sleep(interval)
+
+
+@click.command()
+@click.option("--interval", default=None, help="Keep running, folding new reply logs every N seconds.", type=float)
+def command(interval: Optional[float]):
+    anyio.run(rollup_reply_metrics, interval)
+
+
+if __name__ == "__main__":
+    command()
@@ -0,0 +1,69 @@
+import os
+import click
+import uvicorn
+
+from importlib.util import find_spec
+from typing import Callable, List, Optional
+from socket import socket
+from uvicorn.supervisors import Multiprocess
+
+from app.config import Config, get_settings
+
+APP = "fastapi_app:app"
+
+
+class DrainingServer(uvicorn.Server):
+    """Lets conversation turns in progress finish before the worker stops, see app/api/health.py."""
+
+    def __init__(self, config: uvicorn.Config, drain_timeout: float):
+        super().__init__(config)
+        self.drain_timeout = drain_timeout
+
+    async def shutdown(self, sockets: Optional[List[socket]] = None):
+        # the app is only loaded in the workers
+        from app.api.health import drain_conversations
+
+        force_exit: Callable[[], bool] = lambda: self.force_exit
+        await drain_conversations(self.drain_timeout, force_exit)
+        await super().shutdown(sockets)
+
+
+@click.command()
+@click.option("--host", default=lambda: Config.get("SERVER_HOST", "0.0.0.0"), help="Address to listen on.")
+@click.option("--port", default=lambda: Config.get_int("SERVER_PORT", 8000), help="Port to listen on.", type=int)
+@click.option(
+    "--workers",
+    default=lambda: Config.get_int("SERVER_WORKERS", os.cpu_count() or 1),
+    help="Worker processes, one per core by default.",
+    type=int,
+)
+@click.option(
+    "--loop",
+    default=lambda: Config.get("SERVER_LOOP", "auto"),
+    help="Event loop, auto picks uvloop when it's installed.",
+    type=click.Choice(["auto", "asyncio", "uvloop"]),
+)
+@click.option(
+    "--drain-timeout",
+    default=lambda: Config.get_float("SERVER_DRAIN_TIMEOUT", 30.0),
+    help="Seconds a stopping worker waits for conversation turns in progress.",
+    type=float,
+)
+@click.option("--access-log/--no-access-log", default=False, help="Log every request, written on the event loop.")
+def command(host: str, port: int, workers: int, loop: str, drain_timeout: float, access_log: bool):
+    if loop == "uvloop" and find_spec("uvloop") is None:
+        raise click.ClickException("uvloop is not installed, pip install uvloop or use --loop auto.")
+    # Workers are spawned, not forked, so there is nothing to preload. A missing setting is still better caught here
+    # than in every worker.
+    get_settings()
+
+    config = uvicorn.Config(APP, host=host, port=port, workers=workers, loop=loop, access_log=access_log)
+    server = DrainingServer(config, drain_timeout)
+    if workers > 1:
+        Multiprocess(config, target=server.run, sockets=[config.bind_socket()]).run()
+    else:
+        server.run()
+
+
+if __name__ == "__main__":
+    command()
@@ -1,3 +1,6 @@
+from dataclasses import dataclass
+from functools import lru_cache
+
 from environs import Env
 
 
@@ -11,5 +14,89 @@ class ConfigFromEnv:
             return self.env(name)
         return self.env(name, default)
 
+    def get_int(self, name, default=None):
+        if default is None:
+            return self.env.int(name)
+        return self.env.int(name, default)
+
+    def get_float(self, name, default=None):
+        if default is None:
+            return self.env.float(name)
+        return self.env.float(name, default)
+
+    def get_list(self, name, default=None):
+        if default is None:
+            return self.env.list(name)
+        return self.env.list(name, default)
+
+    def get_bool(self, name, default=None):
+        if default is None:
+            return self.env.bool(name)
+        return self.env.bool(name, default)
+
 
 Config = ConfigFromEnv()
+
+
+@dataclass(frozen=True)
+class Settings:
+    """Settings read on every request or turn, resolved from the environment once."""
+
+    openai_api_key: str
+    openai_base_url: str
+    openai_completions_model: str
+    openai_chat_model: str
+    openai_timeout: float
+    openai_connect_timeout: float
+    gcp_credentials_file: str
+    gcp_english_voice: str
+    gcp_russian_voice: str
+    gcp_public_content_bucket: str
+    gcp_ai_replies_bucket: str
+    gcp_timeout: float
+    gcp_upload_timeout: float
+    conversation_turn_budget: float
+    conversation_short_reply_budget: float
+    conversation_log_replies: bool
+    stream_downgraded_sample_rate: int
+    profiler_token: str
+    profiler_sample_rate: float
+    stub_backends: bool
+
+    @classmethod
+    def from_config(cls, config: ConfigFromEnv) -> "Settings":
+        # in-process stand-ins for OpenAI and GCP, see app/services/integrations/stubs.py
+        stub_backends = config.get_bool("STUB_BACKENDS", False)
+
+        def credential(name: str, stub_default: str) -> str:
+            # the stubs need no credentials, so they need not be configured for them
+            return config.get(name, stub_default) if stub_backends else config.get(name)
+
+        return cls(
+            openai_api_key=credential("OPENAI_API_KEY", "stub"),
+            openai_base_url=config.get("OPENAI_BASE_URL", "https://api.openai.com/v1"),
+            openai_completions_model=credential("OPENAI_COMPLETIONS_MODEL", "stub"),
+            openai_chat_model=config.get("OPENAI_CHAT_MODEL", ""),
+            openai_timeout=config.get_float("OPENAI_TIMEOUT", 30.0),
+            openai_connect_timeout=config.get_float("OPENAI_CONNECT_TIMEOUT", 5.0),
+            gcp_credentials_file=credential("GOOGLE_APPLICATION_CREDENTIALS", ""),
+            gcp_english_voice=credential("GCP_ENGLISH_VOICE", "en-US-Standard-D"),
+            gcp_russian_voice=credential("GCP_RUSSIAN_VOICE", "ru-RU-Standard-D"),
+            gcp_public_content_bucket=credential("GCP_PUBLIC_CONTENT_BUCKET", "stub-public-content"),
+            gcp_ai_replies_bucket=credential("GCP_AI_REPLIES_BUCKET", "stub-ai-replies"),
+            gcp_timeout=config.get_float("GCP_TIMEOUT", 15.0),
+            gcp_upload_timeout=config.get_float("GCP_UPLOAD_TIMEOUT", 30.0),
+            conversation_turn_budget=config.get_float("CONVERSATION_TURN_BUDGET", 20.0),
+            conversation_short_reply_budget=config.get_float("CONVERSATION_SHORT_REPLY_BUDGET", 5.0),
+            conversation_log_replies=config.get_bool("CONVERSATION_LOG_REPLIES", True),
+            stream_downgraded_sample_rate=config.get_int("STREAM_DOWNGRADED_SAMPLE_RATE", 16000),
+            # profiling on request is off without a token
+            profiler_token=config.get("PROFILER_TOKEN", ""),
+            profiler_sample_rate=config.get_float("PROFILER_SAMPLE_RATE", 0.0),
+            stub_backends=stub_backends,
+        )
+
+
+@lru_cache
+def get_settings() -> Settings:
+    return Settings.from_config(Config)
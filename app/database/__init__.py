@@ -1 +1,9 @@
-from .database import Model, db_session_factory, store_models_to_db
+from .database import (
+    Model,
+    db_read_session,
+    db_read_session_scope,
+    db_session,
+    db_session_factory,
+    db_session_scope,
+    store_models_to_db,
+)
@@ -1,38 +1,286 @@
+import asyncio
+
+from collections import defaultdict
+from contextlib import asynccontextmanager
 from functools import lru_cache
-from typing import List
+from time import monotonic, perf_counter
+from typing import AsyncIterator, Dict, List, Optional, Type
 
-from sqlalchemy.exc import SQLAlchemyError
-from sqlalchemy.ext.asyncio import AsyncSession as SAAsyncSession, async_sessionmaker, create_async_engine
+import sqlalchemy as sa
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import DBAPIError, SQLAlchemyError
+from sqlalchemy.orm import Mapper, Session, make_transient_to_detached
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+from sqlalchemy.sql.dml import UpdateBase
+from sqlalchemy.ext.asyncio import (
+    AsyncEngine,
+    AsyncSession as SAAsyncSession,
+    async_sessionmaker,
+    create_async_engine,
+)
 from sqlalchemy.ext.declarative import declarative_base
 
 from app.config import Config
 
 
+class PoolCheckoutStats:
+    def __init__(self):
+        self.checkouts = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def observe(self, wait: float):
+        self.checkouts += 1
+        self.total_wait += wait
+        self.max_wait = max(self.max_wait, wait)
+
+    def as_dict(self) -> dict:
+        return {
+            "checkouts": self.checkouts,
+            "avg_wait": self.total_wait / self.checkouts if self.checkouts else 0.0,
+            "max_wait": self.max_wait,
+        }
+
+
+pool_checkout_stats = PoolCheckoutStats()
+
+
+class TimedQueuePool(AsyncAdaptedQueuePool):
+    def _do_get(self):
+        start_time = perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            pool_checkout_stats.observe(perf_counter() - start_time)
+
+
+@lru_cache
+def engine_factory() -> AsyncEngine:
+    return _create_engine(Config.get("ASYNC_DB_CONNECT"))
+
+
+def _create_engine(db_connect: str) -> AsyncEngine:
+    url = make_url(db_connect)
+    if "prepared_statement_cache_size" not in url.query:
+        url = url.update_query_dict(
+            {"prepared_statement_cache_size": str(Config.get_int("DB_STATEMENT_CACHE_SIZE", 500))}
+        )
+    return create_async_engine(
+        url,
+        poolclass=TimedQueuePool,
+        pool_size=Config.get_int("DB_POOL_SIZE", 10),
+        max_overflow=Config.get_int("DB_POOL_MAX_OVERFLOW", 10),
+        pool_timeout=Config.get_float("DB_POOL_TIMEOUT", 30.0),
+        pool_recycle=Config.get_int("DB_POOL_RECYCLE", 1800),
+        pool_pre_ping=Config.get_bool("DB_POOL_PRE_PING", True),
+    )
+
+
+@lru_cache
+def session_maker() -> async_sessionmaker:
+    return async_sessionmaker(engine_factory(), expire_on_commit=False, class_=SAAsyncSession)
+
+
+def db_session_factory() -> SAAsyncSession:
+    return session_maker()()
+
+
+async def db_session() -> AsyncIterator[SAAsyncSession]:
+    # FastAPI dependency, one session per request. No connection is checked out until the first query.
+    async with db_session_factory() as session:
+        yield session
+
+
+@asynccontextmanager
+async def db_session_scope(session: Optional[SAAsyncSession] = None) -> AsyncIterator[SAAsyncSession]:
+    if session is not None:
+        yield session
+        return
+    async with db_session_factory() as session:
+        yield session
+
+
+class ReplicaRouter:
+    """Round-robin over read replicas, skipping the ones that recently failed to connect."""
+
+    def __init__(self, engines: List[AsyncEngine], eject_for: float):
+        self.engines = engines
+        self.eject_for = eject_for
+        self.ejected_until: Dict[AsyncEngine, float] = {}
+        self._next = 0
+
+    def next_engine(self) -> Optional[AsyncEngine]:
+        now = monotonic()
+        for _ in range(len(self.engines)):
+            engine = self.engines[self._next % len(self.engines)]
+            self._next += 1
+            if self.ejected_until.get(engine, 0.0) <= now:
+                return engine
+        return None
+
+    def eject(self, engine: AsyncEngine):
+        self.ejected_until[engine] = monotonic() + self.eject_for
+
+    def get_status(self) -> List[dict]:
+        now = monotonic()
+        return [
+            {
+                "url": engine.url.render_as_string(hide_password=True),
+                "healthy": self.ejected_until.get(engine, 0.0) <= now,
+                **_get_engine_pool_status(engine),
+            }
+            for engine in self.engines
+        ]
+
+
+@lru_cache
+def replica_router() -> ReplicaRouter:
+    return ReplicaRouter(
+        engines=[_create_engine(db_connect) for db_connect in Config.get_list("DB_READ_REPLICAS", [])],
+        eject_for=Config.get_float("DB_REPLICA_EJECT_SECONDS", 30.0),
+    )
+
+
+class ReadRoutingSession(Session):
+    # Reads go to one replica for the whole session, flushes and DML always go to the primary.
+    def get_bind(self, mapper=None, clause=None, **kwargs):
+        if self._flushing or isinstance(clause, UpdateBase) or self.info.get("read_your_writes"):
+            return engine_factory().sync_engine
+        if "replica" not in self.info:
+            self.info["replica"] = replica_router().next_engine() or engine_factory()
+        return self.info["replica"].sync_engine
+
+
 @lru_cache
-def engine_factory():
-    return create_async_engine(Config.get("ASYNC_DB_CONNECT"))
+def read_session_maker() -> async_sessionmaker:
+    return async_sessionmaker(
+        engine_factory(), expire_on_commit=False, class_=SAAsyncSession, sync_session_class=ReadRoutingSession
+    )
+
+
+def db_read_session_factory(read_your_writes: bool = False) -> SAAsyncSession:
+    return read_session_maker()(info={"read_your_writes": read_your_writes})
+
+
+@asynccontextmanager
+async def db_read_session_scope(
+    session: Optional[SAAsyncSession] = None, read_your_writes: bool = False
+) -> AsyncIterator[SAAsyncSession]:
+    if session is not None:
+        yield session
+        return
+    async with db_read_session_factory(read_your_writes) as session:
+        try:
+            yield session
+        except (OSError, DBAPIError) as exc:
+            replica = session.info.get("replica")
+            connection_failed = isinstance(exc, OSError) or exc.connection_invalidated
+            if replica is not None and replica is not engine_factory() and connection_failed:
+                replica_router().eject(replica)
+            raise
+
+
+async def db_read_session() -> AsyncIterator[SAAsyncSession]:
+    # FastAPI dependency for read-only endpoints, routed to a replica when there are any.
+    async with db_read_session_scope() as session:
+        yield session
 
 
-def db_session_factory():
-    return async_sessionmaker(engine_factory(), expire_on_commit=False, class_=SAAsyncSession)()
+async def dispose_engine():
+    # an engine that was never created has nothing to close, and it may not even be configured
+    if engine_factory.cache_info().currsize:
+        await engine_factory().dispose()
+    if replica_router.cache_info().currsize:
+        for engine in replica_router().engines:
+            await engine.dispose()
+
+
+async def warm_up_pools():
+    # Opens the base pool of every engine up front, the first requests would otherwise connect one by one.
+    for engine in [engine_factory(), *replica_router().engines]:
+        results = await asyncio.gather(*(engine.connect() for _ in range(engine.pool.size())), return_exceptions=True)
+        connections = [result for result in results if not isinstance(result, BaseException)]
+        try:
+            for result in results:
+                if isinstance(result, BaseException):
+                    raise result
+            await asyncio.gather(*(connection.execute(sa.text("SELECT 1")) for connection in connections))
+        finally:
+            await asyncio.gather(*(connection.close() for connection in connections))
+
+
+def get_pool_status() -> dict:
+    return {
+        **_get_engine_pool_status(engine_factory()),
+        "checkout": pool_checkout_stats.as_dict(),
+        "replicas": replica_router().get_status(),
+    }
+
+
+def _get_engine_pool_status(engine: AsyncEngine) -> dict:
+    pool = engine.pool
+    return {
+        "size": pool.size(),
+        "checked_out": pool.checkedout(),
+        "overflow": pool.overflow(),
+    }
 
 
 Model = declarative_base()
 
 
 async def store_models_to_db(models: List[Model]) -> List[Model]:
+    models_by_class: Dict[Type[Model], List[Model]] = defaultdict(list)
+    for model in models:
+        models_by_class[type(model)].append(model)
+
     async with db_session_factory() as session:
-        session.add_all(models)
         try:
+            for model_class, class_models in models_by_class.items():
+                await _insert_returning(session, sa.inspect(model_class), class_models)
             await session.commit()
         except SQLAlchemyError as exc:
             await session.rollback()
             raise DBException(exc)
-        for model in models:
-            await session.refresh(model)
-        session.expunge_all()
     return models
 
 
+async def _insert_returning(session: SAAsyncSession, mapper: Mapper, models: List[Model]):
+    # One multi-row INSERT ... RETURNING per page (insertmanyvalues) instead of a refresh SELECT per model.
+    table = mapper.local_table
+    attr_by_column = {attr.columns[0]: attr.key for attr in mapper.column_attrs if attr.columns[0].table is table}
+    for model in models:
+        _fill_client_side_defaults(model, attr_by_column)
+
+    # Leave out columns nobody set so the server default applies.
+    insert_columns = [
+        column
+        for column, key in attr_by_column.items()
+        if column.server_default is None or any(getattr(model, key) is not None for model in models)
+    ]
+    rows = [{column.key: getattr(model, attr_by_column[column]) for column in insert_columns} for model in models]
+    result = await session.execute(sa.insert(table).returning(*attr_by_column), rows)
+
+    models_by_pk = {
+        tuple(getattr(model, attr_by_column[c]) for c in table.primary_key.columns): model for model in models
+    }
+    for row in result.mappings():
+        model = models_by_pk[tuple(row[c] for c in table.primary_key.columns)]
+        for column, key in attr_by_column.items():
+            setattr(model, key, row[column])
+    for model in models:
+        make_transient_to_detached(model)
+
+
+def _fill_client_side_defaults(model: Model, attr_by_column: Dict[sa.Column, str]):
+    for column, key in attr_by_column.items():
+        if getattr(model, key) is not None or column.default is None:
+            continue
+        if column.default.is_callable:
+            setattr(model, key, column.default.arg(None))
+        elif column.default.is_scalar:
+            setattr(model, key, column.default.arg)
+
+
 class DBException(Exception):
     pass
@@ -27,6 +27,8 @@ if config.config_file_name is not None:
 # target_metadata = mymodel.Base.metadata
 from app.models.content import Model
 from app.models.conversation_reply_log import Model
+from app.models.content_stock_progress import Model
+from app.models.conversation_reply_rollup import Model
 
 target_metadata = Model.metadata
 
@@ -0,0 +1,35 @@
+"""add content random_key
+
+Revision ID: 014a3da31a60
+Revises: d6739ea19223
+Create Date: 2023-03-06 11:02:41.518302
+
+"""
+import sqlalchemy as sa
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = "014a3da31a60"
+down_revision = "d6739ea19223"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    # server default backfills existing rows, new rows get the value from the model default
+    op.add_column(
+        "content",
+        sa.Column("random_key", sa.Float(), nullable=False, server_default=sa.text("random()")),
+    )
+    op.create_index(
+        "ix_content_type_language_random_key",
+        "content",
+        ["content_type", "language", "random_key"],
+        unique=False,
+    )
+
+
+def downgrade() -> None:
+    op.drop_index("ix_content_type_language_random_key", table_name="content")
+    op.drop_column("content", "random_key")
@@ -0,0 +1,38 @@
+"""add content_stock_progress
+
+Revision ID: 436c3acf8c49
+Revises: 014a3da31a60
+Create Date: 2023-03-08 17:44:12.903517
+
+"""
+import sqlalchemy as sa
+from sqlalchemy_utils.types.uuid import UUIDType
+from sqlalchemy_utils.types.choice import ChoiceType
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = "436c3acf8c49"
+down_revision = "014a3da31a60"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        "content_stock_progress",
+        sa.Column("id", UUIDType(), nullable=False),
+        sa.Column("content_type", ChoiceType([("t", "Tale"), ("f", "Fact")], impl=sa.String()), nullable=False),
+        sa.Column("language", ChoiceType([("en", "English"), ("ru", "Russian")], impl=sa.String()), nullable=False),
+        sa.Column("requested", sa.Integer(), nullable=False),
+        sa.Column("generated", sa.Integer(), nullable=False),
+        sa.Column("failed", sa.Integer(), nullable=False),
+        sa.Column("created_at", sa.DateTime(), nullable=False),
+        sa.Column("updated_at", sa.DateTime(), nullable=False),
+        sa.Column("finished_at", sa.DateTime(), nullable=True),
+        sa.PrimaryKeyConstraint("id"),
+    )
+
+
+def downgrade() -> None:
+    op.drop_table("content_stock_progress")
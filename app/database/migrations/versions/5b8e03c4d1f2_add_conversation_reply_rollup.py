@@ -0,0 +1,41 @@
+"""add conversation_reply_rollup
+
+Revision ID: 5b8e03c4d1f2
+Revises: 9f2c6e1d7a45
+Create Date: 2023-03-15 16:08:52.730164
+
+"""
+import sqlalchemy as sa
+from sqlalchemy_utils.types.choice import ChoiceType
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = "5b8e03c4d1f2"
+down_revision = "9f2c6e1d7a45"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        "conversation_reply_rollup",
+        sa.Column("bucket_start", sa.DateTime(), nullable=False),
+        sa.Column("language", ChoiceType([("en", "English"), ("ru", "Russian")], impl=sa.String()), nullable=False),
+        sa.Column("metric", sa.String(), nullable=False),
+        sa.Column("count", sa.BigInteger(), nullable=False),
+        sa.Column("total", sa.Float(), nullable=False),
+        sa.Column("histogram", sa.JSON(), nullable=False),
+        sa.PrimaryKeyConstraint("bucket_start", "language", "metric"),
+    )
+    op.create_table(
+        "rollup_watermark",
+        sa.Column("name", sa.String(), nullable=False),
+        sa.Column("processed_until", sa.DateTime(), nullable=False),
+        sa.PrimaryKeyConstraint("name"),
+    )
+
+
+def downgrade() -> None:
+    op.drop_table("rollup_watermark")
+    op.drop_table("conversation_reply_rollup")
@@ -0,0 +1,91 @@
+"""partition conversation_reply_log by month
+
+Revision ID: 9f2c6e1d7a45
+Revises: 436c3acf8c49
+Create Date: 2023-03-13 10:21:37.114870
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = "9f2c6e1d7a45"
+down_revision = "436c3acf8c49"
+branch_labels = None
+depends_on = None
+
+MONTHS_AHEAD = 3
+
+
+def upgrade() -> None:
+    op.execute("ALTER TABLE conversation_reply_log RENAME TO conversation_reply_log_unpartitioned")
+    op.execute(
+        "ALTER TABLE conversation_reply_log_unpartitioned "
+        "RENAME CONSTRAINT conversation_reply_log_pkey TO conversation_reply_log_unpartitioned_pkey"
+    )
+    op.execute(
+        """
+        CREATE TABLE conversation_reply_log (
+            id UUID NOT NULL,
+            user_reply TEXT NOT NULL,
+            language VARCHAR NOT NULL,
+            metrics JSON,
+            created_at TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+            PRIMARY KEY (id, created_at)
+        ) PARTITION BY RANGE (created_at)
+        """
+    )
+    op.create_index("ix_conversation_reply_log_created_at", "conversation_reply_log", ["created_at"])
+    op.execute("CREATE TABLE conversation_reply_log_default PARTITION OF conversation_reply_log DEFAULT")
+
+    # The months are worked out in SQL, so that `alembic upgrade --sql` renders the same migration.
+    op.execute(
+        f"""
+        DO $$
+        DECLARE
+            month DATE;
+        BEGIN
+            FOR month IN
+                SELECT generate_series(
+                    date_trunc('month', coalesce(oldest, now() AT TIME ZONE 'utc')),
+                    date_trunc('month', now() AT TIME ZONE 'utc') + interval '{MONTHS_AHEAD} months',
+                    interval '1 month'
+                )::date
+                FROM (SELECT min(created_at) AS oldest FROM conversation_reply_log_unpartitioned) AS reply_log
+            LOOP
+                EXECUTE format(
+                    'CREATE TABLE %I PARTITION OF conversation_reply_log FOR VALUES FROM (%L) TO (%L)',
+                    'conversation_reply_log_y' || to_char(month, 'YYYY') || 'm' || to_char(month, 'MM'),
+                    month,
+                    (month + interval '1 month')::date
+                );
+            END LOOP;
+        END $$
+        """
+    )
+
+    op.execute("INSERT INTO conversation_reply_log SELECT * FROM conversation_reply_log_unpartitioned")
+    op.drop_table("conversation_reply_log_unpartitioned")
+
+
+def downgrade() -> None:
+    op.execute("ALTER TABLE conversation_reply_log RENAME TO conversation_reply_log_partitioned")
+    op.execute(
+        "ALTER TABLE conversation_reply_log_partitioned "
+        "RENAME CONSTRAINT conversation_reply_log_pkey TO conversation_reply_log_partitioned_pkey"
+    )
+    op.execute(
+        """
+        CREATE TABLE conversation_reply_log (
+            id UUID NOT NULL,
+            user_reply TEXT NOT NULL,
+            language VARCHAR NOT NULL,
+            metrics JSON,
+            created_at TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+            CONSTRAINT conversation_reply_log_pkey PRIMARY KEY (id)
+        )
+        """
+    )
+    op.execute("INSERT INTO conversation_reply_log SELECT * FROM conversation_reply_log_partitioned")
+    # dropping the parent drops every partition with it
+    op.drop_table("conversation_reply_log_partitioned")
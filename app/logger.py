@@ -1,28 +1,128 @@
+import atexit
 import logging
+import queue
+import random
+import ujson
+import zlib
 
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
 from time import perf_counter
 from functools import lru_cache
-from typing import Coroutine
+from typing import Coroutine, Dict, Optional
+from uuid import uuid4
+
+from app.config import Config
+
+# id of the request or conversation turn being handled, attached to every record logged while handling it
+correlation_id: ContextVar[Optional[str]] = ContextVar("correlation_id", default=None)
 
 
 class Logger:
-    def __init__(self, name: str):
+    def __init__(self, name: str, handler: logging.Handler):
         self.writer = logging.getLogger(name)
-        self.writer.setLevel(logging.DEBUG)
-        handler = logging.StreamHandler()
-        handler.setFormatter(logging.Formatter("%(name)s: %(message)s"))
+        self.writer.setLevel(Config.get("LOG_LEVEL", "DEBUG"))
         self.writer.addHandler(handler)
 
     def log_error(self, message: str):
         self.writer.log(logging.ERROR, message)
 
+    def log_info(self, message: str):
+        self.writer.log(logging.INFO, message)
+
     def log_debug(self, message: str):
         self.writer.log(logging.DEBUG, message)
 
 
+class JSONFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        if getattr(record, "correlation_id", None) is not None:
+            entry["correlation_id"] = record.correlation_id
+        return ujson.dumps(entry, ensure_ascii=False, escape_forward_slashes=False)
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Passes the given share of records per level, levels that aren't listed pass in full. Records are sampled by
+    their correlation id, so a turn is either logged in full or not at all.
+    """
+
+    def __init__(self, rates: Dict[int, float]):
+        super().__init__()
+        self.rates = rates
+        self.sampled_out = 0
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        rate = self.rates.get(record.levelno, 1.0)
+        if rate >= 1.0:
+            return True
+        cid = correlation_id.get()
+        sample = random.random() if cid is None else zlib.crc32(cid.encode()) / 2**32
+        if sample < rate:
+            return True
+        self.sampled_out += 1
+        return False
+
+
+class QueueLogHandler(QueueHandler):
+    """Hands records over to the listener thread, the event loop never waits for the output."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record.correlation_id = correlation_id.get()
+        return super().prepare(record)
+
+    def enqueue(self, record: logging.LogRecord):
+        # a full queue means the output can't keep up, losing records beats stalling the loop
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+@lru_cache
+def get_log_handler() -> QueueLogHandler:
+    log_queue: queue.Queue = queue.Queue(Config.get_int("LOG_QUEUE_SIZE", 10000))
+    handler = QueueLogHandler(log_queue)
+    handler.addFilter(SamplingFilter({logging.DEBUG: Config.get_float("LOG_DEBUG_SAMPLE_RATE", 1.0)}))
+
+    output = logging.StreamHandler()
+    output.setFormatter(JSONFormatter())
+    listener = QueueListener(log_queue, output, respect_handler_level=True)
+    listener.start()
+    # flushes what is still queued
+    atexit.register(listener.stop)
+    return handler
+
+
+def get_log_status() -> dict:
+    handler = get_log_handler()
+    return {
+        "queued": handler.queue.qsize(),
+        "dropped": handler.dropped,
+        "sampled_out": sum(getattr(log_filter, "sampled_out", 0) for log_filter in handler.filters),
+    }
+
+
+def new_correlation_id() -> str:
+    cid = uuid4().hex[:16]
+    correlation_id.set(cid)
+    return cid
+
+
 @lru_cache
 def logger_factory(name: str) -> Logger:
-    return Logger(name)
+    return Logger(name, get_log_handler())
 
 
 def log_exec_time(func_description: str):
@@ -1,8 +1,9 @@
 import uuid
+import random
 
 from enum import Enum
 from datetime import datetime
-from sqlalchemy import Column, String, Text, JSON, DateTime
+from sqlalchemy import Column, String, Text, JSON, DateTime, Float, Index
 from sqlalchemy_utils.types.uuid import UUIDType
 from sqlalchemy_utils.types.choice import ChoiceType
 
@@ -28,3 +29,7 @@ class Content(Model):
     language = Column("language", ChoiceType(ContentLanguage, impl=String()), nullable=False)
     audio_url = Column("audio_url", Text(), nullable=True)
     created_at = Column("created_at", DateTime(), default=datetime.utcnow, nullable=False)
+    # Uniform key in [0, 1) used to pick random rows with a single index probe.
+    random_key = Column("random_key", Float(), default=random.random, nullable=False)
+
+    __table_args__ = (Index("ix_content_type_language_random_key", "content_type", "language", "random_key"),)
@@ -0,0 +1,23 @@
+import uuid
+import sqlalchemy as sa
+
+from datetime import datetime
+from sqlalchemy_utils.types.uuid import UUIDType
+from sqlalchemy_utils.types.choice import ChoiceType
+
+from app.database import Model
+from app.models.content import ContentLanguage, ContentType
+
+
+class ContentStockProgress(Model):
+    __tablename__ = "content_stock_progress"
+
+    id = sa.Column(UUIDType(), primary_key=True, default=uuid.uuid4)
+    content_type = sa.Column(ChoiceType(ContentType, impl=sa.String()), nullable=False)
+    language = sa.Column(ChoiceType(ContentLanguage, impl=sa.String()), nullable=False)
+    requested = sa.Column(sa.Integer(), nullable=False)
+    generated = sa.Column(sa.Integer(), default=0, nullable=False)
+    failed = sa.Column(sa.Integer(), default=0, nullable=False)
+    created_at = sa.Column(sa.DateTime(), default=datetime.utcnow, nullable=False)
+    updated_at = sa.Column(sa.DateTime(), default=datetime.utcnow, nullable=False)
+    finished_at = sa.Column(sa.DateTime(), nullable=True)
@@ -16,5 +16,8 @@ class ConversationReplyLog(Model):
     user_reply = sa.Column(sa.Text(), nullable=False)
     language = sa.Column(ChoiceType(ContentLanguage, impl=sa.String()), nullable=False)
     metrics = sa.Column(sa.JSON(), nullable=True)
-    created_at = sa.Column(sa.DateTime(), default=datetime.utcnow, nullable=False)
+    # partition key, monthly range partitions are managed by app/cli/maintain_reply_log.py
+    created_at = sa.Column(sa.DateTime(), default=datetime.utcnow, primary_key=True, nullable=False)
     # user_uuid?
+
+    __table_args__ = (sa.Index("ix_conversation_reply_log_created_at", "created_at"),)
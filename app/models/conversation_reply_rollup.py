@@ -0,0 +1,27 @@
+import sqlalchemy as sa
+
+from sqlalchemy_utils.types.choice import ChoiceType
+
+from app.database import Model
+from app.models.content import ContentLanguage
+
+
+class ConversationReplyRollup(Model):
+    """Per-minute, per-language histogram of one ConversationReplyLog metric."""
+
+    __tablename__ = "conversation_reply_rollup"
+
+    bucket_start = sa.Column(sa.DateTime(), primary_key=True)
+    language = sa.Column(ChoiceType(ContentLanguage, impl=sa.String()), primary_key=True)
+    metric = sa.Column(sa.String(), primary_key=True)
+    count = sa.Column(sa.BigInteger(), nullable=False)
+    total = sa.Column(sa.Float(), nullable=False)
+    # sparse {bucket index: count}, see app/services/metrics_rollup.py for the bucket layout
+    histogram = sa.Column(sa.JSON(), nullable=False)
+
+
+class RollupWatermark(Model):
+    __tablename__ = "rollup_watermark"
+
+    name = sa.Column(sa.String(), primary_key=True)
+    processed_until = sa.Column(sa.DateTime(), nullable=False)
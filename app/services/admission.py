@@ -0,0 +1,193 @@
+import asyncio
+import heapq
+import math
+
+from contextlib import asynccontextmanager
+from enum import IntEnum
+from time import monotonic
+from typing import AsyncIterator, List, Optional
+
+from app.config import Config
+from app.logger import logger_factory
+from app.services.exceptions import ServiceException
+from app.services.service import Service
+
+LIMIT_SMOOTHING = 0.2
+MIN_GRADIENT = 0.5
+MAX_RETRY_AFTER = 30
+
+
+class AdmissionPriority(IntEnum):
+    # lower goes first
+    STREAM_TURN = 0
+    REQUEST = 1
+
+
+class AdmissionRejected(ServiceException):
+    def __init__(self, message: str, retry_after: int):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class AdmissionTicket:
+    __slots__ = ("admitted_at", "latency")
+
+    def __init__(self):
+        self.admitted_at = monotonic()
+        self.latency: Optional[float] = None
+
+    def observe(self, latency: float):
+        # for turns whose wall time includes the user talking, only the upstream part should drive the limit
+        self.latency = latency
+
+
+class AdmissionController(Service):
+    """
+    Caps concurrent conversation turns of this worker. Turns over the cap wait in a short priority queue until their
+    deadline, the rest are rejected with a retry hint. The cap follows upstream latency: it shrinks when turns get
+    slower than `latency_tolerance` times the recent best, and grows back while they are fast.
+    """
+
+    def __init__(
+        self,
+        initial_limit: int,
+        min_limit: int,
+        max_limit: int,
+        max_queue: int,
+        queue_timeout: float,
+        latency_tolerance: float,
+        latency_window: int,
+        *args,
+        **kwargs,
+    ):
+        super().__init__(*args, **kwargs)
+        self.limit = float(initial_limit)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.latency_tolerance = latency_tolerance
+        self.latency_window = latency_window
+        self.in_flight = 0
+        self.waiters: List[list] = []
+        self._waiter_seq = 0
+        self.min_latency: Optional[float] = None
+        self.avg_latency: Optional[float] = None
+        self._window_min: Optional[float] = None
+        self._window_samples = 0
+        self.admitted = 0
+        self.rejected = 0
+        self.timed_out = 0
+
+    @asynccontextmanager
+    async def admit(
+        self, priority: AdmissionPriority, deadline: Optional[float] = None
+    ) -> AsyncIterator[AdmissionTicket]:
+        # queued until the queue timeout or the caller's deadline, whichever runs out first
+        queue_until = monotonic() + self.queue_timeout
+        await self._acquire(priority, queue_until if deadline is None else min(deadline, queue_until))
+        ticket = AdmissionTicket()
+        try:
+            yield ticket
+        finally:
+            self._release(ticket)
+
+    def is_overloaded(self) -> bool:
+        return len(self.waiters) >= self.max_queue
+
+    def retry_after(self) -> int:
+        # roughly how long until the current queue is worked off
+        turn_time = self.avg_latency or 1.0
+        return max(1, min(MAX_RETRY_AFTER, math.ceil(turn_time * (len(self.waiters) + 1) / self.capacity)))
+
+    @property
+    def capacity(self) -> int:
+        return max(1, int(self.limit))
+
+    async def _acquire(self, priority: AdmissionPriority, deadline: float):
+        if self.in_flight < self.capacity and not self.waiters:
+            self._admit()
+            return
+        if self.is_overloaded() or deadline <= monotonic():
+            self.rejected += 1
+            raise AdmissionRejected("Too many conversations in progress.", self.retry_after())
+
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiter_seq += 1
+        entry = [priority, self._waiter_seq, waiter]
+        heapq.heappush(self.waiters, entry)
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter), deadline - monotonic())
+        except asyncio.TimeoutError:
+            if not waiter.done():
+                self._remove_waiter(entry)
+                self.timed_out += 1
+                raise AdmissionRejected("Timed out waiting for a free conversation slot.", self.retry_after())
+        except asyncio.CancelledError:
+            if waiter.done():
+                self._release(None)
+            else:
+                self._remove_waiter(entry)
+            raise
+
+    def _admit(self):
+        self.in_flight += 1
+        self.admitted += 1
+
+    def _release(self, ticket: Optional[AdmissionTicket]):
+        self.in_flight -= 1
+        if ticket is not None:
+            self._observe_latency(ticket.latency if ticket.latency is not None else monotonic() - ticket.admitted_at)
+        while self.waiters and self.in_flight < self.capacity:
+            _, _, waiter = heapq.heappop(self.waiters)
+            if not waiter.done():
+                self._admit()
+                waiter.set_result(None)
+
+    def _remove_waiter(self, entry: list):
+        self.waiters.remove(entry)
+        heapq.heapify(self.waiters)
+
+    def _observe_latency(self, latency: float):
+        latency = max(latency, 1e-3)
+        self.avg_latency = latency if self.avg_latency is None else 0.9 * self.avg_latency + 0.1 * latency
+        # The baseline is the best latency of the last window, so it recovers when upstreams get slower for good.
+        self._window_min = latency if self._window_min is None else min(self._window_min, latency)
+        self._window_samples += 1
+        self.min_latency = latency if self.min_latency is None else min(self.min_latency, latency)
+        if self._window_samples >= self.latency_window:
+            self.min_latency = self._window_min
+            self._window_min, self._window_samples = None, 0
+
+        gradient = max(MIN_GRADIENT, min(1.0, self.latency_tolerance * self.min_latency / latency))
+        if gradient == 1.0 and self.in_flight + 1 < self.limit / 2:
+            # not using half of the limit says nothing about whether more would be fine
+            return
+        new_limit = self.limit * gradient + math.sqrt(self.limit)
+        self.limit = (1 - LIMIT_SMOOTHING) * self.limit + LIMIT_SMOOTHING * new_limit
+        self.limit = max(self.min_limit, min(self.max_limit, self.limit))
+
+    def get_status(self) -> dict:
+        return {
+            "limit": round(self.limit, 2),
+            "in_flight": self.in_flight,
+            "queued": len(self.waiters),
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "timed_out": self.timed_out,
+            "min_latency": self.min_latency,
+            "avg_latency": self.avg_latency,
+        }
+
+
+def admission_controller_factory() -> AdmissionController:
+    return AdmissionController(
+        initial_limit=Config.get_int("ADMISSION_INITIAL_LIMIT", 20),
+        min_limit=Config.get_int("ADMISSION_MIN_LIMIT", 2),
+        max_limit=Config.get_int("ADMISSION_MAX_LIMIT", 200),
+        max_queue=Config.get_int("ADMISSION_MAX_QUEUE", 50),
+        queue_timeout=Config.get_float("ADMISSION_QUEUE_TIMEOUT", 2.0),
+        latency_tolerance=Config.get_float("ADMISSION_LATENCY_TOLERANCE", 2.0),
+        latency_window=Config.get_int("ADMISSION_LATENCY_WINDOW", 500),
+        logger=logger_factory("Admission Controller"),
+    )
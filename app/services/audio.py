@@ -0,0 +1,20 @@
+from enum import Enum
+
+
+class AudioEncoding(Enum):
+    # Member names match google.cloud.texttospeech.AudioEncoding, values are file extensions. Kept apart from the
+    # integrations so callers don't have to import the SDK to pick an encoding.
+    OGG_OPUS = "ogg"
+    MP3 = "mp3"
+    LINEAR16 = "wav"
+
+
+class AudioQuality(Enum):
+    LOW = "low"
+    STANDARD = "standard"
+    HIGH = "high"
+
+    @property
+    def sample_rate_hertz(self) -> int:
+        # speech stays clear down to 16 kHz, the voices themselves are 24 kHz
+        return {AudioQuality.LOW: 16000, AudioQuality.STANDARD: 24000, AudioQuality.HIGH: 48000}[self]
@@ -0,0 +1,29 @@
+import asyncio
+
+from typing import Coroutine, Set
+
+
+class BackgroundTasks:
+    """Work a request leaves running after its reply, kept in one place so shutdown can wait for it."""
+
+    def __init__(self):
+        self.tasks: Set[asyncio.Task] = set()
+
+    def run(self, coro: Coroutine) -> asyncio.Task:
+        task = asyncio.create_task(coro)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return task
+
+    async def wait(self, timeout: float) -> int:
+        """Waits up to `timeout` seconds for the tasks, cancels the rest and returns how many were cancelled."""
+        if not self.tasks:
+            return 0
+        _, pending = await asyncio.wait(set(self.tasks), timeout=timeout)
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+        return len(pending)
+
+
+background_tasks = BackgroundTasks()
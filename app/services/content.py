@@ -3,13 +3,20 @@ import asyncio
 import sqlalchemy as sa
 import random
 
-from typing import List, Awaitable, Optional
+from typing import TYPE_CHECKING, List, Awaitable, Callable, Optional, Set, Tuple
 from uuid import UUID
-from app.database import store_models_to_db, db_session_factory
+from sqlalchemy.ext.asyncio import AsyncSession
+from app.database import store_models_to_db, db_session_factory, db_read_session_scope
 
 from app.models.content import Content, ContentLanguage, ContentType
 from app.services import factories
 
+if TYPE_CHECKING:
+    from app.services.integrations import gcp, openai as oai
+
+MAX_RANDOM_PROBES = 3
+CONTENT_CHANGED_CHANNEL = "content_changed"
+
 
 async def generate_new_content_and_store_in_db(
     content_type: ContentType, lang: ContentLanguage, count: int = 1
@@ -19,19 +26,91 @@ async def generate_new_content_and_store_in_db(
         task = asyncio.create_task(gen_new_content_and_upload_for_public_access(content_type, lang))
         tasks.append(task)
     models = await asyncio.gather(*tasks)
+    return await store_content_and_notify(models)
+
+
+async def generate_content_in_chunks(
+    content_type: ContentType,
+    lang: ContentLanguage,
+    count: int,
+    concurrency: int,
+    chunk_size: int,
+    generate: Optional[Callable[[ContentType, ContentLanguage], Awaitable[Content]]] = None,
+    store: Optional[Callable[[List[Content]], Awaitable[List[Content]]]] = None,
+    on_chunk_stored: Optional[Callable[[int, int], None]] = None,
+) -> Tuple[int, int]:
+    """Generate with at most `concurrency` items in flight, committing every `chunk_size` items.
+
+    Returns the number of stored and failed items, `on_chunk_stored` gets the running totals after every commit.
+    """
+    generate = generate or gen_new_content_and_upload_for_public_access
+    store = store or store_content_and_notify
+    queue: asyncio.Queue = asyncio.Queue(maxsize=chunk_size * 2)
+    remaining = count
+
+    async def worker():
+        nonlocal remaining
+        while remaining > 0:
+            remaining -= 1
+            try:
+                await queue.put(await generate(content_type, lang))
+            except Exception as exc:
+                await queue.put(exc)
+
+    async def close_queue_when_done():
+        await asyncio.gather(*workers)
+        await queue.put(None)
+
+    workers = [asyncio.create_task(worker()) for _ in range(min(concurrency, count))]
+    closer = asyncio.create_task(close_queue_when_done())
+    stored, failed, chunk = 0, 0, []
+    try:
+        while (item := await queue.get()) is not None:
+            if isinstance(item, Exception):
+                failed += 1
+            else:
+                chunk.append(item)
+            if len(chunk) >= chunk_size:
+                stored += len(await store(chunk))
+                chunk = []
+                if on_chunk_stored:
+                    on_chunk_stored(stored, failed)
+        if chunk:
+            stored += len(await store(chunk))
+            if on_chunk_stored:
+                on_chunk_stored(stored, failed)
+    finally:
+        for task in workers + [closer]:
+            task.cancel()
+    return stored, failed
+
+
+async def store_content_and_notify(models: List[Content]) -> List[Content]:
     models = await store_models_to_db(models)
+    await notify_content_changed()
     return models
 
 
+async def notify_content_changed():
+    # Delivered on commit to every process holding a content pool.
+    async with db_session_factory() as db:
+        await db.execute(sa.select(sa.func.pg_notify(CONTENT_CHANGED_CHANNEL, "")))
+        await db.commit()
+
+
 async def gen_new_content_and_upload_for_public_access(
     content_type: ContentType,
     lang: ContentLanguage,
+    ai: Optional["oai.AI"] = None,
+    tts_service: Optional["gcp.TextToVoice"] = None,
+    upload_service: Optional["gcp.Upload"] = None,
 ) -> Awaitable[Content]:
-    text = await factories.ai().generate_content(content_type, lang)
-    tts_service = factories.text_to_voice()
+    ai = ai or factories.ai()
+    text = await ai.generate_content(content_type, lang)
+    tts_service = tts_service or factories.text_to_voice()
     audio_file_path = await tts_service.text_to_voice(lang, text)
     upload_to_path = os.path.basename(audio_file_path)
-    upload_service = factories.upload()
+    upload_service = upload_service or factories.upload()
     audio_url = await upload_service.upload_public_content(audio_file_path, upload_to_path)
     os.remove(audio_file_path)
     content = Content(
@@ -44,17 +123,83 @@ async def gen_new_content_and_upload_for_public_access(
 
 
 async def get_random_content_item(
-    content_type: ContentType, lang: ContentLanguage, exclude_ids: Optional[List[UUID]]
+    content_type: ContentType,
+    lang: ContentLanguage,
+    exclude_ids: Optional[List[UUID]],
+    db: Optional[AsyncSession] = None,
 ) -> Content | None:
+    exclude_ids = set(exclude_ids or [])
+    async with db_read_session_scope(db) as db:
+        # Uniform: an offset into the catalogue, walked on the (content_type, language, random_key) index and redrawn
+        # when it lands on an excluded item.
+        total, excluded = await _count_content_items(db, content_type, lang, exclude_ids)
+        if total <= excluded:
+            return None
+        for _ in range(MAX_RANDOM_PROBES):
+            random_content_item = await _content_item_at(db, content_type, lang, random.randrange(total))
+            if random_content_item is not None and random_content_item.id not in exclude_ids:
+                return random_content_item
+        # Most of the catalogue is excluded, draw among the remaining items only.
+        return await _content_item_at(db, content_type, lang, random.randrange(total - excluded), exclude_ids)
+
+
+async def get_random_content_items(
+    content_type: ContentType,
+    lang: ContentLanguage,
+    count: int,
+    exclude_ids: Optional[List[UUID]],
+    db: Optional[AsyncSession] = None,
+) -> List[Content]:
+    exclude_ids = set(exclude_ids or [])
+    # One round trip: oversampled independent probes, then a run of keys after a random point and its wrap around, to
+    # fill up a small catalogue or heavy exclusions. At most count * 4 rows are read, duplicates and excluded hits are
+    # dropped here. The branch column keeps the random probes ahead of the fill.
+    content_query = _content_query(content_type, lang).order_by(Content.random_key).limit(1)
+    probes = [content_query.where(Content.random_key >= random.random()) for _ in range(count * 2)]
+    fill_query = _content_query(content_type, lang, exclude_ids).order_by(Content.random_key).limit(count)
+    fill_from = random.random()
+    fills = [fill_query.where(Content.random_key >= fill_from), fill_query.where(Content.random_key < fill_from)]
+    branches = [query.add_columns(sa.literal(branch).label("branch")) for branch, query in enumerate(probes + fills)]
+    random_items_query = sa.select(Content).from_statement(
+        sa.union_all(*branches).order_by(sa.literal_column("branch"))
+    )
+
+    async with db_read_session_scope(db) as db:
+        random_items = {}
+        for item in (await db.scalars(random_items_query)).all():
+            if item.id not in exclude_ids:
+                random_items.setdefault(item.id, item)
+        return list(random_items.values())[:count]
+
+
+def _content_query(content_type: ContentType, lang: ContentLanguage, exclude_ids: Optional[Set[UUID]] = None):
     content_query = sa.select(Content).where(sa.and_(Content.content_type == content_type, Content.language == lang))
     if exclude_ids:
         content_query = content_query.where(Content.id.not_in(exclude_ids))
-    count_query = sa.select(sa.func.count()).select_from(content_query)
+    return content_query
 
-    async with db_session_factory() as db:
-        total = await db.scalar(count_query)
-        if total == 0:
-            return None
-        random_item_pos = random.randint(0, total - 1)
-        random_content_item = (await db.scalars(content_query.offset(random_item_pos).limit(1))).one()
-        return random_content_item
+
+async def _count_content_items(
+    db: AsyncSession, content_type: ContentType, lang: ContentLanguage, exclude_ids: Set[UUID]
+) -> Tuple[int, int]:
+    count_query = sa.select(sa.func.count()).select_from(Content)
+    count_query = count_query.where(sa.and_(Content.content_type == content_type, Content.language == lang))
+    if not exclude_ids:
+        return await db.scalar(count_query), 0
+    # excluded ids are looked up by primary key, the ones of other types or languages don't count
+    excluded_query = count_query.where(Content.id.in_(exclude_ids))
+    counts_query = sa.select(count_query.scalar_subquery(), excluded_query.scalar_subquery())
+    total, excluded = (await db.execute(counts_query)).one()
+    return total, excluded
+
+
+async def _content_item_at(
+    db: AsyncSession,
+    content_type: ContentType,
+    lang: ContentLanguage,
+    offset: int,
+    exclude_ids: Optional[Set[UUID]] = None,
+) -> Content | None:
+    content_query = _content_query(content_type, lang, exclude_ids).order_by(Content.random_key)
+    # None only when items were deleted since they were counted
+    return await db.scalar(content_query.offset(offset).limit(1))
@@ -0,0 +1,216 @@
+import asyncio
+import random
+import sqlalchemy as sa
+
+from collections import defaultdict
+from datetime import datetime, timedelta
+from typing import Callable, Dict, List, Optional, Set, Tuple
+from uuid import UUID
+
+from app.config import Config
+from app.database import db_read_session_scope
+from app.database.database import engine_factory
+from app.logger import logger_factory
+from app.models.content import Content, ContentLanguage, ContentType
+from app.services.content import CONTENT_CHANGED_CHANNEL, MAX_RANDOM_PROBES
+from app.services.seen_items import SeenItems, is_seen
+from app.services.service import Service
+
+# Rows committed slightly out of created_at order are still picked up by re-reading this window.
+REFRESH_OVERLAP = timedelta(minutes=1)
+LISTEN_RETRY_MIN_DELAY = 1.0
+LISTEN_RETRY_MAX_DELAY = 60.0
+LISTEN_PING_INTERVAL = 30.0
+
+
+class ContentPoolBucket:
+    __slots__ = ("ids", "payloads", "positions")
+
+    def __init__(self):
+        self.ids: List[UUID] = []
+        self.payloads: List[bytes] = []
+        self.positions: Dict[UUID, int] = {}
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def add(self, content_id: UUID, payload: bytes) -> bool:
+        if content_id in self.positions:
+            return False
+        self.positions[content_id] = len(self.ids)
+        self.ids.append(content_id)
+        self.payloads.append(payload)
+        return True
+
+    def pick(self, count: int, exclude_ids: Optional[Set[UUID]] = None, seen: Optional[bytearray] = None) -> List[int]:
+        if not self.ids:
+            return []
+
+        def is_available(pos: int) -> bool:
+            if exclude_ids and self.ids[pos] in exclude_ids:
+                return False
+            return not seen or not is_seen(seen, pos)
+
+        picked: List[int] = []
+        picked_set: Set[int] = set()
+        for _ in range(count * MAX_RANDOM_PROBES):
+            if len(picked) == count:
+                return picked
+            pos = random.randrange(len(self.ids))
+            if pos not in picked_set and is_available(pos):
+                picked.append(pos)
+                picked_set.add(pos)
+        if len(picked) < count:
+            candidates = [pos for pos in range(len(self.ids)) if pos not in picked_set and is_available(pos)]
+            picked += random.sample(candidates, min(count - len(picked), len(candidates)))
+        return picked
+
+
+class ContentPool(Service):
+    """In-process copy of the content catalogue, serving random picks without touching the database."""
+
+    def __init__(
+        self,
+        serializer: Callable[[Content], bytes],
+        enabled: bool,
+        refresh_interval: float,
+        *args,
+        **kwargs,
+    ):
+        super().__init__(*args, **kwargs)
+        self.serializer = serializer
+        self.enabled = enabled
+        self.refresh_interval = refresh_interval
+        self.buckets: Dict[Tuple[ContentType, ContentLanguage], ContentPoolBucket] = defaultdict(ContentPoolBucket)
+        self.last_created_at: Optional[datetime] = None
+        self.ready = False
+        self._refresh_lock = asyncio.Lock()
+        self._refresh_requested = asyncio.Event()
+        self._tasks: List[asyncio.Task] = []
+
+    def pick(
+        self,
+        content_type: ContentType,
+        lang: ContentLanguage,
+        exclude_ids: Optional[List[UUID]] = None,
+        seen: Optional[SeenItems] = None,
+    ) -> Optional[bytes]:
+        payloads = self.pick_many(content_type, lang, 1, exclude_ids, seen)
+        return payloads[0] if payloads else None
+
+    def pick_many(
+        self,
+        content_type: ContentType,
+        lang: ContentLanguage,
+        count: int,
+        exclude_ids: Optional[List[UUID]] = None,
+        seen: Optional[SeenItems] = None,
+    ) -> List[bytes]:
+        bucket = self.buckets[(content_type, lang)]
+        seen_bitmap = seen.bitmap(content_type, lang) if seen is not None else None
+        positions = bucket.pick(count, set(exclude_ids or []), seen_bitmap)
+        if seen is not None:
+            for pos in positions:
+                seen.mark(content_type, lang, pos)
+        return [bucket.payloads[pos] for pos in positions]
+
+    def notify(self):
+        self._refresh_requested.set()
+
+    async def refresh(self, read_your_writes: bool = False) -> int:
+        async with self._refresh_lock:
+            query = sa.select(Content).order_by(Content.created_at)
+            if self.last_created_at is not None:
+                query = query.where(Content.created_at >= self.last_created_at - REFRESH_OVERLAP)
+            async with db_read_session_scope(read_your_writes=read_your_writes) as db:
+                new_items = (await db.scalars(query)).all()
+
+            added = 0
+            for item in new_items:
+                bucket = self.buckets[(item.content_type, item.language)]
+                if item.id not in bucket.positions:
+                    bucket.add(item.id, self.serializer(item))
+                    added += 1
+                self.last_created_at = item.created_at
+            self.ready = True
+            if added:
+                self.logger.log_debug(f"Added {added} items to the content pool.")
+            return added
+
+    async def start(self):
+        if not self.enabled:
+            return
+        try:
+            await self.refresh()
+        except Exception as exc:
+            self.logger.log_error(f"Initial content pool load failed, serving from the database: {exc}")
+        self._tasks = [
+            asyncio.create_task(self._refresh_periodically()),
+            asyncio.create_task(self._listen_for_changes()),
+        ]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def _refresh_periodically(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._refresh_requested.wait(), self.refresh_interval)
+            except asyncio.TimeoutError:
+                pass
+            # a notification means a fresh commit on the primary that replicas may not have yet
+            notified = self._refresh_requested.is_set()
+            self._refresh_requested.clear()
+            try:
+                await self.refresh(read_your_writes=notified)
+            except Exception as exc:
+                self.logger.log_error(f"Content pool refresh failed: {exc}")
+
+    async def _listen_for_changes(self):
+        retry_delay = LISTEN_RETRY_MIN_DELAY
+        reconnecting = False
+        while True:
+            try:
+                async with engine_factory().connect() as conn:
+                    try:
+                        driver_conn = (await conn.get_raw_connection()).driver_connection
+                        lost = asyncio.Event()
+                        driver_conn.add_termination_listener(lambda *_: lost.set())
+                        await driver_conn.add_listener(CONTENT_CHANGED_CHANNEL, lambda *_: self.notify())
+                        if reconnecting:
+                            # changes committed while nobody listened were never delivered
+                            self.notify()
+                        retry_delay = LISTEN_RETRY_MIN_DELAY
+                        await self._wait_for_connection_loss(driver_conn, lost)
+                    finally:
+                        # a connection with a listener on it is not handed out again
+                        await conn.invalidate()
+                self.logger.log_error("Lost the connection listening for content changes, reconnecting.")
+            except asyncio.CancelledError:
+                raise
+            except Exception as exc:
+                self.logger.log_error(f"Could not listen for content changes, retrying in {retry_delay:.0f}s: {exc}")
+                await asyncio.sleep(retry_delay)
+                retry_delay = min(retry_delay * 2, LISTEN_RETRY_MAX_DELAY)
+            reconnecting = True
+
+    async def _wait_for_connection_loss(self, driver_conn, lost: asyncio.Event):
+        # a half-open connection never terminates, the ping finds it
+        while True:
+            try:
+                await asyncio.wait_for(lost.wait(), LISTEN_PING_INTERVAL)
+                return
+            except asyncio.TimeoutError:
+                await driver_conn.execute("SELECT 1", timeout=LISTEN_PING_INTERVAL)
+
+
+def content_pool_factory(serializer: Callable[[Content], bytes]) -> ContentPool:
+    return ContentPool(
+        serializer,
+        enabled=Config.get_bool("CONTENT_POOL_ENABLED", True),
+        refresh_interval=Config.get_float("CONTENT_POOL_REFRESH_INTERVAL", 300.0),
+        logger=logger_factory("Content Pool"),
+    )
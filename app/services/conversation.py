@@ -1,5 +1,8 @@
+from contextlib import aclosing
+from enum import Enum
 from io import BytesIO
-from typing import Optional
+from time import perf_counter
+from typing import TYPE_CHECKING, Any, Coroutine, List, NamedTuple, Optional
 from tempfile import SpooledTemporaryFile
 from pydantic import BaseModel
 from collections.abc import AsyncIterator
@@ -7,61 +10,247 @@ from collections.abc import AsyncIterator
 from app.database.database import store_models_to_db
 from app.models.conversation_reply_log import ConversationReplyLog
 from app.models.content import ContentLanguage
-from google.cloud import texttospeech as gcp_tts
-from .integrations import gcp
+from .audio import AudioEncoding
+from .background import background_tasks
+from .deadline import Deadline, DeadlineExceeded, degradation_counts
+from .integrations.circuit_breaker import CircuitOpenException
 from .service import Service, time_it
 from . import factories
 
+if TYPE_CHECKING:
+    from .integrations import gcp
+
+SHORT_REPLY_MAX_TOKENS = 150
+FALLBACK_PHRASES = {
+    ContentLanguage.ENGLISH: "Sorry, I need a moment to think. Could you say that again?",
+    ContentLanguage.RUSSIAN: "Извините, мне нужно немного подумать. Повторите, пожалуйста?",
+}
+
+
+class Degradation(Enum):
+    SHORT_REPLY = "short_reply"
+    TRUNCATED_REPLY = "truncated_reply"
+    FALLBACK_PHRASE = "fallback_phrase"
+    CACHED_AUDIO = "cached_audio"
+    TEXT_ONLY = "text_only"
+
+
+class ConversationReply(BaseModel):
+    text: str
+    # None for text-only replies
+    audio_path: Optional[str]
+
 
 class Conversation(Service):
-    async def get_and_log_reply_for_audio(self, lang: ContentLanguage, source_audio_file: SpooledTemporaryFile) -> str:
+    def __init__(self, short_reply_budget: float, log_replies: bool = True, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # below this many seconds left the AI is asked for a shorter reply
+        self.short_reply_budget = short_reply_budget
+        self.log_replies = log_replies
+
+    async def get_and_log_reply_for_audio(
+        self,
+        lang: ContentLanguage,
+        source_audio_file: SpooledTemporaryFile,
+        deadline: Optional[Deadline] = None,
+        ttv: Optional["gcp.TextToVoice"] = None,
+    ) -> ConversationReply:
         source_audio_content = source_audio_file.read()
-        vtt_time, vtt_resp = await self.get_text_for_audio(source_audio_content, lang)
-        ai_reply_time, ai_resp = await self.get_ai_reply(lang, vtt_resp.text)
-        ttv_time, dest_audio = await self.get_audio_for_text(lang, ai_resp)
-        await log_response_to_db(
+        degradations: List[Degradation] = []
+        vtt_time, vtt_resp = await self.get_text_for_audio(source_audio_content, lang, deadline)
+        ai_reply_time, ai_resp = await self.get_ai_reply(lang, vtt_resp.transcription, deadline, degradations)
+        ttv_time, dest_audio = await self.get_audio_for_text(lang, ai_resp, deadline, degradations, ttv)
+        self._log_reply(
             ReplyLogEntry(
                 lang=lang,
-                user_reply=vtt_resp.transcript,
+                user_reply=vtt_resp.transcription,
                 user_reply_confidence_score=vtt_resp.confidence,
                 vtt_time=vtt_time,
                 ttv_time=ttv_time,
                 ai_reply_length=len(ai_resp),
                 ai_reply_time=ai_reply_time,
+                degradations=[degradation.value for degradation in degradations],
             )
         )
-        return dest_audio
+        return ConversationReply(text=ai_resp, audio_path=dest_audio)
 
     @time_it
-    async def get_text_for_audio(self, source_audio_content: BytesIO, lang: ContentLanguage) -> gcp.VTTResp:
+    async def get_text_for_audio(
+        self, source_audio_content: BytesIO, lang: ContentLanguage, deadline: Optional[Deadline] = None
+    ) -> "gcp.VTTResp":
         vtt_service = factories.voice_to_text()
-        resp: gcp.VTTResp = await vtt_service.voice_to_text(lang, source_audio_content)
+        resp = await vtt_service.voice_to_text(lang, source_audio_content, deadline)
         return resp
 
     @time_it
-    async def get_ai_reply(self, lang: ContentLanguage, text: str) -> str:
+    async def get_ai_reply(
+        self,
+        lang: ContentLanguage,
+        text: str,
+        deadline: Optional[Deadline] = None,
+        degradations: Optional[List[Degradation]] = None,
+    ) -> str:
+        degradations = [] if degradations is None else degradations
         ai = factories.ai()
-        return ai.reply(text)
+        try:
+            return await ai.reply(text, deadline, self._get_max_tokens(deadline, degradations))
+        except (DeadlineExceeded, CircuitOpenException):
+            self._degrade(degradations, Degradation.FALLBACK_PHRASE)
+            return FALLBACK_PHRASES[lang]
 
     @time_it
-    async def get_audio_for_text(self, lang: ContentLanguage, text: str) -> str:
-        ttv_service = factories.text_to_voice()
-        out_audio: str = await ttv_service.text_to_voice(lang, text)
+    async def get_audio_for_text(
+        self,
+        lang: ContentLanguage,
+        text: str,
+        deadline: Optional[Deadline] = None,
+        degradations: Optional[List[Degradation]] = None,
+        ttv_service: Optional["gcp.TextToVoice"] = None,
+    ) -> Optional[str]:
+        degradations = [] if degradations is None else degradations
+        ttv_service = ttv_service or factories.text_to_voice()
+        audio_content = self._get_phrase_audio(ttv_service, lang, text, degradations)
+        if audio_content is not None:
+            return await ttv_service.save_audio(audio_content)
+        if Degradation.TEXT_ONLY in degradations:
+            return None
+        try:
+            out_audio: str = await ttv_service.text_to_voice(lang, text, deadline)
+        except (DeadlineExceeded, CircuitOpenException):
+            self._degrade(degradations, Degradation.TEXT_ONLY)
+            return None
         return out_audio
 
     async def get_and_log_stream_reply(
-        self, lang: ContentLanguage, incoming_stream: AsyncIterator[bytes]
+        self,
+        lang: ContentLanguage,
+        incoming_stream: AsyncIterator[bytes],
+        ttv: Optional["gcp.StreamTextToVoice"] = None,
+        deadline: Optional[Deadline] = None,
     ) -> AsyncIterator[bytes]:
+        async with aclosing(self.stream_reply_events(lang, incoming_stream, ttv, deadline)) as events:
+            async for event in events:
+                if event.event_type == ReplyEventType.AUDIO:
+                    yield event.data
+
+    async def stream_reply_events(
+        self,
+        lang: ContentLanguage,
+        incoming_stream: AsyncIterator[bytes],
+        ttv: Optional["gcp.StreamTextToVoice"] = None,
+        deadline: Optional[Deadline] = None,
+    ) -> AsyncIterator["ReplyEvent"]:
         voice_to_text_service = factories.voice_to_text(stream=True)
         ai = factories.ai()
-        ttv = factories.text_to_voice(stream=True, audio_encoding=gcp_tts.AudioEncoding.MP3)
+        if ttv is None:
+            ttv = factories.text_to_voice(stream=True, audio_encoding=AudioEncoding.MP3)
+        degradations: List[Degradation] = []
+
+        start_time = perf_counter()
+        vtt_resp = await voice_to_text_service.voice_to_text(lang, incoming_stream, deadline=deadline)
+        vtt_time = perf_counter() - start_time
+        yield ReplyEvent(ReplyEventType.TRANSCRIPT, vtt_resp.transcription)
+
+        ai_reply_time, ttv_time, ai_reply_length = 0.0, 0.0, 0
+        max_tokens = self._get_max_tokens(deadline, degradations)
+        async with aclosing(ai.reply_stream(vtt_resp.transcription, deadline, max_tokens)) as text_stream:
+            while True:
+                start_time = perf_counter()
+                try:
+                    text_chunk = await anext(text_stream)
+                except StopAsyncIteration:
+                    break
+                except (DeadlineExceeded, CircuitOpenException):
+                    if ai_reply_length:
+                        self._degrade(degradations, Degradation.TRUNCATED_REPLY)
+                        break
+                    self._degrade(degradations, Degradation.FALLBACK_PHRASE)
+                    text_chunk = FALLBACK_PHRASES[lang]
+                ai_reply_time += perf_counter() - start_time
+                ai_reply_length += len(text_chunk)
+                # text goes out before its audio is synthesized so clients can render it right away
+                yield ReplyEvent(ReplyEventType.TEXT, text_chunk)
+
+                start_time = perf_counter()
+                audio_data = self._get_phrase_audio(ttv, lang, text_chunk, degradations)
+                if audio_data is None and Degradation.TEXT_ONLY not in degradations:
+                    try:
+                        audio_data = await ttv.synthesize_chunk(lang, text_chunk, deadline)
+                    except (DeadlineExceeded, CircuitOpenException):
+                        self._degrade(degradations, Degradation.TEXT_ONLY)
+                ttv_time += perf_counter() - start_time
+                if audio_data is not None:
+                    yield ReplyEvent(ReplyEventType.AUDIO, audio_data)
+                if Degradation.FALLBACK_PHRASE in degradations:
+                    break
+
+        log_entry = ReplyLogEntry(
+            lang=lang,
+            user_reply=vtt_resp.transcription,
+            user_reply_confidence_score=vtt_resp.confidence,
+            vtt_time=round(vtt_time, 4),
+            ttv_time=round(ttv_time, 4),
+            ai_reply_length=ai_reply_length,
+            ai_reply_time=round(ai_reply_time, 4),
+            degradations=[degradation.value for degradation in degradations],
+        )
+        yield ReplyEvent(ReplyEventType.METRICS, log_entry.dict(exclude={"lang", "user_reply"}))
+        self._log_reply(log_entry)
+
+    def _get_max_tokens(self, deadline: Optional[Deadline], degradations: List[Degradation]) -> Optional[int]:
+        # None leaves the reply length to the AI service
+        if deadline is not None and deadline.timeout() is not None and deadline.timeout() < self.short_reply_budget:
+            self._degrade(degradations, Degradation.SHORT_REPLY)
+            return SHORT_REPLY_MAX_TOKENS
+        return None
+
+    def _get_phrase_audio(
+        self, ttv: "gcp.TextToVoice", lang: ContentLanguage, text: str, degradations: List[Degradation]
+    ) -> Optional[bytes]:
+        # Only fallback phrases are cached. There is no budget left for them, so they are never synthesized in line.
+        if Degradation.FALLBACK_PHRASE not in degradations:
+            return None
+        audio_content = ttv.get_cached_phrase(lang, text)
+        if audio_content is not None:
+            self._degrade(degradations, Degradation.CACHED_AUDIO)
+            return audio_content
+        self._degrade(degradations, Degradation.TEXT_ONLY)
+        self._run_in_background(ttv.cache_phrase(lang, text))
+        return None
+
+    def _log_reply(self, log_entry: "ReplyLogEntry"):
+        if not self.log_replies:
+            return
+        # the reply is out or about to be, a failed bookkeeping write must not fail the turn
+        self._run_in_background(self._store_log_entry(log_entry))
+
+    async def _store_log_entry(self, log_entry: "ReplyLogEntry"):
+        try:
+            await log_response_to_db(log_entry)
+        except Exception as exc:
+            self.logger.log_error(f"Could not log the reply: {exc}")
+
+    def _run_in_background(self, coro: Coroutine):
+        # outlives this instance, which is built per request
+        background_tasks.run(coro)
+
+    def _degrade(self, degradations: List[Degradation], degradation: Degradation):
+        if degradation not in degradations:
+            degradations.append(degradation)
+            degradation_counts[degradation.value] += 1
+            self.logger.log_debug(f"Turn degraded: {degradation.value}.")
+
+
+class ReplyEventType(Enum):
+    TRANSCRIPT = "transcript"
+    TEXT = "text"
+    AUDIO = "audio"
+    METRICS = "metrics"
+
 
-        vtt_resp = await voice_to_text_service.voice_to_text(lang, incoming_stream)
-        reply_stream = ai.reply_stream(vtt_resp.transcription)
-        audio_stream = ttv.text_to_voice(lang, reply_stream)
-        # TODO: Add logging here when needed
-        async for audio_data in audio_stream:
-            yield audio_data
+class ReplyEvent(NamedTuple):
+    event_type: ReplyEventType
+    data: Any
 
 
 class ReplyLogEntry(BaseModel):
@@ -72,6 +261,7 @@ class ReplyLogEntry(BaseModel):
     ttv_time: Optional[float]
     ai_reply_length: Optional[int]
     ai_reply_time: Optional[float]
+    degradations: List[str] = []
     # audio_uri?
 
 
@@ -85,6 +275,7 @@ async def log_response_to_db(log_entry: ReplyLogEntry):
             "ttv_time": log_entry.ttv_time,
             "ai_reply_length": log_entry.ai_reply_length,
             "ai_reply_time": log_entry.ai_reply_time,
+            "degradations": log_entry.degradations,
         },
     )
     await store_models_to_db([log_entry])
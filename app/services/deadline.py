@@ -0,0 +1,94 @@
+import asyncio
+
+from collections import Counter
+from collections.abc import AsyncIterator
+from time import monotonic
+from typing import Awaitable, Optional, Tuple, Type, TypeVar
+
+from app.services.exceptions import ServiceException
+
+T = TypeVar("T")
+
+# times each degradation kicked in since the worker started, exposed in /metrics
+degradation_counts: Counter = Counter()
+
+
+class DeadlineExceeded(ServiceException):
+    def __init__(self, stage: str):
+        super().__init__(f"{stage} did not finish within the turn deadline.")
+        self.stage = stage
+
+
+class Deadline:
+    """
+    Time budget of one conversation turn, created at the API boundary and handed down to every upstream call.
+    A deadline can be created stopped and started later: streamed turns start counting when the user stops talking.
+    """
+
+    def __init__(self, budget: float, started: bool = True):
+        self.budget = budget
+        self.expires_at: Optional[float] = monotonic() + budget if started else None
+        self._started = asyncio.Event()
+        if started:
+            self._started.set()
+
+    def start(self):
+        if self.expires_at is None:
+            self.expires_at = monotonic() + self.budget
+            self._started.set()
+
+    def remaining(self) -> float:
+        if self.expires_at is None:
+            return self.budget
+        return max(0.0, self.expires_at - monotonic())
+
+    def expired(self) -> bool:
+        return self.expires_at is not None and self.remaining() == 0.0
+
+    def timeout(self, cap: Optional[float] = None) -> Optional[float]:
+        # while stopped, only the stage's own cap applies
+        if self.expires_at is None:
+            return cap
+        return self.remaining() if cap is None else min(cap, self.remaining())
+
+    async def wait(
+        self,
+        awaitable: Awaitable[T],
+        stage: str,
+        timeout_errors: Tuple[Type[BaseException], ...] = (asyncio.TimeoutError,),
+    ) -> T:
+        # Like wait_for_stage, but a wait that began while the deadline was stopped is bounded once it starts.
+        task = asyncio.ensure_future(awaitable)
+        try:
+            if self.expires_at is None:
+                started = asyncio.ensure_future(self._started.wait())
+                try:
+                    await asyncio.wait({task, started}, return_when=asyncio.FIRST_COMPLETED)
+                finally:
+                    started.cancel()
+                if task.done():
+                    return task.result()
+            return await wait_for_stage(task, stage, self.timeout(), timeout_errors)
+        finally:
+            task.cancel()
+
+    async def start_after(self, stream: AsyncIterator[T]) -> AsyncIterator[T]:
+        async for item in stream:
+            yield item
+        self.start()
+
+
+def stage_timeout(deadline: Optional[Deadline], cap: float) -> float:
+    return cap if deadline is None else deadline.timeout(cap)
+
+
+async def wait_for_stage(
+    awaitable: Awaitable[T],
+    stage: str,
+    timeout: Optional[float],
+    timeout_errors: Tuple[Type[BaseException], ...] = (asyncio.TimeoutError,),
+) -> T:
+    try:
+        return await asyncio.wait_for(awaitable, timeout)
+    except timeout_errors:
+        raise DeadlineExceeded(stage)
@@ -1,28 +1,74 @@
-from typing import Optional
+from typing import TYPE_CHECKING, Optional
+from app.config import get_settings
 from app.logger import logger_factory
-from google.cloud import texttospeech as gcp_tts
-from .integrations import gcp, openai as oai
+from .audio import AudioEncoding
 from .conversation import Conversation
 
+# The integrations pull in the Google and OpenAI SDKs, which take most of the startup time. They are imported when
+# a service is first built, so processes that never use them don't pay for it.
+if TYPE_CHECKING:
+    from .integrations import gcp, openai as oai
+
 
 def conversation() -> Conversation:
-    return Conversation(logger=logger_factory("Conversation Service"))
+    return Conversation(
+        short_reply_budget=get_settings().conversation_short_reply_budget,
+        log_replies=get_settings().conversation_log_replies,
+        logger=logger_factory("Conversation Service"),
+    )
+
 
+def upload(stream: Optional[bool] = False) -> "gcp.Upload":
+    if get_settings().stub_backends:
+        from .integrations import stubs
+
+        return stubs.stub_upload(stream=stream)
+    from .integrations import gcp
 
-def upload(stream: Optional[bool] = False) -> gcp.Upload:
     return gcp.upload_service_factory(stream=stream)
 
 
-def voice_to_text(stream: Optional[bool] = False) -> gcp.VoiceToText:
+def voice_to_text(stream: Optional[bool] = False) -> "gcp.VoiceToText":
+    if get_settings().stub_backends:
+        from .integrations import stubs
+
+        return stubs.stub_voice_to_text(stream=stream)
+    from .integrations import gcp
+
     return gcp.voice_to_text_service_factory(stream=stream)
 
 
 def text_to_voice(
     stream: Optional[bool] = False,
-    audio_encoding: Optional[gcp_tts.AudioEncoding] = gcp_tts.AudioEncoding.OGG_OPUS,
-) -> gcp.TextToVoice:
-    return gcp.text_to_voice_service_factory(stream=stream, audio_encoding=audio_encoding)
+    audio_encoding: AudioEncoding = AudioEncoding.OGG_OPUS,
+    sample_rate_hertz: Optional[int] = None,
+) -> "gcp.TextToVoice":
+    if get_settings().stub_backends:
+        from .integrations import stubs
+
+        return stubs.stub_text_to_voice(stream, audio_encoding, sample_rate_hertz)
+    from .integrations import gcp
+
+    return gcp.text_to_voice_service_factory(
+        stream=stream, audio_encoding=audio_encoding, sample_rate_hertz=sample_rate_hertz
+    )
+
+
+def batch_text_to_voice(batch_size: Optional[int] = None) -> "gcp.BatchTextToVoice":
+    if get_settings().stub_backends:
+        from .integrations import stubs
+
+        return stubs.stub_batch_text_to_voice(batch_size)
+    from .integrations import gcp
+
+    return gcp.batch_text_to_voice_service_factory(batch_size=batch_size)
+
+
+def ai() -> "oai.AI":
+    if get_settings().stub_backends:
+        from .integrations import stubs
 
+        return stubs.stub_ai()
+    from .integrations import openai as oai
 
-def ai() -> oai.AI:
     return oai.openai_service_factory()
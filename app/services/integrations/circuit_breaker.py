@@ -0,0 +1,257 @@
+import asyncio
+import inspect
+import math
+
+from collections import deque
+from contextlib import aclosing
+from enum import Enum
+from functools import wraps
+from time import monotonic
+from typing import AsyncIterator, Callable, Deque, Dict, Optional, Tuple
+
+from app.config import Config
+from app.logger import logger_factory
+from app.services.deadline import Deadline, DeadlineExceeded
+from app.services.exceptions import ServiceException
+
+
+class CircuitState(Enum):
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+
+class CircuitOpenException(ServiceException):
+    def __init__(self, name: str, retry_after: int):
+        super().__init__(f"{name} is unavailable, calls are suspended for {retry_after} sec.")
+        self.name = name
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    """
+    Rolling window of call outcomes of one upstream. Too many failed or slow calls open the circuit, calls then fail
+    right away until `open_for` passes. A few trial calls are let through after that (half-open), and the circuit
+    closes again once they all succeed.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        failure_rate_threshold: float,
+        slow_call_rate_threshold: float,
+        window: float,
+        min_calls: int,
+        open_for: float,
+        half_open_calls: int,
+    ):
+        self.name = name
+        self.failure_rate_threshold = failure_rate_threshold
+        self.slow_call_rate_threshold = slow_call_rate_threshold
+        self.window = window
+        self.min_calls = min_calls
+        self.open_for = open_for
+        self.half_open_calls = half_open_calls
+        self.logger = logger_factory("Circuit Breaker")
+        self.state = CircuitState.CLOSED
+        # (finished at, failed, slow)
+        self.calls: Deque[Tuple[float, bool, bool]] = deque()
+        self.opened_at = 0.0
+        self.trials_in_flight = 0
+        self.trials_succeeded = 0
+        self.rejected = 0
+
+    async def call(
+        self,
+        func: Callable,
+        args: tuple,
+        kwargs: dict,
+        slow_call_threshold: Optional[float] = None,
+        is_failure: Optional[Callable[[Exception], bool]] = None,
+    ):
+        trial = self.before_call()
+        start_time = monotonic()
+        try:
+            result = await func(*args, **kwargs)
+        except asyncio.CancelledError:
+            self.after_call(trial, cancelled=True)
+            raise
+        except Exception as exc:
+            self.after_failure(trial, exc, args, kwargs, is_failure)
+            raise
+        self.after_call(trial, slow=is_slow(monotonic() - start_time, slow_call_threshold))
+        return result
+
+    async def stream(
+        self,
+        func: Callable,
+        args: tuple,
+        kwargs: dict,
+        slow_call_threshold: Optional[float] = None,
+        is_failure: Optional[Callable[[Exception], bool]] = None,
+    ) -> AsyncIterator:
+        trial = self.before_call()
+        start_time = monotonic()
+        # streams are slow when their first item is, their length is up to the caller
+        first_item_time = None
+        recorded = False
+        try:
+            async with aclosing(func(*args, **kwargs)) as items:
+                async for item in items:
+                    if first_item_time is None:
+                        first_item_time = monotonic() - start_time
+                    try:
+                        yield item
+                    except BaseException:
+                        # closed or thrown into by the consumer, which says nothing about the upstream
+                        self.after_call(trial, cancelled=True)
+                        recorded = True
+                        raise
+        except (asyncio.CancelledError, GeneratorExit):
+            if not recorded:
+                self.after_call(trial, cancelled=True)
+            raise
+        except Exception as exc:
+            if not recorded:
+                self.after_failure(trial, exc, args, kwargs, is_failure)
+            raise
+        self.after_call(trial, slow=is_slow(first_item_time or monotonic() - start_time, slow_call_threshold))
+
+    def before_call(self) -> bool:
+        # returns whether the call is a half-open trial
+        if self.state == CircuitState.OPEN:
+            if monotonic() - self.opened_at < self.open_for:
+                self._reject()
+            self._move_to(CircuitState.HALF_OPEN)
+        if self.state == CircuitState.HALF_OPEN:
+            if self.trials_in_flight + self.trials_succeeded >= self.half_open_calls:
+                self._reject()
+            self.trials_in_flight += 1
+            return True
+        return False
+
+    def after_failure(
+        self,
+        trial: bool,
+        exc: Exception,
+        args: tuple,
+        kwargs: dict,
+        is_failure: Optional[Callable[[Exception], bool]] = None,
+    ):
+        # A turn deadline that ran out means the caller's budget was too short for the call, not that the upstream
+        # failed. Timeouts of the stage's own cap still count. Errors `is_failure` rejects, like bad user input, are
+        # not held against the upstream either.
+        caller_timed_out = isinstance(exc, DeadlineExceeded) and any(
+            isinstance(arg, Deadline) and arg.expired() for arg in (*args, *kwargs.values())
+        )
+        not_upstream = is_failure is not None and not is_failure(exc)
+        ignored = caller_timed_out or not_upstream
+        self.after_call(trial, failed=not ignored, cancelled=ignored)
+
+    def after_call(self, trial: bool, failed: bool = False, slow: bool = False, cancelled: bool = False):
+        if trial:
+            self.trials_in_flight -= 1
+            if self.state != CircuitState.HALF_OPEN or cancelled:
+                return
+            if failed:
+                self._move_to(CircuitState.OPEN)
+                return
+            self.trials_succeeded += 1
+            if self.trials_succeeded >= self.half_open_calls:
+                self._move_to(CircuitState.CLOSED)
+            return
+        if cancelled or self.state != CircuitState.CLOSED:
+            return
+
+        now = monotonic()
+        self.calls.append((now, failed, slow))
+        while self.calls and self.calls[0][0] < now - self.window:
+            self.calls.popleft()
+        if len(self.calls) < self.min_calls:
+            return
+        failure_rate = sum(call_failed for _, call_failed, _ in self.calls) / len(self.calls)
+        slow_call_rate = sum(call_slow for _, _, call_slow in self.calls) / len(self.calls)
+        if failure_rate >= self.failure_rate_threshold or slow_call_rate >= self.slow_call_rate_threshold:
+            self.logger.log_error(
+                f"Opening the {self.name} circuit: {failure_rate:.0%} failed and {slow_call_rate:.0%} slow calls "
+                f"out of the last {len(self.calls)}."
+            )
+            self._move_to(CircuitState.OPEN)
+
+    def _reject(self):
+        self.rejected += 1
+        retry_after = max(1, math.ceil(self.open_for - (monotonic() - self.opened_at)))
+        raise CircuitOpenException(self.name, retry_after)
+
+    def _move_to(self, state: CircuitState):
+        self.state = state
+        self.trials_in_flight = 0
+        self.trials_succeeded = 0
+        if state == CircuitState.OPEN:
+            self.opened_at = monotonic()
+        elif state == CircuitState.CLOSED:
+            self.calls.clear()
+            self.logger.log_debug(f"The {self.name} circuit is closed again.")
+
+    def get_status(self) -> dict:
+        return {
+            "state": self.state.value,
+            "calls": len(self.calls),
+            "failed": sum(failed for _, failed, _ in self.calls),
+            "slow": sum(slow for _, _, slow in self.calls),
+            "rejected": self.rejected,
+        }
+
+
+circuit_breakers: Dict[str, CircuitBreaker] = {}
+
+
+def is_slow(duration: float, slow_call_threshold: Optional[float]) -> bool:
+    return slow_call_threshold is not None and duration > slow_call_threshold
+
+
+def circuit_breaker(
+    name: str,
+    slow_call_threshold: Optional[float] = None,
+    is_failure: Optional[Callable[[Exception], bool]] = None,
+) -> Callable[[Callable], Callable]:
+    """
+    Guards coroutines and async generators that call one upstream, all of them sharing the breaker `name`.
+    Calls longer than `slow_call_threshold` count as slow, leave it out for calls that last as long as the user talks.
+    Every exception counts as a failure unless `is_failure` says otherwise.
+    """
+
+    def decorate(func: Callable) -> Callable:
+        if inspect.isasyncgenfunction(func):
+
+            @wraps(func)
+            def guarded_stream(*args, **kwargs) -> AsyncIterator:
+                return get_circuit_breaker(name).stream(func, args, kwargs, slow_call_threshold, is_failure)
+
+            return guarded_stream
+
+        @wraps(func)
+        async def guarded(*args, **kwargs):
+            return await get_circuit_breaker(name).call(func, args, kwargs, slow_call_threshold, is_failure)
+
+        return guarded
+
+    return decorate
+
+
+def get_circuit_breaker(name: str) -> CircuitBreaker:
+    if name not in circuit_breakers:
+        circuit_breakers[name] = CircuitBreaker(
+            name,
+            failure_rate_threshold=Config.get_float("CIRCUIT_FAILURE_RATE", 0.5),
+            slow_call_rate_threshold=Config.get_float("CIRCUIT_SLOW_CALL_RATE", 0.8),
+            window=Config.get_float("CIRCUIT_WINDOW", 30.0),
+            min_calls=Config.get_int("CIRCUIT_MIN_CALLS", 10),
+            open_for=Config.get_float("CIRCUIT_OPEN_FOR", 15.0),
+            half_open_calls=Config.get_int("CIRCUIT_HALF_OPEN_CALLS", 3),
+        )
+    return circuit_breakers[name]
+
+
+def get_circuit_breakers_status() -> dict:
+    return {name: breaker.get_status() for name, breaker in circuit_breakers.items()}
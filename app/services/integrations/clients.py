@@ -0,0 +1,31 @@
+import asyncio
+
+from typing import Any, Awaitable, Callable, Dict, NamedTuple
+
+
+class SharedClient(NamedTuple):
+    loop: asyncio.AbstractEventLoop
+    client: Any
+    close: Callable[[Any], Awaitable]
+
+
+# upstream clients of this worker by name, so their connections and channels outlive a single call
+shared_clients: Dict[str, SharedClient] = {}
+
+
+def get_shared_client(name: str, create: Callable[[], Any], close: Callable[[Any], Awaitable]) -> Any:
+    # Clients are bound to the event loop they were created on. A worker has one loop, but CLI commands and tests
+    # may run several in turn.
+    loop = asyncio.get_running_loop()
+    shared = shared_clients.get(name)
+    if shared is None or shared.loop is not loop:
+        shared = shared_clients[name] = SharedClient(loop, create(), close)
+    return shared.client
+
+
+async def close_shared_clients():
+    loop = asyncio.get_running_loop()
+    for name, shared in list(shared_clients.items()):
+        del shared_clients[name]
+        if shared.loop is loop:
+            await shared.close(shared.client)
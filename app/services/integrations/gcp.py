@@ -1,56 +1,118 @@
 import anyio
+import asyncio
+import grpc
 import tempfile
+import wave
+
+from html import escape
 
-from contextlib import asynccontextmanager
 from collections.abc import AsyncIterator
 from io import BytesIO
 from uuid import uuid4
 from fastapi import WebSocket
-from google.cloud import texttospeech as gcp_tts, speech as gcp_stt
+from google.api_core import exceptions as gcp_exceptions
+from google.cloud import texttospeech as gcp_tts, texttospeech_v1beta1 as gcp_tts_beta, speech as gcp_stt
 from google.cloud.speech_v1.types import cloud_speech as stt_types, RecognitionConfig
 
 from gcloud.aio.auth import Token
 from gcloud.aio.storage import Storage as StorageClient
-from typing import Optional, Type, Awaitable
-from enum import Enum
+from typing import Dict, List, Optional, Sequence, Set, Tuple, Type
+from collections import OrderedDict
 
 from pydantic import BaseModel
 
 from google.cloud.speech_v1.services.speech import SpeechAsyncClient
 
-from app.config import Config
+from app.config import Config, get_settings
 from app.logger import log_exec_time, logger_factory
 from app.models.content import ContentLanguage
+from app.services.audio import AudioEncoding
+from app.services.deadline import Deadline, DeadlineExceeded, stage_timeout, wait_for_stage
 from app.services.exceptions import ServiceException
+from app.services.integrations.circuit_breaker import circuit_breaker
+from app.services.integrations.clients import get_shared_client
+from app.services.utils import AvailableBucket, get_bucket_name, get_url_for_ai_reply_obj
 from ..service import Service
 
 
-def get_voice_params(lang: ContentLanguage) -> gcp_tts.VoiceSelectionParams:
-    voice_name = get_voice_for_language(lang).value
+TEXT_TO_SPEECH_CIRCUIT = "gcp_text_to_speech"
+# timepoints are only in the beta API, its client is shared apart from the other one
+TEXT_TO_SPEECH_BETA_CLIENT = "gcp_text_to_speech_beta"
+# the API's limit on the input of a request, markup included
+MAX_SSML_BYTES = 5000
+SPEECH_TO_TEXT_CIRCUIT = "gcp_speech_to_text"
+STORAGE_CIRCUIT = "gcp_storage"
+GCP_TIMEOUT_ERRORS = (asyncio.TimeoutError, gcp_exceptions.DeadlineExceeded, gcp_exceptions.RetryError)
+
+
+def is_upstream_failure(exc: Exception) -> bool:
+    # Silent or unrecognisable user audio and a client that hung up mid-utterance say nothing about the upstream.
+    if isinstance(exc, gcp_exceptions.ClientError):
+        return isinstance(exc, gcp_exceptions.TooManyRequests)
+    return isinstance(exc, (gcp_exceptions.GoogleAPIError, grpc.RpcError, DeadlineExceeded, *GCP_TIMEOUT_ERRORS))
+
+
+def get_voice_params(lang: ContentLanguage, tts_types=gcp_tts) -> gcp_tts.VoiceSelectionParams:
+    voice_name = get_voice_for_language(lang)
     lang_code = "-".join(voice_name.split("-")[:2])
-    return gcp_tts.VoiceSelectionParams(language_code=lang_code, name=voice_name)
+    return tts_types.VoiceSelectionParams(language_code=lang_code, name=voice_name)
 
 
 class TextToVoice(Service):
     def __init__(
-        self, tts_client: gcp_tts.TextToSpeechAsyncClient, audio_encoding: gcp_tts.AudioEncoding, *args, **kwargs
+        self,
+        tts_client: gcp_tts.TextToSpeechAsyncClient,
+        audio_encoding: gcp_tts.AudioEncoding,
+        *args,
+        sample_rate_hertz: Optional[int] = None,
+        **kwargs,
     ):
         super().__init__(*args, **kwargs)
         self.tts_client: gcp_tts.TextToSpeechAsyncClient = tts_client
         self.audio_encoding = audio_encoding
+        self.sample_rate_hertz = sample_rate_hertz
+
+    async def warm_up(self):
+        await self.tts_client.transport.grpc_channel.channel_ready()
 
     # @log_exec_time("text_to_audio")
-    async def text_to_voice(self, lang: ContentLanguage, text: str) -> Awaitable[str]:
-        text_input = gcp_tts.SynthesisInput(text=text)
-        voice_params = get_voice_params(lang)
-        audio_config = gcp_tts.AudioConfig(audio_encoding=self.audio_encoding)
-        response = await self.tts_client.synthesize_speech(
-            input=text_input,
-            voice=voice_params,
-            audio_config=audio_config,
+    async def text_to_voice(self, lang: ContentLanguage, text: str, deadline: Optional[Deadline] = None) -> str:
+        audio_content = await self.synthesize_chunk(lang, text, deadline)
+        return await self.save_audio(audio_content)
+
+    async def save_audio(self, audio_content: bytes) -> str:
+        return await self._store_audio_to_file(audio_content, AudioEncoding[self.audio_encoding.name].value)
+
+    @circuit_breaker(TEXT_TO_SPEECH_CIRCUIT, slow_call_threshold=3.0)
+    async def synthesize_chunk(
+        self, lang: ContentLanguage, text_chunk: str, deadline: Optional[Deadline] = None
+    ) -> bytes:
+        timeout = stage_timeout(deadline, get_settings().gcp_timeout)
+        response = await wait_for_stage(
+            self.tts_client.synthesize_speech(
+                input=gcp_tts.SynthesisInput(text=text_chunk),
+                voice=get_voice_params(lang),
+                audio_config=gcp_tts.AudioConfig(
+                    audio_encoding=self.audio_encoding, sample_rate_hertz=self.sample_rate_hertz, pitch=0.0
+                ),
+                timeout=timeout,
+            ),
+            "Text to speech",
+            timeout,
+            GCP_TIMEOUT_ERRORS,
         )
-        out_ogg_path = await self._store_response_to_file(response.audio_content, "ogg")
-        return out_ogg_path
+        return response.audio_content
+
+    def get_cached_phrase(self, lang: ContentLanguage, text: str) -> Optional[bytes]:
+        return phrase_audio_cache.get(self._phrase_key(lang, text))
+
+    async def cache_phrase(self, lang: ContentLanguage, text: str) -> bytes:
+        audio_content = await self.synthesize_chunk(lang, text)
+        phrase_audio_cache.put(self._phrase_key(lang, text), audio_content)
+        return audio_content
+
+    def _phrase_key(self, lang: ContentLanguage, text: str) -> tuple:
+        return lang, text, self.audio_encoding, self.sample_rate_hertz
 
     async def _store_audio_to_file(self, audio_content: bytes, file_ext: str) -> str:
         path = f"{tempfile.gettempdir()}/{uuid4()}.{file_ext}"
@@ -60,48 +122,206 @@ class TextToVoice(Service):
 
 
 class StreamTextToVoice(TextToVoice):
+    def __init__(self, *args, sample_rate_hertz: int = 48000, **kwargs):
+        # lowered for clients that can't keep up with the reply audio
+        super().__init__(*args, sample_rate_hertz=sample_rate_hertz, **kwargs)
+
     async def text_to_voice(
         self,
         lang: ContentLanguage,
         text_stream: AsyncIterator[str],
+        deadline: Optional[Deadline] = None,
     ) -> AsyncIterator[bytes]:
-        voice_params = get_voice_params(lang)
-        audio_config = gcp_tts.AudioConfig(audio_encoding=self.audio_encoding, sample_rate_hertz=48000, pitch=0.0)
-
         async for text_chunk in text_stream:
-            print("GPT says:", text_chunk)
-            text_input = gcp_tts.SynthesisInput(text=text_chunk)
-            response = await self.tts_client.synthesize_speech(
-                input=text_input,
-                voice=voice_params,
-                audio_config=audio_config,
-            )
-            yield response.audio_content
+            self.logger.log_debug(f"AI reply chunk: {text_chunk}")
+            yield await self.synthesize_chunk(lang, text_chunk, deadline)
+
+
+class BatchTextToVoice(TextToVoice):
+    """
+    Synthesizes many short texts in one request: they are joined into SSML with a <mark> before each and the audio is
+    cut at the timepoints of the marks. Only PCM can be cut anywhere, so the audio is LINEAR16 and every text gets a
+    WAV file of its own. Concurrent text_to_voice calls are batched, up to `batch_size` texts or the ones that came
+    within `linger` seconds of the first.
+    """
+
+    def __init__(self, *args, batch_size: int, linger: float, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.batch_size = batch_size
+        self.linger = linger
+        self.pending: Dict[ContentLanguage, List[Tuple[str, asyncio.Future]]] = {}
+        self._flush_handles: Dict[ContentLanguage, asyncio.TimerHandle] = {}
+        self._batch_tasks: Set[asyncio.Task] = set()
+
+    async def text_to_voice(self, lang: ContentLanguage, text: str, deadline: Optional[Deadline] = None) -> str:
+        # the deadline of a single text doesn't apply to a batch, batching is for content generation which has none
+        future = asyncio.get_running_loop().create_future()
+        pending = self.pending.setdefault(lang, [])
+        pending.append((text, future))
+        if len(pending) >= self.batch_size:
+            self._flush(lang)
+        elif len(pending) == 1:
+            self._flush_handles[lang] = asyncio.get_running_loop().call_later(self.linger, self._flush, lang)
+        return await self.save_audio(await future)
+
+    def _flush(self, lang: ContentLanguage):
+        handle = self._flush_handles.pop(lang, None)
+        if handle is not None:
+            handle.cancel()
+        batch = self.pending.pop(lang, [])
+        if batch:
+            task = asyncio.create_task(self._synthesize_pending(lang, batch))
+            self._batch_tasks.add(task)
+            task.add_done_callback(self._batch_tasks.discard)
+
+    async def _synthesize_pending(self, lang: ContentLanguage, batch: List[Tuple[str, asyncio.Future]]):
+        try:
+            segments = await self.synthesize_batch(lang, [text for text, _ in batch])
+        except Exception as exc:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(exc)
+            return
+        for (_, future), segment in zip(batch, segments):
+            if not future.done():
+                future.set_result(segment)
+
+    async def synthesize_batch(
+        self, lang: ContentLanguage, texts: Sequence[str], deadline: Optional[Deadline] = None
+    ) -> List[bytes]:
+        requests = group_for_ssml(texts)
+        segments = await asyncio.gather(*(self.synthesize_marked(lang, request, deadline) for request in requests))
+        return [segment for request_segments in segments for segment in request_segments]
+
+    @circuit_breaker(TEXT_TO_SPEECH_CIRCUIT, slow_call_threshold=10.0)
+    async def synthesize_marked(
+        self, lang: ContentLanguage, texts: Sequence[str], deadline: Optional[Deadline] = None
+    ) -> List[bytes]:
+        timeout = stage_timeout(deadline, get_settings().gcp_timeout)
+        request = gcp_tts_beta.SynthesizeSpeechRequest(
+            input=gcp_tts_beta.SynthesisInput(ssml=to_marked_ssml(texts)),
+            voice=get_voice_params(lang, gcp_tts_beta),
+            audio_config=gcp_tts_beta.AudioConfig(
+                audio_encoding=self.audio_encoding, sample_rate_hertz=self.sample_rate_hertz, pitch=0.0
+            ),
+            enable_time_pointing=[gcp_tts_beta.SynthesizeSpeechRequest.TimepointType.SSML_MARK],
+        )
+        response = await wait_for_stage(
+            self.tts_client.synthesize_speech(request=request, timeout=timeout),
+            "Text to speech",
+            timeout,
+            GCP_TIMEOUT_ERRORS,
+        )
+        return split_at_marks(response.audio_content, response.timepoints, len(texts))
+
+
+def to_marked_ssml(texts: Sequence[str]) -> str:
+    # marks are named by the index of the text they start
+    return (
+        "<speak>" + " ".join(f'<mark name="{index}"/>{escape(text)}' for index, text in enumerate(texts)) + "</speak>"
+    )
+
+
+def group_for_ssml(texts: Sequence[str]) -> List[List[str]]:
+    groups: List[List[str]] = [[]]
+    for text in texts:
+        if groups[-1] and len(to_marked_ssml(groups[-1] + [text]).encode()) > MAX_SSML_BYTES:
+            groups.append([])
+        groups[-1].append(text)
+    return groups
+
+
+def split_at_marks(wav_content: bytes, timepoints: Sequence["gcp_tts_beta.Timepoint"], count: int) -> List[bytes]:
+    with wave.open(BytesIO(wav_content), "rb") as reader:
+        params = reader.getparams()
+        frames = reader.readframes(reader.getnframes())
+    marks = {int(timepoint.mark_name): timepoint.time_seconds for timepoint in timepoints}
+    if sorted(marks) != list(range(count)):
+        raise ServiceException(f"Text to speech returned timepoints for marks {sorted(marks)} of {count} texts.")
+    frame_size = params.sampwidth * params.nchannels
+    # the silence before the first mark is dropped, the one after a text stays with it
+    offsets = [int(marks[index] * params.framerate) * frame_size for index in range(count)] + [len(frames)]
+    return [
+        to_wav(frames[start:end], params.nchannels, params.sampwidth, params.framerate)
+        for start, end in zip(offsets, offsets[1:])
+    ]
+
 
+def to_wav(frames: bytes, channels: int, sample_width: int, sample_rate: int) -> bytes:
+    output = BytesIO()
+    with wave.open(output, "wb") as writer:
+        writer.setnchannels(channels)
+        writer.setsampwidth(sample_width)
+        writer.setframerate(sample_rate)
+        writer.writeframes(frames)
+    return output.getvalue()
 
-class AvailableVoice(Enum):
-    ENGLISH = Config.get("GCP_ENGLISH_VOICE")
-    RUSSIAN = Config.get("GCP_RUSSIAN_VOICE")
 
+class PhraseAudioCache:
+    """Synthesized audio of fixed phrases, for replies that can't wait for text to speech."""
 
-def get_voice_for_language(lang: ContentLanguage):
+    def __init__(self, max_items: int):
+        self.max_items = max_items
+        self.items: OrderedDict[tuple, bytes] = OrderedDict()
+
+    def get(self, key: tuple) -> Optional[bytes]:
+        audio_content = self.items.get(key)
+        if audio_content is not None:
+            self.items.move_to_end(key)
+        return audio_content
+
+    def put(self, key: tuple, audio_content: bytes):
+        self.items[key] = audio_content
+        self.items.move_to_end(key)
+        while len(self.items) > self.max_items:
+            self.items.popitem(last=False)
+
+
+phrase_audio_cache = PhraseAudioCache(max_items=256)
+
+
+def get_voice_for_language(lang: ContentLanguage) -> str:
+    settings = get_settings()
     return {
-        ContentLanguage.ENGLISH: AvailableVoice.ENGLISH,
-        ContentLanguage.RUSSIAN: AvailableVoice.RUSSIAN,
+        ContentLanguage.ENGLISH: settings.gcp_english_voice,
+        ContentLanguage.RUSSIAN: settings.gcp_russian_voice,
     }[lang]
 
 
 def text_to_voice_service_factory(
     tts_client: Optional[gcp_tts.TextToSpeechAsyncClient] = None,
-    audio_encoding: Optional[gcp_tts.AudioEncoding] = gcp_tts.AudioEncoding.OGG_OPUS,
+    audio_encoding: AudioEncoding = AudioEncoding.OGG_OPUS,
     stream: Optional[bool] = False,
+    sample_rate_hertz: Optional[int] = None,
 ) -> TextToVoice:
     if tts_client is None:
-        tts_client = gcp_tts.TextToSpeechAsyncClient()
+        tts_client = get_shared_client(TEXT_TO_SPEECH_CIRCUIT, gcp_tts.TextToSpeechAsyncClient, close_grpc_client)
     logger = logger_factory("GCP TextToSpeech")
+    gcp_audio_encoding = gcp_tts.AudioEncoding[audio_encoding.name]
+    # None keeps the default of the service, the voice's own rate or 48 kHz for streams
+    rate = {} if sample_rate_hertz is None else {"sample_rate_hertz": sample_rate_hertz}
     if stream:
-        return StreamTextToVoice(tts_client, audio_encoding, logger)
-    return TextToVoice(tts_client, audio_encoding, logger)
+        return StreamTextToVoice(tts_client, gcp_audio_encoding, logger, **rate)
+    return TextToVoice(tts_client, gcp_audio_encoding, logger, **rate)
+
+
+def batch_text_to_voice_service_factory(
+    tts_client: Optional[gcp_tts_beta.TextToSpeechAsyncClient] = None,
+    batch_size: Optional[int] = None,
+    sample_rate_hertz: Optional[int] = None,
+) -> BatchTextToVoice:
+    if tts_client is None:
+        tts_client = get_shared_client(
+            TEXT_TO_SPEECH_BETA_CLIENT, gcp_tts_beta.TextToSpeechAsyncClient, close_grpc_client
+        )
+    return BatchTextToVoice(
+        tts_client,
+        gcp_tts_beta.AudioEncoding.LINEAR16,
+        logger_factory("GCP TextToSpeech"),
+        sample_rate_hertz=sample_rate_hertz,
+        batch_size=batch_size or Config.get_int("TTS_BATCH_SIZE", 20),
+        linger=Config.get_float("TTS_BATCH_LINGER", 0.2),
+    )
 
 
 class VTTResp(BaseModel):
@@ -114,13 +334,22 @@ class VoiceToText(Service):
         super().__init__(*args, **kwargs)
         self.client: gcp_stt.SpeechAsyncClient = client
 
-    async def ogg_to_text(self, lang: ContentLanguage, source_audio_content: BytesIO) -> VTTResp:
+    async def warm_up(self):
+        await self.client.transport.grpc_channel.channel_ready()
+
+    @circuit_breaker(SPEECH_TO_TEXT_CIRCUIT, slow_call_threshold=5.0, is_failure=is_upstream_failure)
+    async def ogg_to_text(
+        self, lang: ContentLanguage, source_audio_content: BytesIO, deadline: Optional[Deadline] = None
+    ) -> VTTResp:
         config = self.get_config(lang, RecognitionConfig.AudioEncoding.OGG_OPUS)
         req = gcp_stt.RecognizeRequest(
             audio=gcp_stt.RecognitionAudio(content=source_audio_content),
             config=config,
         )
-        resp = await self.client.recognize(req)
+        timeout = stage_timeout(deadline, get_settings().gcp_timeout)
+        resp = await wait_for_stage(
+            self.client.recognize(req, timeout=timeout), "Speech to text", timeout, GCP_TIMEOUT_ERRORS
+        )
         self.validate_response(resp)
 
         best_alternative = resp.results[0].alternatives[0]
@@ -129,8 +358,10 @@ class VoiceToText(Service):
             confidence=best_alternative.confidence,
         )
 
-    async def voice_to_text(self, lang: ContentLanguage, source_audio_content: BytesIO) -> VTTResp:
-        return await self.ogg_to_text(lang, source_audio_content)
+    async def voice_to_text(
+        self, lang: ContentLanguage, source_audio_content: BytesIO, deadline: Optional[Deadline] = None
+    ) -> VTTResp:
+        return await self.ogg_to_text(lang, source_audio_content, deadline)
 
     def get_config(self, lang: ContentLanguage, encoding: RecognitionConfig.AudioEncoding) -> gcp_stt.RecognitionConfig:
         return gcp_stt.RecognitionConfig(
@@ -156,18 +387,28 @@ def content_lang_to_gcp_lang_code(lang: ContentLanguage) -> str:
 
 
 class VoiceToTextStream(VoiceToText):
+    @circuit_breaker(SPEECH_TO_TEXT_CIRCUIT, is_failure=is_upstream_failure)
     async def voice_to_text(
         self,
         lang: ContentLanguage,
         stream: AsyncIterator[bytes],
         encoding: Optional[RecognitionConfig.AudioEncoding] = RecognitionConfig.AudioEncoding.WEBM_OPUS,
+        deadline: Optional[Deadline] = None,
     ) -> VTTResp:
         stream = await self.client.streaming_recognize(
             requests=self._request_generator_for_stream(stream, config=self.get_config(lang, encoding))
         )
         final_transcription = ""
         average_confidence = [0.0, 1]
-        async for resp in stream:
+        while True:
+            # unbounded while the user talks, a stopped deadline only starts once the input stream ends
+            try:
+                if deadline is None:
+                    resp = await anext(stream)
+                else:
+                    resp = await deadline.wait(anext(stream), "Speech to text", GCP_TIMEOUT_ERRORS)
+            except StopAsyncIteration:
+                break
             for interm_result in resp.results:
                 best_alternative = interm_result.alternatives[0]
                 final_transcription += best_alternative.transcript
@@ -209,16 +450,15 @@ def voice_to_text_service_factory(
     stream: Optional[bool] = False,
 ) -> VoiceToText:
     if stt_client is None:
-        stt_client = gcp_stt.SpeechAsyncClient()
+        stt_client = get_shared_client(SPEECH_TO_TEXT_CIRCUIT, gcp_stt.SpeechAsyncClient, close_grpc_client)
     logger = logger_factory("GCP VoiceToText")
     if stream:
         return VoiceToTextStream(client=stt_client, logger=logger)
     return VoiceToText(stt_client, logger)
 
 
-class AvailableBucket(Enum):
-    PUBLIC_CONTENT = Config.get("GCP_PUBLIC_CONTENT_BUCKET")
-    AI_REPLIES = Config.get("GCP_AI_REPLIES_BUCKET")
+async def close_grpc_client(client):
+    await client.transport.close()
 
 
 class Upload(Service):
@@ -229,39 +469,47 @@ class Upload(Service):
         self.token_class = token_class
         self.client_class = client_class
 
-    @asynccontextmanager
-    async def _new_session(self):
-        token = self.token_class(service_file=Config.get("GOOGLE_APPLICATION_CREDENTIALS"), scopes=self.SCOPES)
-        client = self.client_class(token=token)
-        try:
-            yield client
-        finally:
-            await client.close()
-            await token.close()
+    async def warm_up(self):
+        await self._get_client().token.get()
+
+    def _get_client(self) -> StorageClient:
+        # shared, so the access token is fetched once per hour rather than once per upload
+        return get_shared_client(STORAGE_CIRCUIT, self._create_client, close_storage_client)
+
+    def _create_client(self) -> StorageClient:
+        token = self.token_class(service_file=get_settings().gcp_credentials_file, scopes=self.SCOPES)
+        return self.client_class(token=token)
 
     async def upload_public_content(self, source_path: str, dest_path: str) -> str:
         return await self._upload_obj(source_path, AvailableBucket.PUBLIC_CONTENT, dest_path)
 
-    async def upload_ai_reply(self, source_path: str, dest_path: str) -> str:
-        return await self._upload_obj(source_path, AvailableBucket.AI_REPLIES, dest_path)
+    async def upload_ai_reply(self, source_path: str, dest_path: str, deadline: Optional[Deadline] = None) -> str:
+        return await self._upload_obj(source_path, AvailableBucket.AI_REPLIES, dest_path, deadline)
 
     # @log_exec_time("upload_content_for_public_access")
-    async def _upload_obj(self, source_path: str, bucket: AvailableBucket, dest_path: str):
-        async with self._new_session() as client:
-            resp: dict = await client.upload_from_filename(bucket.value, dest_path, source_path)
-            await client.close()
-            return resp["name"]
+    @circuit_breaker(STORAGE_CIRCUIT, slow_call_threshold=10.0)
+    async def _upload_obj(
+        self, source_path: str, bucket: AvailableBucket, dest_path: str, deadline: Optional[Deadline] = None
+    ):
+        timeout = stage_timeout(deadline, get_settings().gcp_upload_timeout)
+        resp: dict = await wait_for_stage(
+            self._get_client().upload_from_filename(get_bucket_name(bucket), dest_path, source_path, timeout=timeout),
+            "Upload",
+            timeout,
+        )
+        return resp["name"]
 
 
 class UploadStream(Upload):
     async def upload_public_content(self, source_path: str, dest_path: str) -> str:
         raise NotImplementedError()
 
+    @circuit_breaker(STORAGE_CIRCUIT)
     async def upload_ai_reply(self, source_stream: AsyncIterator[bytes], dest_path: str) -> str:
-        async with self._new_session() as client:
-            async for reply_audio_chunk in source_stream:
-                await self._stream_obj(client, reply_audio_chunk, AvailableBucket.AI_REPLIES, dest_path)
-            return get_url_for_ai_reply_obj(dest_path)
+        client = self._get_client()
+        async for reply_audio_chunk in source_stream:
+            await self._stream_obj(client, reply_audio_chunk, AvailableBucket.AI_REPLIES, dest_path)
+        return get_url_for_ai_reply_obj(dest_path)
 
     async def _stream_obj(
         self,
@@ -271,7 +519,7 @@ class UploadStream(Upload):
         dest_path: str,
     ) -> dict:
         return await client.upload(
-            bucket=bucket.value,
+            bucket=get_bucket_name(bucket),
             object_name=dest_path,
             file_data=data,
             content_type="audio/ogg",
@@ -279,6 +527,11 @@ class UploadStream(Upload):
         )
 
 
+async def close_storage_client(client: StorageClient):
+    await client.close()
+    await client.token.close()
+
+
 def upload_service_factory(
     token_class: Optional[Type[Token]] = None,
     client_class: Optional[Type[StorageClient]] = None,
@@ -290,15 +543,3 @@ def upload_service_factory(
     if stream:
         return UploadStream(token_class, client_class, logger=logger)
     return Upload(token_class, client_class, logger=logger)
-
-
-def get_url_for_storage_object(bucket: AvailableBucket, obj_name: str) -> str:
-    return f"https://storage.googleapis.com/{bucket.value}/{obj_name}"
-
-
-def get_url_for_public_content_obj(obj_name: str) -> str:
-    return get_url_for_storage_object(AvailableBucket.PUBLIC_CONTENT, obj_name)
-
-
-def get_url_for_ai_reply_obj(obj_name: str) -> str:
-    return get_url_for_storage_object(AvailableBucket.AI_REPLIES, obj_name)
@@ -1,24 +1,49 @@
 import aiohttp
+import asyncio
 import ssl
 from pydantic import BaseModel
 import ujson
 import certifi
 
 from abc import ABC
+from contextlib import aclosing
 from enum import Enum
-from functools import wraps
+from functools import lru_cache, wraps
 from collections.abc import AsyncIterator
 
 from typing import Awaitable, Optional
-from app.config import Config
+from app.config import Config, get_settings
 from app.logger import Logger, logger_factory, log_exec_time
 from app.models.content import ContentLanguage, ContentType
+from app.services.deadline import Deadline, DeadlineExceeded, stage_timeout
 from app.services.exceptions import ServiceException
+from app.services.integrations.circuit_breaker import circuit_breaker
+from app.services.integrations.clients import get_shared_client
 from app.services.service import Service
 
-ssl_context = ssl.create_default_context(cafile=certifi.where())
 MAX_TOKENS_PER_REQ = 1000
+OPENAI_CIRCUIT = "openai"
+# streamed replies count as slow by their first sentence
+SLOW_CALL_THRESHOLD = 10.0
 STREAM_END_MESSAGE = "[DONE]"
+MODELS_PATH = "/models"
+
+
+@lru_cache
+def get_ssl_context() -> ssl.SSLContext:
+    # loading the CA bundle takes a while, only the first request should pay for it
+    return ssl.create_default_context(cafile=certifi.where())
+
+
+def get_http_session() -> aiohttp.ClientSession:
+    # one connection pool per worker, calls reuse open connections instead of a TLS handshake each
+    return get_shared_client(
+        "openai_http",
+        lambda: aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=Config.get_int("OPENAI_MAX_CONNECTIONS", 100), ssl=get_ssl_context())
+        ),
+        lambda session: session.close(),
+    )
 
 
 class RequestData(BaseModel):
@@ -27,10 +52,13 @@ class RequestData(BaseModel):
 
 
 class RequestMaker(ABC):
-    def __init__(self, auth_token: str, logger: Logger):
+    PATH: str
+
+    def __init__(self, auth_token: str, logger: Logger, base_url: Optional[str] = None):
         self.model: str = self.get_model()
         self.auth_token = auth_token
         self.logger = logger
+        self.base_url = base_url or get_settings().openai_base_url
 
     def get_model(self):
         raise NotImplementedError()
@@ -41,6 +69,26 @@ class RequestMaker(ABC):
             "Authorization": f"Bearer {self.auth_token}",
         }
 
+    async def _check_response(self, resp: aiohttp.ClientResponse):
+        # error bodies have no "choices" and would only surface as KeyErrors further down
+        if resp.status >= 400:
+            raise ServiceException(f"OpenAI responded with {resp.status}: {await resp.text()}", self.logger)
+
+    def _post(self, json_data: dict, deadline: Optional[Deadline] = None):
+        # the total timeout covers the whole response, streamed ones included
+        timeout = aiohttp.ClientTimeout(
+            total=stage_timeout(deadline, get_settings().openai_timeout),
+            sock_connect=get_settings().openai_connect_timeout,
+        )
+        return get_http_session().post(
+            self.base_url + self.PATH, json=json_data, headers=self._get_request_headers(), timeout=timeout
+        )
+
+    async def warm_up(self):
+        # opens a pooled connection, and fails early on a wrong API key
+        async with get_http_session().get(self.base_url + MODELS_PATH, headers=self._get_request_headers()) as resp:
+            await self._check_response(resp)
+
     async def generate_content(
         self,
         content_type: ContentType,
@@ -51,37 +99,66 @@ class RequestMaker(ABC):
         )
         return content
 
-    def make_request(self, data: RequestData) -> str:
+    # The public calls are guarded, request and streaming_request are not. A wrapping request maker calls the
+    # unguarded ones of the request it wraps, so a logical call is one outcome of the circuit.
+    @circuit_breaker(OPENAI_CIRCUIT, SLOW_CALL_THRESHOLD)
+    async def make_request(self, data: RequestData, deadline: Optional[Deadline] = None) -> str:
+        return await self.request(data, deadline)
+
+    @circuit_breaker(OPENAI_CIRCUIT, SLOW_CALL_THRESHOLD)
+    async def make_streaming_request(
+        self, data: RequestData, deadline: Optional[Deadline] = None
+    ) -> AsyncIterator[str]:
+        async with aclosing(self.streaming_request(data, deadline)) as sentences:
+            async for sentence in sentences:
+                yield sentence
+
+    async def request(self, data: RequestData, deadline: Optional[Deadline] = None) -> str:
+        raise NotImplementedError()
+
+    def streaming_request(self, data: RequestData, deadline: Optional[Deadline] = None) -> AsyncIterator[str]:
         raise NotImplementedError()
 
-    def make_streaming_request(self, data: RequestData) -> AsyncIterator[str]:
+    def get_text_from_streaming_chunk(self, text_chunk: bytes) -> Optional[str]:
         raise NotImplementedError()
 
+    async def assemble_sentences(self, text_chunks: AsyncIterator[bytes]) -> AsyncIterator[str]:
+        # The reply is spoken sentence by sentence. Sentence ends come as tokens of their own, which start the next
+        # sentence.
+        chunk_to_yield = ""
+        async for text_chunk in text_chunks:
+            text = self.get_text_from_streaming_chunk(text_chunk)
+            if text:
+                chunk_to_yield += text
+            if text and text.startswith((".", "?", "!")):
+                yield chunk_to_yield
+                chunk_to_yield = ""
+        if chunk_to_yield:
+            yield chunk_to_yield
+
 
 class CompletionRequest(RequestMaker):
-    URL = "https://api.openai.com/v1/completions"
+    PATH = "/completions"
 
-    async def make_request(self, data: RequestData) -> str:
+    async def request(self, data: RequestData, deadline: Optional[Deadline] = None) -> str:
         json_data = self._get_json_config(data, stream=False)
-        async with aiohttp.ClientSession(headers=self._get_request_headers()) as session:
-            async with session.post(self.URL, json=json_data, ssl_context=ssl_context) as resp:
+        try:
+            async with self._post(json_data, deadline) as resp:
+                await self._check_response(resp)
                 resp_json = await resp.json()
                 return resp_json["choices"][0]["text"].strip("\n")
+        except asyncio.TimeoutError:
+            raise DeadlineExceeded("OpenAI completion")
 
-    async def make_streaming_request(self, data: RequestData) -> AsyncIterator[str]:
+    async def streaming_request(self, data: RequestData, deadline: Optional[Deadline] = None) -> AsyncIterator[str]:
         json_data = self._get_json_config(data, stream=True)
-        async with aiohttp.ClientSession(headers=self._get_request_headers()) as session:
-            async with session.post(self.URL, json=json_data, ssl_context=ssl_context) as resp:
-                chunk_to_yield = ""
-                async for text_chunk, _ in resp.content.iter_chunks():
-                    text = self.get_text_from_streaming_chunk(text_chunk)
-                    if text:
-                        chunk_to_yield += text
-                    if text and text.startswith((".", "?", "!")):
-                        yield chunk_to_yield
-                        chunk_to_yield = ""
-                if chunk_to_yield:
-                    yield chunk_to_yield
+        try:
+            async with self._post(json_data, deadline) as resp:
+                await self._check_response(resp)
+                async for sentence in self.assemble_sentences(chunk async for chunk, _ in resp.content.iter_chunks()):
+                    yield sentence
+        except asyncio.TimeoutError:
+            raise DeadlineExceeded("OpenAI completion")
 
     def _get_json_config(self, data: RequestData, stream: bool) -> dict:
         return {
@@ -94,7 +171,7 @@ class CompletionRequest(RequestMaker):
         }
 
     def get_model(self) -> str:
-        return Config.get("OPENAI_COMPLETIONS_MODEL")
+        return get_settings().openai_completions_model
 
     def get_text_from_streaming_chunk(self, text_chunk: bytes) -> Optional[str]:
         # text_chunk would be like:
@@ -127,32 +204,30 @@ class CompletionRequest(RequestMaker):
 
 
 class ChatRequest(RequestMaker):
-    URL = "https://api.openai.com/v1/chat/completions"
+    PATH = "/chat/completions"
 
     def get_model(self) -> str:
-        return Config.get("OPENAI_CHAT_MODEL")
+        return get_settings().openai_chat_model
 
-    async def make_request(self, data: RequestData) -> str:
+    async def request(self, data: RequestData, deadline: Optional[Deadline] = None) -> str:
         json_data = self._get_json_config(data, stream=False)
-        async with aiohttp.ClientSession(headers=self._get_request_headers()) as session:
-            async with session.post(self.URL, json=json_data, ssl_context=ssl_context) as resp:
+        try:
+            async with self._post(json_data, deadline) as resp:
+                await self._check_response(resp)
                 resp_json = await resp.json()
                 return resp_json["choices"][0]["message"]["content"].strip("\n")
+        except asyncio.TimeoutError:
+            raise DeadlineExceeded("OpenAI chat completion")
 
-    async def make_streaming_request(self, data: RequestData) -> AsyncIterator[str]:
+    async def streaming_request(self, data: RequestData, deadline: Optional[Deadline] = None) -> AsyncIterator[str]:
         json_data = self._get_json_config(data, stream=True)
-        async with aiohttp.ClientSession(headers=self._get_request_headers()) as session:
-            async with session.post(self.URL, json=json_data, ssl_context=ssl_context) as resp:
-                chunk_to_yield = ""
-                async for text_chunk, _ in resp.content.iter_chunks():
-                    text = self.get_text_from_streaming_chunk(text_chunk)
-                    if text:
-                        chunk_to_yield += text
-                    if text and text.startswith((".", "?", "!")):
-                        yield chunk_to_yield
-                        chunk_to_yield = ""
-                if chunk_to_yield:
-                    yield chunk_to_yield
+        try:
+            async with self._post(json_data, deadline) as resp:
+                await self._check_response(resp)
+                async for sentence in self.assemble_sentences(chunk async for chunk, _ in resp.content.iter_chunks()):
+                    yield sentence
+        except asyncio.TimeoutError:
+            raise DeadlineExceeded("OpenAI chat completion")
 
     def _get_json_config(self, data: RequestData, stream: bool) -> dict:
         return {
@@ -194,7 +269,7 @@ class ChatRequest(RequestMaker):
 
 
 class ModerationRequest(RequestMaker):
-    URL = "https://api.openai.com/v1/moderations"
+    PATH = "/moderations"
     MODERATION_FAILED_RESPONSE = "The request is inappropriate. Please try again."
 
     def __init__(self, actual_req: RequestMaker, *args, **kwargs):
@@ -204,26 +279,31 @@ class ModerationRequest(RequestMaker):
     def get_model(self):
         return self.actual_req.get_model()
 
-    async def make_request(self, data: RequestData) -> str:
-        moderation_failed = await self.make_moderation_request(data.prompt)
+    async def request(self, data: RequestData, deadline: Optional[Deadline] = None) -> str:
+        moderation_failed = await self.make_moderation_request(data.prompt, deadline)
         if moderation_failed:
             return self.MODERATION_FAILED_RESPONSE
-        return await self.actual_req.make_request(data)
+        return await self.actual_req.request(data, deadline)
 
-    async def make_streaming_request(self, data: RequestData) -> AsyncIterator[str]:
-        moderation_failed = await self.make_moderation_request(data.prompt)
+    async def streaming_request(self, data: RequestData, deadline: Optional[Deadline] = None) -> AsyncIterator[str]:
+        moderation_failed = await self.make_moderation_request(data.prompt, deadline)
         if moderation_failed:
             yield self.MODERATION_FAILED_RESPONSE
-            raise StopAsyncIteration()
-        async for chunk in self.actual_req.make_streaming_request(data):
-            yield chunk
+            return
+        async with aclosing(self.actual_req.streaming_request(data, deadline)) as chunks:
+            async for chunk in chunks:
+                yield chunk
 
     @log_exec_time("moderation_request")
-    async def make_moderation_request(self, prompt: str) -> bool:  # True for inappropriate
-        headers = self._get_request_headers()
-        async with aiohttp.ClientSession(headers=headers) as session:
-            async with session.post(self.URL, json={"input": prompt}, ssl_context=ssl_context) as resp:
+    async def make_moderation_request(
+        self, prompt: str, deadline: Optional[Deadline] = None
+    ) -> bool:  # True for inappropriate
+        try:
+            async with self._post({"input": prompt}, deadline) as resp:
+                await self._check_response(resp)
                 resp_json = await resp.json()
+        except asyncio.TimeoutError:
+            raise DeadlineExceeded("OpenAI moderation")
         moderation_failed = resp_json["results"][0]["flagged"]
         return moderation_failed
 
@@ -233,19 +313,29 @@ class AI(Service):
         super().__init__(*args, **kwargs)
         self.request_maker = req_maker
 
-    def reply(self, reply_to: str) -> str:
-        return self.request_maker.make_request(RequestData(prompt=reply_to))
+    async def warm_up(self):
+        await self.request_maker.warm_up()
+
+    async def generate_content(self, content_type: ContentType, lang: ContentLanguage = ContentLanguage.ENGLISH) -> str:
+        return await self.request_maker.generate_content(content_type, lang)
+
+    async def reply(self, reply_to: str, deadline: Optional[Deadline] = None, max_tokens: Optional[int] = None) -> str:
+        data = RequestData(prompt=reply_to, max_tokens=max_tokens or MAX_TOKENS_PER_REQ)
+        return await self.request_maker.make_request(data, deadline)
 
-    def reply_stream(self, reply_to: str) -> AsyncIterator[str]:
-        return self.request_maker.make_streaming_request(RequestData(prompt=reply_to))
+    def reply_stream(
+        self, reply_to: str, deadline: Optional[Deadline] = None, max_tokens: Optional[int] = None
+    ) -> AsyncIterator[str]:
+        data = RequestData(prompt=reply_to, max_tokens=max_tokens or MAX_TOKENS_PER_REQ)
+        return self.request_maker.make_streaming_request(data, deadline)
 
 
-def openai_service_factory(pre_moderate: Optional[bool] = True) -> AI:
+def openai_service_factory(pre_moderate: Optional[bool] = True, base_url: Optional[str] = None) -> AI:
     logger = logger_factory("OpenAI")
-    auth_token = Config.get("OPENAI_API_KEY")
-    req_maker = CompletionRequest(auth_token=auth_token, logger=logger)
+    auth_token = get_settings().openai_api_key
+    req_maker = CompletionRequest(auth_token=auth_token, logger=logger, base_url=base_url)
     if pre_moderate:
-        req_maker = ModerationRequest(req_maker, auth_token=auth_token, logger=logger)
+        req_maker = ModerationRequest(req_maker, auth_token=auth_token, logger=logger, base_url=base_url)
 
     return AI(req_maker=req_maker, logger=logger)
 
@@ -0,0 +1,337 @@
+import anyio
+import asyncio
+import html
+import random
+import re
+import ujson
+
+from aiohttp import web
+from functools import lru_cache
+from time import time
+from typing import AsyncIterator, Callable, Dict, List, NamedTuple, Optional, Tuple
+
+from google.cloud import texttospeech as gcp_tts, texttospeech_v1beta1 as gcp_tts_beta, speech as gcp_stt
+
+from app.config import Config
+from app.services.audio import AudioEncoding
+from app.services.exceptions import ServiceException
+from app.services.integrations import gcp, openai as oai
+
+STUB_REPLY = (
+    "That is a great question! Cats sleep for most of the day, up to sixteen hours. "
+    "They save their energy for hunting at dawn and dusk. Would you like to hear another fact?"
+)
+STUB_TRANSCRIPT = "How long do cats sleep?"
+STUB_SPOKEN_CHARS_PER_SECOND = 15
+
+
+class LatencyModel(NamedTuple):
+    base: float
+    per_unit: float = 0.0
+    jitter: float = 0.0
+
+    def delay(self, units: int = 0) -> float:
+        return max(0.0, self.base + self.per_unit * units + random.uniform(-self.jitter, self.jitter))
+
+
+def tokenize(text: str) -> List[str]:
+    # close enough to the OpenAI tokenizer for the reply assembly: words with their leading space, punctuation apart
+    return re.findall(r"\s*\w+|[^\w\s]", text)
+
+
+class StubOpenAIServer:
+    """
+    Answers like the OpenAI API on a local port: completions and chat completions, streamed as server-sent events or
+    not, moderations and models. Streamed tokens are written one event at a time, `first_token` after the request and
+    `token_interval` apart.
+    """
+
+    def __init__(self, first_token: LatencyModel, token_interval: LatencyModel, reply: str = STUB_REPLY):
+        self.first_token = first_token
+        self.token_interval = token_interval
+        self.reply = reply
+        self.url: Optional[str] = None
+        self._runner: Optional[web.AppRunner] = None
+
+    def build_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post("/v1/completions", self.completions)
+        app.router.add_post("/v1/chat/completions", self.chat_completions)
+        app.router.add_post("/v1/moderations", self.moderations)
+        app.router.add_get("/v1/models", self.models)
+        return app
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> str:
+        self._runner = web.AppRunner(self.build_app(), access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, port).start()
+        # port 0 picks a free one
+        bound_host, bound_port = self._runner.addresses[0][:2]
+        self.url = f"http://{bound_host}:{bound_port}/v1"
+        return self.url
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner, self.url = None, None
+
+    async def completions(self, request: web.Request) -> web.StreamResponse:
+        return await self._reply(request, completion_chunk, completion_reply)
+
+    async def chat_completions(self, request: web.Request) -> web.StreamResponse:
+        return await self._reply(request, chat_chunk, chat_reply)
+
+    async def moderations(self, request: web.Request) -> web.Response:
+        await asyncio.sleep(self.first_token.delay())
+        return web.json_response({"results": [{"flagged": False}]}, dumps=ujson.dumps)
+
+    async def models(self, request: web.Request) -> web.Response:
+        return web.json_response({"data": [{"id": "stub", "object": "model"}]}, dumps=ujson.dumps)
+
+    async def _reply(self, request: web.Request, to_chunk: Callable, to_reply: Callable) -> web.StreamResponse:
+        body = await request.json(loads=ujson.loads)
+        tokens = tokenize(self.reply)[: body.get("max_tokens") or None]
+        await asyncio.sleep(self.first_token.delay())
+        if not body.get("stream"):
+            await asyncio.sleep(sum(self.token_interval.delay() for _ in tokens))
+            return web.json_response(to_reply("".join(tokens)), dumps=ujson.dumps)
+
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+        for index, token in enumerate(tokens):
+            if index:
+                await asyncio.sleep(self.token_interval.delay())
+            await response.write(sse_event(to_chunk(token, None)))
+        await response.write(sse_event(to_chunk("", "stop")))
+        await response.write(b"data: [DONE]\n\n")
+        await response.write_eof()
+        return response
+
+
+def sse_event(data: dict) -> bytes:
+    return b"data: " + ujson.dumps(data).encode() + b"\n\n"
+
+
+def completion_reply(text: str) -> dict:
+    return {"choices": [{"text": text, "index": 0, "finish_reason": "stop"}]}
+
+
+def chat_reply(text: str) -> dict:
+    return {"choices": [{"message": {"role": "assistant", "content": text}, "index": 0, "finish_reason": "stop"}]}
+
+
+def completion_chunk(token: str, finish_reason: Optional[str]) -> dict:
+    return {
+        "id": "cmpl-stub",
+        "object": "text_completion",
+        "created": int(time()),
+        "choices": [{"text": token, "index": 0, "logprobs": None, "finish_reason": finish_reason}],
+        "model": "stub",
+    }
+
+
+def chat_chunk(token: str, finish_reason: Optional[str]) -> dict:
+    return {
+        "id": "chatcmpl-stub",
+        "object": "chat.completion.chunk",
+        "created": int(time()),
+        "model": "stub",
+        "choices": [{"delta": {"content": token} if token else {}, "index": 0, "finish_reason": finish_reason}],
+    }
+
+
+class StubTransport:
+    """The parts of a gRPC transport the services use to warm up and close their clients."""
+
+    def __init__(self):
+        self.grpc_channel = self
+
+    async def channel_ready(self):
+        pass
+
+    async def close(self):
+        pass
+
+
+class StubTextToSpeechClient:
+    """
+    Stands in for TextToSpeechAsyncClient of both API versions, the audio is silence of about the length the text would
+    be spoken. Marks of SSML input get timepoints when asked for, like the beta API gives them.
+    """
+
+    def __init__(self, latency: LatencyModel):
+        self.latency = latency
+        self.transport = StubTransport()
+
+    async def synthesize_speech(
+        self,
+        request: Optional[gcp_tts_beta.SynthesizeSpeechRequest] = None,
+        *,
+        input: Optional[gcp_tts.SynthesisInput] = None,
+        voice: Optional[gcp_tts.VoiceSelectionParams] = None,
+        audio_config: Optional[gcp_tts.AudioConfig] = None,
+        timeout: Optional[float] = None,
+    ) -> gcp_tts.SynthesizeSpeechResponse:
+        if request is not None:
+            input, audio_config = request.input, request.audio_config
+        text = input.text or spoken_text(input.ssml)
+        await asyncio.sleep(self.latency.delay(len(text)))
+        audio_content = stub_audio(text, audio_config)
+        if request is None or not request.enable_time_pointing:
+            return gcp_tts.SynthesizeSpeechResponse(audio_content=audio_content)
+        return gcp_tts_beta.SynthesizeSpeechResponse(
+            audio_content=audio_content, timepoints=stub_timepoints(input.ssml)
+        )
+
+
+def spoken_text(ssml: str) -> str:
+    return html.unescape(re.sub(r"<[^>]*>", "", ssml))
+
+
+def stub_timepoints(ssml: str) -> List[gcp_tts_beta.Timepoint]:
+    return [
+        gcp_tts_beta.Timepoint(
+            mark_name=mark.group(1), time_seconds=len(spoken_text(ssml[: mark.start()])) / STUB_SPOKEN_CHARS_PER_SECOND
+        )
+        for mark in re.finditer(r'<mark name="([^"]*)"/>', ssml)
+    ]
+
+
+def stub_audio(text: str, audio_config: gcp_tts.AudioConfig) -> bytes:
+    # roughly what the real service returns: fixed rate MP3, Opus and PCM that grow with the sample rate
+    sample_rate_hertz = audio_config.sample_rate_hertz or 24000
+    encoding = AudioEncoding[audio_config.audio_encoding.name]
+    bits_per_second = {
+        AudioEncoding.MP3: 32000,
+        AudioEncoding.OGG_OPUS: sample_rate_hertz * 2 // 3,
+        AudioEncoding.LINEAR16: sample_rate_hertz * 16,
+    }[encoding]
+    audio_size = int(len(text) / STUB_SPOKEN_CHARS_PER_SECOND * bits_per_second / 8)
+    if encoding == AudioEncoding.LINEAR16:
+        # with a WAV header, like the real one
+        return gcp.to_wav(bytes(audio_size - audio_size % 2), 1, 2, sample_rate_hertz)
+    return bytes(audio_size)
+
+
+class StubSpeechClient:
+    """Stands in for SpeechAsyncClient, every recognition gives the same transcript. Latency is per KB of audio."""
+
+    def __init__(self, latency: LatencyModel, transcript: str = STUB_TRANSCRIPT):
+        self.latency = latency
+        self.transcript = transcript
+        self.transport = StubTransport()
+
+    async def recognize(self, request: gcp_stt.RecognizeRequest, timeout: Optional[float] = None):
+        await asyncio.sleep(self.latency.delay(len(request.audio.content) // 1024))
+        return gcp_stt.RecognizeResponse(results=[gcp_stt.SpeechRecognitionResult(alternatives=[self._alternative()])])
+
+    async def streaming_recognize(self, requests: AsyncIterator, timeout: Optional[float] = None) -> AsyncIterator:
+        return self._recognize_stream(requests)
+
+    async def _recognize_stream(self, requests: AsyncIterator) -> AsyncIterator[gcp_stt.StreamingRecognizeResponse]:
+        # like the real one with interim results off: a single final result once the audio ends
+        audio_size = 0
+        async for request in requests:
+            audio_size += len(request.audio_content)
+        await asyncio.sleep(self.latency.delay(audio_size // 1024))
+        result = gcp_stt.StreamingRecognitionResult(alternatives=[self._alternative()], is_final=True)
+        yield gcp_stt.StreamingRecognizeResponse(results=[result])
+
+    def _alternative(self) -> gcp_stt.SpeechRecognitionAlternative:
+        return gcp_stt.SpeechRecognitionAlternative(transcript=self.transcript, confidence=0.92)
+
+
+class StubToken:
+    def __init__(self, *args, **kwargs):
+        pass
+
+    async def get(self) -> str:
+        return "stub-token"
+
+    async def close(self):
+        pass
+
+
+class StubStorage:
+    """Stands in for the gcloud-aio Storage client. Objects are kept in memory, latency is per KB uploaded."""
+
+    # shared by every client, like the buckets are
+    objects: Dict[Tuple[str, str], bytes] = {}
+
+    def __init__(self, token: Optional[StubToken] = None, latency: Optional[LatencyModel] = None):
+        self.token = token or StubToken()
+        self.latency = latency or storage_latency()
+
+    async def upload(
+        self,
+        bucket: str,
+        object_name: str,
+        file_data: bytes,
+        content_type: Optional[str] = None,
+        timeout: Optional[float] = None,
+        **kwargs,
+    ) -> dict:
+        await asyncio.sleep(self.latency.delay(len(file_data) // 1024))
+        self.objects[(bucket, object_name)] = bytes(file_data)
+        return {"name": object_name, "bucket": bucket, "size": str(len(file_data)), "contentType": content_type}
+
+    async def upload_from_filename(self, bucket: str, object_name: str, filename: str, **kwargs) -> dict:
+        async with await anyio.open_file(filename, "rb") as f:
+            file_data = await f.read()
+        return await self.upload(bucket, object_name, file_data, **kwargs)
+
+    async def download(self, bucket: str, object_name: str, **kwargs) -> bytes:
+        return self.objects[(bucket, object_name)]
+
+    async def close(self):
+        pass
+
+
+def storage_latency() -> LatencyModel:
+    return LatencyModel(
+        Config.get_float("STUB_STORAGE_LATENCY", 0.05), Config.get_float("STUB_STORAGE_LATENCY_PER_KB", 0.0005)
+    )
+
+
+@lru_cache
+def get_stub_openai_server() -> StubOpenAIServer:
+    return StubOpenAIServer(
+        first_token=LatencyModel(Config.get_float("STUB_OPENAI_FIRST_TOKEN_LATENCY", 0.4), jitter=0.1),
+        token_interval=LatencyModel(Config.get_float("STUB_OPENAI_TOKEN_INTERVAL", 0.03), jitter=0.01),
+    )
+
+
+def stub_ai() -> oai.AI:
+    url = get_stub_openai_server().url
+    if url is None:
+        raise ServiceException("The stub OpenAI server is not running, start it with get_stub_openai_server().start().")
+    return oai.openai_service_factory(base_url=url)
+
+
+def stub_text_to_voice(
+    stream: Optional[bool] = False,
+    audio_encoding: AudioEncoding = AudioEncoding.OGG_OPUS,
+    sample_rate_hertz: Optional[int] = None,
+) -> gcp.TextToVoice:
+    return gcp.text_to_voice_service_factory(stub_tts_client(), audio_encoding, stream, sample_rate_hertz)
+
+
+def stub_tts_client() -> StubTextToSpeechClient:
+    return StubTextToSpeechClient(
+        LatencyModel(Config.get_float("STUB_TTS_LATENCY", 0.15), Config.get_float("STUB_TTS_LATENCY_PER_CHAR", 0.002))
+    )
+
+
+def stub_batch_text_to_voice(batch_size: Optional[int] = None) -> gcp.BatchTextToVoice:
+    return gcp.batch_text_to_voice_service_factory(stub_tts_client(), batch_size)
+
+
+def stub_voice_to_text(stream: Optional[bool] = False) -> gcp.VoiceToText:
+    client = StubSpeechClient(
+        LatencyModel(Config.get_float("STUB_STT_LATENCY", 0.3), Config.get_float("STUB_STT_LATENCY_PER_KB", 0.001))
+    )
+    return gcp.voice_to_text_service_factory(client, stream=stream)
+
+
+def stub_upload(stream: Optional[bool] = False) -> gcp.Upload:
+    return gcp.upload_service_factory(token_class=StubToken, client_class=StubStorage, stream=stream)
@@ -0,0 +1,82 @@
+import asyncio
+
+from typing import Awaitable, Callable, Collection, Dict, List, Optional, Set, Tuple
+
+from fastapi import WebSocket
+
+from app.database.database import warm_up_pools
+from app.logger import logger_factory
+from app.services import factories
+from app.services.audio import AudioEncoding
+from app.services.conversation import FALLBACK_PHRASES
+
+
+class ServerState:
+    def __init__(self):
+        self.warmed_up = False
+        self.draining = False
+        # warm-up step -> "ok" or why it failed
+        self.warm_up_report: Dict[str, str] = {}
+        # steps the worker is not ready without, a step that timed out failed like any other
+        self.required_warm_up_steps: Tuple[str, ...] = ()
+        self.warm_up_timeout = 10.0
+        self.conversations: Set[WebSocket] = set()
+        self._recheck: Optional[asyncio.Task] = None
+
+    def failed_required_steps(self) -> List[str]:
+        return [name for name in self.required_warm_up_steps if self.warm_up_report.get(name, "ok") != "ok"]
+
+    def recheck_required_steps(self):
+        # in the background, a readiness probe won't wait for a step that may take the whole warm-up timeout
+        if self._recheck is None or self._recheck.done():
+            self._recheck = asyncio.create_task(self._rerun_failed_required_steps())
+
+    async def _rerun_failed_required_steps(self):
+        self.warm_up_report.update(await warm_up(self.warm_up_timeout, self.failed_required_steps()))
+
+
+server_state = ServerState()
+
+
+async def warm_up(timeout: float, only: Optional[Collection[str]] = None) -> Dict[str, str]:
+    """
+    Opens upstream connections and primes caches before the worker takes traffic, all steps or `only` the named ones.
+    A failed step is only reported, the worker can still serve what doesn't depend on it unless the step is required.
+    """
+    logger = logger_factory("Warm-up")
+    steps: Dict[str, Callable[[], Awaitable]] = {
+        "database": warm_up_pools,
+        "openai": lambda: factories.ai().warm_up(),
+        "gcp_text_to_speech": lambda: factories.text_to_voice().warm_up(),
+        "gcp_speech_to_text": lambda: factories.voice_to_text(stream=True).warm_up(),
+        "gcp_storage": lambda: factories.upload().warm_up(),
+        "fallback_phrases": cache_fallback_phrases,
+    }
+    if only is not None:
+        steps = {name: step for name, step in steps.items() if name in only}
+    tasks = {name: asyncio.create_task(run_step(step)) for name, step in steps.items()}
+    await asyncio.wait(tasks.values(), timeout=timeout)
+
+    report = {}
+    for name, task in tasks.items():
+        if not task.done():
+            task.cancel()
+            report[name] = f"did not finish in {timeout} sec."
+        elif task.exception() is not None:
+            report[name] = f"failed: {task.exception()!r}"
+        else:
+            report[name] = "ok"
+        if report[name] != "ok":
+            logger.log_error(f"Warm-up step {name} {report[name]}")
+    return report
+
+
+async def run_step(step: Callable[[], Awaitable]):
+    # building a service can fail before there is anything to await, this keeps that inside the task
+    await step()
+
+
+async def cache_fallback_phrases():
+    # the same encodings the conversation endpoints reply in
+    for ttv in (factories.text_to_voice(), factories.text_to_voice(stream=True, audio_encoding=AudioEncoding.MP3)):
+        await asyncio.gather(*(ttv.cache_phrase(lang, phrase) for lang, phrase in FALLBACK_PHRASES.items()))
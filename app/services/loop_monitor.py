@@ -0,0 +1,118 @@
+import asyncio
+import sys
+import threading
+import traceback
+
+from collections import Counter, deque
+from time import monotonic
+from typing import Deque, Dict, Optional
+
+from app.config import Config
+from app.logger import logger_factory
+from app.services.service import Service
+
+
+class LoopMonitor(Service):
+    """
+    Tells a busy event loop apart from slow upstreams. A probe is scheduled on the loop every `interval` and the time
+    it runs late is the scheduling lag every other callback sees too. A watchdog thread logs the stack of the loop
+    thread while a probe is late by more than `block_threshold`, which shows the callback that holds the loop.
+    """
+
+    def __init__(
+        self,
+        interval: float,
+        block_threshold: float,
+        saturation_threshold: float,
+        window: int,
+        *args,
+        **kwargs,
+    ):
+        super().__init__(*args, **kwargs)
+        self.interval = interval
+        self.block_threshold = block_threshold
+        self.saturation_threshold = saturation_threshold
+        self.lags: Deque[float] = deque(maxlen=window)
+        self.blocked = 0
+        self.last_probe = monotonic()
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.loop_thread_id: Optional[int] = None
+        self._probe_handle: Optional[asyncio.TimerHandle] = None
+        self._watchdog: Optional[threading.Thread] = None
+        self._stopping = threading.Event()
+
+    def start(self):
+        self.loop = asyncio.get_running_loop()
+        self.loop_thread_id = threading.get_ident()
+        self._stopping.clear()
+        self._schedule_probe()
+        self._watchdog = threading.Thread(target=self._watch, name="loop-watchdog", daemon=True)
+        self._watchdog.start()
+
+    def stop(self):
+        if self._probe_handle is not None:
+            self._probe_handle.cancel()
+            self._probe_handle = None
+        self._stopping.set()
+
+    def _schedule_probe(self):
+        self.last_probe = monotonic()
+        self._probe_handle = self.loop.call_later(self.interval, self._probe, self.last_probe + self.interval)
+
+    def _probe(self, scheduled_at: float):
+        self.lags.append(max(0.0, monotonic() - scheduled_at))
+        self._schedule_probe()
+
+    def _watch(self):
+        reported_probe = None
+        while not self._stopping.wait(self.block_threshold / 2):
+            last_probe = self.last_probe
+            late = monotonic() - last_probe - self.interval
+            # one report per stall, however long it lasts
+            if late > self.block_threshold and last_probe != reported_probe:
+                reported_probe = last_probe
+                self.blocked += 1
+                self._log_blocked(late)
+
+    def _log_blocked(self, late: float):
+        task = asyncio.current_task(self.loop)
+        frame = sys._current_frames().get(self.loop_thread_id)
+        stack = "".join(traceback.format_stack(frame)) if frame is not None else ""
+        running = f"task {task_category(task)}" if task is not None else "a callback"
+        self.logger.log_error(f"Event loop blocked for over {late:.3f} sec. by {running}:\n{stack}")
+
+    def count_tasks(self) -> Dict[str, int]:
+        # tasks are named after the coroutine they run, "Task-123" would say nothing
+        return dict(Counter(task_category(task) for task in asyncio.all_tasks(self.loop)))
+
+    def get_status(self) -> dict:
+        lags = sorted(self.lags)
+        lag_p99 = lags[int(len(lags) * 0.99)] if lags else 0.0
+        tasks = self.count_tasks() if self.loop is not None else {}
+        return {
+            "lag": self.lags[-1] if self.lags else 0.0,
+            "lag_avg": sum(lags) / len(lags) if lags else 0.0,
+            "lag_p99": lag_p99,
+            "lag_max": lags[-1] if lags else 0.0,
+            # for autoscaling, a worker over this can't take more conversations whatever the upstreams do
+            "saturated": lag_p99 > self.saturation_threshold,
+            "blocked": self.blocked,
+            "task_count": sum(tasks.values()),
+            "tasks": tasks,
+        }
+
+
+def task_category(task: asyncio.Task) -> str:
+    coro = task.get_coro()
+    return getattr(coro, "__qualname__", type(coro).__name__)
+
+
+def loop_monitor_factory() -> LoopMonitor:
+    return LoopMonitor(
+        interval=Config.get_float("LOOP_MONITOR_INTERVAL", 0.1),
+        block_threshold=Config.get_float("LOOP_MONITOR_BLOCK_THRESHOLD", 0.25),
+        saturation_threshold=Config.get_float("LOOP_MONITOR_SATURATION_THRESHOLD", 0.1),
+        # a minute of probes at the default interval
+        window=Config.get_int("LOOP_MONITOR_WINDOW", 600),
+        logger=logger_factory("Loop Monitor"),
+    )
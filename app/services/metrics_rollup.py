@@ -0,0 +1,189 @@
+import math
+import sqlalchemy as sa
+
+from collections import Counter
+from datetime import datetime, timedelta
+from enum import Enum
+from typing import Dict, Optional, Tuple
+
+from pydantic import BaseModel
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+
+from app.config import Config
+from app.database import db_read_session_scope, db_session_factory
+from app.logger import logger_factory
+from app.models.content import ContentLanguage
+from app.models.conversation_reply_log import ConversationReplyLog
+from app.models.conversation_reply_rollup import ConversationReplyRollup, RollupWatermark
+from app.services.service import Service
+
+# Log-scale buckets: 0 holds values below HISTOGRAM_MIN, bucket i >= 1 holds [MIN * GROWTH^(i-1), MIN * GROWTH^i).
+# Growth of 1.1 keeps percentiles within 10% for anything from milliseconds to megabytes.
+HISTOGRAM_MIN = 1e-3
+HISTOGRAM_GROWTH = 1.1
+ROLLUP_WATERMARK_NAME = "conversation_reply_log"
+ROLLUP_LOCK_KEY = 72_010_036
+
+
+class RollupMetric(Enum):
+    VTT_TIME = "vtt_time"
+    TTV_TIME = "ttv_time"
+    AI_REPLY_TIME = "ai_reply_time"
+    AI_REPLY_LENGTH = "ai_reply_length"
+
+
+def histogram_bucket(value: float) -> int:
+    if value < HISTOGRAM_MIN:
+        return 0
+    return int(math.log(value / HISTOGRAM_MIN, HISTOGRAM_GROWTH)) + 1
+
+
+def histogram_bucket_upper_bound(bucket: int) -> float:
+    return HISTOGRAM_MIN * HISTOGRAM_GROWTH**bucket
+
+
+class RollupBucket:
+    __slots__ = ("count", "total", "histogram")
+
+    def __init__(self, count: int = 0, total: float = 0.0, histogram: Optional[Dict[str, int]] = None):
+        self.count = count
+        self.total = total
+        self.histogram = Counter({int(bucket): n for bucket, n in (histogram or {}).items()})
+
+    def add(self, value: float):
+        self.count += 1
+        self.total += value
+        self.histogram[histogram_bucket(value)] += 1
+
+    def merge(self, other: "RollupBucket"):
+        self.count += other.count
+        self.total += other.total
+        self.histogram.update(other.histogram)
+
+    def percentile(self, fraction: float) -> Optional[float]:
+        if not self.count:
+            return None
+        rank = fraction * self.count
+        seen = 0
+        for bucket in sorted(self.histogram):
+            seen += self.histogram[bucket]
+            if seen >= rank:
+                return histogram_bucket_upper_bound(bucket)
+        return histogram_bucket_upper_bound(max(self.histogram))
+
+
+class LatencyStats(BaseModel):
+    metric: RollupMetric
+    lang: Optional[ContentLanguage]
+    start: datetime
+    end: datetime
+    count: int
+    mean: Optional[float]
+    p50: Optional[float]
+    p95: Optional[float]
+    p99: Optional[float]
+
+
+class MetricsRollup(Service):
+    """Folds new ConversationReplyLog rows into per-minute histograms and answers percentiles from them."""
+
+    def __init__(self, settle_delay: timedelta, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # rows are timestamped before they commit, wait this long before treating a minute as complete
+        self.settle_delay = settle_delay
+
+    async def fold_new_reply_logs(self) -> int:
+        until = datetime.utcnow() - self.settle_delay
+        async with db_session_factory() as db:
+            await db.execute(sa.select(sa.func.pg_advisory_xact_lock(ROLLUP_LOCK_KEY)))
+            watermark = await db.get(RollupWatermark, ROLLUP_WATERMARK_NAME)
+            query = sa.select(
+                ConversationReplyLog.created_at, ConversationReplyLog.language, ConversationReplyLog.metrics
+            ).where(ConversationReplyLog.created_at <= until)
+            if watermark is not None:
+                query = query.where(ConversationReplyLog.created_at > watermark.processed_until)
+
+            folded = 0
+            buckets: Dict[Tuple[datetime, ContentLanguage, str], RollupBucket] = {}
+            for created_at, lang, metrics in (await db.execute(query)).all():
+                minute = created_at.replace(second=0, microsecond=0)
+                for metric in RollupMetric:
+                    value = (metrics or {}).get(metric.value)
+                    if value is not None:
+                        buckets.setdefault((minute, lang, metric.value), RollupBucket()).add(value)
+                folded += 1
+
+            if buckets:
+                await self._merge_buckets(db, buckets)
+            await db.merge(RollupWatermark(name=ROLLUP_WATERMARK_NAME, processed_until=until))
+            await db.commit()
+        return folded
+
+    async def _merge_buckets(self, db, buckets: Dict[Tuple[datetime, ContentLanguage, str], RollupBucket]):
+        existing_query = sa.select(ConversationReplyRollup).where(
+            ConversationReplyRollup.bucket_start.in_({minute for minute, _, _ in buckets})
+        )
+        for existing in (await db.scalars(existing_query)).all():
+            key = (existing.bucket_start, existing.language, existing.metric)
+            if key in buckets:
+                buckets[key].merge(RollupBucket(existing.count, existing.total, existing.histogram))
+
+        rows = [
+            {
+                "bucket_start": minute,
+                "language": lang,
+                "metric": metric,
+                "count": bucket.count,
+                "total": bucket.total,
+                "histogram": {str(index): n for index, n in bucket.histogram.items()},
+            }
+            for (minute, lang, metric), bucket in buckets.items()
+        ]
+        upsert = pg_insert(ConversationReplyRollup)
+        upsert = upsert.on_conflict_do_update(
+            index_elements=["bucket_start", "language", "metric"],
+            set_={
+                "count": upsert.excluded.count,
+                "total": upsert.excluded.total,
+                "histogram": upsert.excluded.histogram,
+            },
+        )
+        await db.execute(upsert, rows)
+
+    async def get_latency_stats(
+        self, metric: RollupMetric, lang: Optional[ContentLanguage], start: datetime, end: datetime
+    ) -> LatencyStats:
+        query = sa.select(
+            ConversationReplyRollup.count, ConversationReplyRollup.total, ConversationReplyRollup.histogram
+        ).where(
+            sa.and_(
+                ConversationReplyRollup.metric == metric.value,
+                ConversationReplyRollup.bucket_start >= start,
+                ConversationReplyRollup.bucket_start < end,
+            )
+        )
+        if lang is not None:
+            query = query.where(ConversationReplyRollup.language == lang)
+
+        window = RollupBucket()
+        async with db_read_session_scope() as db:
+            for count, total, histogram in (await db.execute(query)).all():
+                window.merge(RollupBucket(count, total, histogram))
+        return LatencyStats(
+            metric=metric,
+            lang=lang,
+            start=start,
+            end=end,
+            count=window.count,
+            mean=window.total / window.count if window.count else None,
+            p50=window.percentile(0.5),
+            p95=window.percentile(0.95),
+            p99=window.percentile(0.99),
+        )
+
+
+def metrics_rollup_factory() -> MetricsRollup:
+    return MetricsRollup(
+        settle_delay=timedelta(seconds=Config.get_float("ROLLUP_SETTLE_DELAY", 60.0)),
+        logger=logger_factory("Metrics Rollup"),
+    )
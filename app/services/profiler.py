@@ -0,0 +1,204 @@
+import asyncio
+import os
+import random
+import sys
+import tempfile
+import threading
+
+from collections import Counter
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from functools import lru_cache
+from time import perf_counter, sleep, time
+from types import FrameType
+from typing import AsyncIterator, Dict, Optional, Set
+from weakref import WeakKeyDictionary
+
+from app.config import Config, get_settings
+from app.logger import correlation_id, logger_factory, new_correlation_id
+
+# samples taken while a profiled request or turn waits, on upstream calls or for other tasks to yield
+WAITING_FRAME = "(waiting)"
+# the profile of the request or turn being handled, tasks it creates are profiled along with it
+active_profile: ContextVar[Optional["Profile"]] = ContextVar("active_profile", default=None)
+
+
+class Profile:
+    def __init__(self, count_waiting: bool):
+        self.count_waiting = count_waiting
+        # "frame;frame;frame" -> samples, the collapsed stack format flamegraph.pl and speedscope read
+        self.stacks: Counter = Counter()
+        self.started = perf_counter()
+
+
+class SamplingProfiler:
+    """
+    Samples the stack of the event loop thread from a thread of its own, and adds it to the profile of the task that
+    is running. The thread only samples while a profile is open.
+    """
+
+    def __init__(self, interval: float, output_dir: str, background_window: float):
+        self.interval = interval
+        self.output_dir = output_dir
+        self.background_window = background_window
+        # requests and turns sampled at PROFILER_SAMPLE_RATE add up here, written once per window
+        self.background = Profile(count_waiting=False)
+        self.task_profiles: "WeakKeyDictionary[asyncio.Task, Profile]" = WeakKeyDictionary()
+        self.open_profiles: Set[Profile] = set()
+        self.profiles_written = 0
+        self.lock = threading.Lock()
+        self.sampling = threading.Event()
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.loop_thread_id: Optional[int] = None
+        self.thread: Optional[threading.Thread] = None
+        self.logger = logger_factory("Profiler")
+
+    def start(self, task: asyncio.Task, profile: Profile):
+        loop = asyncio.get_running_loop()
+        if self.loop is not loop:
+            self.loop = loop
+            self.loop_thread_id = threading.get_ident()
+            # another factory would be replaced, tasks are only followed with the default one
+            if loop.get_task_factory() is None:
+                loop.set_task_factory(profiled_task_factory)
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._sample_while_profiling, name="profiler", daemon=True)
+            self.thread.start()
+        with self.lock:
+            self.task_profiles[task] = profile
+            self.open_profiles.add(profile)
+            self.sampling.set()
+
+    def follow(self, task: asyncio.Task, profile: Profile):
+        with self.lock:
+            if profile in self.open_profiles:
+                self.task_profiles[task] = profile
+
+    def stop(self, task: asyncio.Task, profile: Profile):
+        with self.lock:
+            self.task_profiles.pop(task, None)
+            # the background profile stays open while any sampled request or turn is in flight
+            if profile is not self.background or profile not in self.task_profiles.values():
+                self.open_profiles.discard(profile)
+            if not self.open_profiles:
+                self.sampling.clear()
+
+    def _sample_while_profiling(self):
+        while True:
+            self.sampling.wait()
+            sleep(self.interval)
+            try:
+                self.sample()
+            except Exception as exc:
+                # the thread is started once, dying here would leave every later profile empty
+                self.logger.log_error(f"Could not take a profiler sample: {exc!r}")
+
+    def sample(self):
+        # The loop may switch tasks between these two reads, which misattributes a sample now and then. Locking
+        # the loop out for every sample would cost more than that.
+        task = asyncio.current_task(self.loop)
+        frame = sys._current_frames().get(self.loop_thread_id)
+        with self.lock:
+            running = self.task_profiles.get(task) if task is not None else None
+            for profile in self.open_profiles:
+                if profile is running and frame is not None:
+                    profile.stacks[collapse_stack(frame)] += 1
+                elif profile.count_waiting:
+                    profile.stacks[WAITING_FRAME] += 1
+
+    def background_due(self) -> bool:
+        return perf_counter() - self.background.started >= self.background_window
+
+    async def write(self, profile: Profile, name: str) -> Optional[str]:
+        with self.lock:
+            stacks = Counter(profile.stacks)
+            if profile is self.background:
+                profile.stacks.clear()
+                duration, profile.started = perf_counter() - profile.started, perf_counter()
+            else:
+                duration = perf_counter() - profile.started
+        if not stacks:
+            return None
+
+        path = os.path.join(self.output_dir, f"{int(time())}-{name.replace('/', '-')}.folded")
+        try:
+            await asyncio.to_thread(write_collapsed_stacks, path, stacks)
+        except OSError as exc:
+            self.logger.log_error(f"Could not write profile {path}: {exc}")
+            return None
+        self.profiles_written += 1
+        self.logger.log_info(f"Profile written to {path}, {sum(stacks.values())} samples over {duration:.3f} sec.")
+        return path
+
+    async def write_background(self) -> Optional[str]:
+        return await self.write(self.background, f"background-{os.getpid()}")
+
+    def get_status(self) -> Dict[str, int]:
+        return {"open_profiles": len(self.open_profiles), "profiles_written": self.profiles_written}
+
+
+def collapse_stack(frame: Optional[FrameType]) -> str:
+    # outermost frame first, named like py-spy does, so line level hot spots stay apart
+    frames = []
+    while frame is not None:
+        code = frame.f_code
+        # co_qualname is new in 3.11, the image still runs 3.10
+        frames.append(f"{getattr(code, 'co_qualname', code.co_name)} ({code.co_filename}:{frame.f_lineno})")
+        frame = frame.f_back
+    return ";".join(reversed(frames))
+
+
+def write_collapsed_stacks(path: str, stacks: Counter):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as output:
+        output.writelines(f"{stack} {samples}\n" for stack, samples in stacks.items())
+
+
+def profiled_task_factory(loop: asyncio.AbstractEventLoop, coro, **kwargs) -> asyncio.Task:
+    task = asyncio.Task(coro, loop=loop, **kwargs)
+    context = kwargs.get("context")
+    profile = active_profile.get() if context is None else context.get(active_profile)
+    if profile is not None:
+        get_profiler().follow(task, profile)
+    return task
+
+
+@lru_cache
+def get_profiler() -> SamplingProfiler:
+    return SamplingProfiler(
+        interval=Config.get_float("PROFILER_INTERVAL", 0.01),
+        output_dir=Config.get("PROFILER_OUTPUT_DIR", os.path.join(tempfile.gettempdir(), "profiles")),
+        background_window=Config.get_float("PROFILER_BACKGROUND_WINDOW", 300.0),
+    )
+
+
+@asynccontextmanager
+async def profiled(requested: bool = False) -> AsyncIterator[Optional[Profile]]:
+    """
+    Profiles the request or turn on its own when requested. Otherwise it is sampled into the background profile at
+    PROFILER_SAMPLE_RATE.
+    """
+    profiler = get_profiler()
+    if requested:
+        if correlation_id.get() is None:
+            new_correlation_id()
+        profile = Profile(count_waiting=True)
+    elif random.random() < get_settings().profiler_sample_rate:
+        profile = profiler.background
+    else:
+        yield None
+        return
+
+    task = asyncio.current_task()
+    profiler.start(task, profile)
+    token = active_profile.set(profile)
+    try:
+        yield profile
+    finally:
+        active_profile.reset(token)
+        profiler.stop(task, profile)
+        # named by the correlation id, so the log line with the path is found along with the rest of the turn
+        if requested:
+            await profiler.write(profile, correlation_id.get())
+        elif profiler.background_due():
+            await profiler.write_background()
@@ -0,0 +1,135 @@
+import os
+import gzip
+import ujson
+import sqlalchemy as sa
+
+from datetime import date, datetime
+from typing import List, Optional
+
+from app.config import Config
+from app.database.database import engine_factory
+from app.logger import logger_factory
+from app.services.service import Service
+
+PARTITIONED_TABLE = "conversation_reply_log"
+DEFAULT_PARTITION = f"{PARTITIONED_TABLE}_default"
+
+
+def add_months(month: date, months: int) -> date:
+    month_index = month.year * 12 + month.month - 1 + months
+    return date(month_index // 12, month_index % 12 + 1, 1)
+
+
+def current_month() -> date:
+    now = datetime.utcnow()
+    return date(now.year, now.month, 1)
+
+
+def partition_name(month: date) -> str:
+    return f"{PARTITIONED_TABLE}_y{month.year}m{month.month:02d}"
+
+
+def partition_month(name: str) -> Optional[date]:
+    prefix = f"{PARTITIONED_TABLE}_y"
+    if not name.startswith(prefix):
+        return None
+    year, month = name[len(prefix) :].split("m")
+    return date(int(year), int(month), 1)
+
+
+class ReplyLogPartitions(Service):
+    """Monthly partitions of conversation_reply_log: created ahead of time, archived and dropped after retention."""
+
+    def __init__(self, months_ahead: int, retention_months: int, archive_dir: str, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.months_ahead = months_ahead
+        self.retention_months = retention_months
+        self.archive_dir = archive_dir
+
+    async def list_partitions(self) -> List[date]:
+        query = sa.text(
+            """
+            SELECT child.relname FROM pg_inherits
+            JOIN pg_class parent ON pg_inherits.inhparent = parent.oid
+            JOIN pg_class child ON pg_inherits.inhrelid = child.oid
+            WHERE parent.relname = :table
+            """
+        )
+        async with engine_factory().connect() as conn:
+            names = (await conn.scalars(query, {"table": PARTITIONED_TABLE})).all()
+        return sorted(month for month in map(partition_month, names) if month is not None)
+
+    def get_missing_months(self, existing: List[date]) -> List[date]:
+        months = [add_months(current_month(), offset) for offset in range(self.months_ahead + 1)]
+        return [month for month in months if month not in existing]
+
+    def get_expired_months(self, existing: List[date]) -> List[date]:
+        keep_from = add_months(current_month(), -self.retention_months)
+        return [month for month in existing if month < keep_from]
+
+    async def create_partition(self, month: date):
+        name = partition_name(month)
+        start, end = month.isoformat(), add_months(month, 1).isoformat()
+        # Rows that landed in the default partition for this month are moved before attaching.
+        async with engine_factory().begin() as conn:
+            await conn.execute(sa.text(f"CREATE TABLE {name} (LIKE {PARTITIONED_TABLE} INCLUDING ALL)"))
+            await conn.execute(
+                sa.text(
+                    f"WITH moved AS (DELETE FROM {DEFAULT_PARTITION} WHERE created_at >= :start AND created_at < :end "
+                    f"RETURNING *) INSERT INTO {name} SELECT * FROM moved"
+                ),
+                {"start": month, "end": add_months(month, 1)},
+            )
+            await conn.execute(
+                sa.text(
+                    f"ALTER TABLE {PARTITIONED_TABLE} ATTACH PARTITION {name} FOR VALUES FROM ('{start}') TO ('{end}')"
+                )
+            )
+        self.logger.log_debug(f"Created partition {name}.")
+
+    async def archive_partition(self, month: date) -> str:
+        name = partition_name(month)
+        os.makedirs(self.archive_dir, exist_ok=True)
+        archive_path = os.path.join(self.archive_dir, f"{name}.jsonl.gz")
+        tmp_path = f"{archive_path}.tmp"
+        rows = 0
+        async with engine_factory().connect() as conn:
+            result = await conn.stream(sa.text(f"SELECT * FROM {name} ORDER BY created_at"))
+            with gzip.open(tmp_path, "wt", encoding="utf-8") as archive:
+                async for row in result.mappings():
+                    archive.write(ujson.dumps({key: _to_json_value(value) for key, value in row.items()}))
+                    archive.write("\n")
+                    rows += 1
+        os.replace(tmp_path, archive_path)
+        self.logger.log_debug(f"Archived {rows} rows of {name} to {archive_path}.")
+        return archive_path
+
+    async def drop_partition(self, month: date):
+        name = partition_name(month)
+        async with engine_factory().begin() as conn:
+            await conn.execute(sa.text(f"ALTER TABLE {PARTITIONED_TABLE} DETACH PARTITION {name}"))
+            await conn.execute(sa.text(f"DROP TABLE {name}"))
+        self.logger.log_debug(f"Dropped partition {name}.")
+
+
+def _to_json_value(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, (str, int, float, bool, dict, list)) or value is None:
+        return value
+    return str(value)
+
+
+def reply_log_partitions_factory(
+    months_ahead: Optional[int] = None,
+    retention_months: Optional[int] = None,
+    archive_dir: Optional[str] = None,
+) -> ReplyLogPartitions:
+    return ReplyLogPartitions(
+        months_ahead=Config.get_int("REPLY_LOG_MONTHS_AHEAD", 3) if months_ahead is None else months_ahead,
+        retention_months=(
+            Config.get_int("REPLY_LOG_RETENTION_MONTHS", 6) if retention_months is None else retention_months
+        ),
+        archive_dir=archive_dir or Config.get("REPLY_LOG_ARCHIVE_DIR", "reply_log_archive"),
+        logger=logger_factory("Reply Log Partitions"),
+    )
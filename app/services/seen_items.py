@@ -0,0 +1,69 @@
+from collections import OrderedDict
+from time import monotonic
+from typing import Dict, Tuple
+
+from app.config import Config
+from app.logger import logger_factory
+from app.models.content import ContentLanguage, ContentType
+from app.services.service import Service
+
+
+class SeenItems:
+    """Items a session has already been served, one bitmap per content pool bucket, indexed by pool position."""
+
+    __slots__ = ("bitmaps", "touched_at")
+
+    def __init__(self):
+        self.bitmaps: Dict[Tuple[ContentType, ContentLanguage], bytearray] = {}
+        self.touched_at = monotonic()
+
+    def bitmap(self, content_type: ContentType, lang: ContentLanguage) -> bytearray:
+        return self.bitmaps.setdefault((content_type, lang), bytearray())
+
+    def mark(self, content_type: ContentType, lang: ContentLanguage, pos: int):
+        bitmap = self.bitmap(content_type, lang)
+        byte_pos = pos >> 3
+        if byte_pos >= len(bitmap):
+            bitmap.extend(bytes(byte_pos - len(bitmap) + 1))
+        bitmap[byte_pos] |= 1 << (pos & 7)
+
+
+def is_seen(bitmap: bytearray, pos: int) -> bool:
+    byte_pos = pos >> 3
+    return byte_pos < len(bitmap) and bool(bitmap[byte_pos] & (1 << (pos & 7)))
+
+
+class SeenItemsTracker(Service):
+    def __init__(self, max_sessions: int, session_ttl: float, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.max_sessions = max_sessions
+        self.session_ttl = session_ttl
+        self.sessions: OrderedDict[str, SeenItems] = OrderedDict()
+
+    def get(self, session_id: str) -> SeenItems:
+        self._evict_expired()
+        seen = self.sessions.get(session_id)
+        if seen is None:
+            seen = self.sessions[session_id] = SeenItems()
+            if len(self.sessions) > self.max_sessions:
+                self.sessions.popitem(last=False)
+        else:
+            self.sessions.move_to_end(session_id)
+        seen.touched_at = monotonic()
+        return seen
+
+    def _evict_expired(self):
+        expire_before = monotonic() - self.session_ttl
+        while self.sessions:
+            oldest = next(iter(self.sessions.values()))
+            if oldest.touched_at >= expire_before:
+                break
+            self.sessions.popitem(last=False)
+
+
+def seen_items_tracker_factory() -> SeenItemsTracker:
+    return SeenItemsTracker(
+        max_sessions=Config.get_int("SEEN_ITEMS_MAX_SESSIONS", 100_000),
+        session_ttl=Config.get_float("SEEN_ITEMS_SESSION_TTL", 6 * 60 * 60.0),
+        logger=logger_factory("Seen Items"),
+    )
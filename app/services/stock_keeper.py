@@ -0,0 +1,209 @@
+import asyncio
+import sqlalchemy as sa
+
+from datetime import datetime
+from contextlib import asynccontextmanager
+from typing import Dict, List, Optional, Tuple
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlalchemy.pool import NullPool
+
+from app.config import Config
+from app.database import db_session_factory, store_models_to_db
+from app.database.database import engine_factory
+from app.logger import logger_factory
+from app.models.content import Content, ContentLanguage, ContentType
+from app.models.content_stock_progress import ContentStockProgress
+from app.services.content import gen_new_content_and_upload_for_public_access, notify_content_changed
+from app.services.service import Service
+
+# pg advisory lock key, only one keeper across all processes generates at a time
+STOCK_KEEPER_LOCK_KEY = 72_010_030
+
+
+class StockKeeper(Service):
+    """Keeps every (content type, language) stock above a low-water mark by generating off-peak."""
+
+    def __init__(
+        self,
+        low_water_mark: int,
+        target: int,
+        batch_size: int,
+        concurrency: int,
+        batch_pause: float,
+        off_peak_hours: Tuple[int, int],
+        check_interval: float,
+        *args,
+        **kwargs,
+    ):
+        super().__init__(*args, **kwargs)
+        self.low_water_mark = low_water_mark
+        self.target = max(target, low_water_mark)
+        self.batch_size = batch_size
+        self.batch_pause = batch_pause
+        self.off_peak_hours = off_peak_hours
+        self.check_interval = check_interval
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._task: Optional[asyncio.Task] = None
+
+    def is_off_peak(self, now: Optional[datetime] = None) -> bool:
+        hour = (now or datetime.utcnow()).hour
+        start, end = self.off_peak_hours
+        if start <= end:
+            return start <= hour < end
+        return hour >= start or hour < end
+
+    async def get_stock(self) -> Dict[Tuple[ContentType, ContentLanguage], int]:
+        query = sa.select(Content.content_type, Content.language, sa.func.count()).group_by(
+            Content.content_type, Content.language
+        )
+        async with db_session_factory() as db:
+            return {(content_type, lang): count for content_type, lang, count in (await db.execute(query)).all()}
+
+    async def run_once(self) -> int:
+        if not self.is_off_peak():
+            return 0
+        generated = 0
+        async with self._exclusive() as acquired:
+            if not acquired:
+                self.logger.log_debug("Another stock keeper is running, skipping.")
+                return 0
+            stock = await self.get_stock()
+            for content_type in ContentType:
+                for lang in ContentLanguage:
+                    progress = await self._get_unfinished_progress(content_type, lang)
+                    in_stock = stock.get((content_type, lang), 0)
+                    if progress is None and in_stock < self.low_water_mark:
+                        progress = ContentStockProgress(
+                            content_type=content_type, language=lang, requested=self.target - in_stock
+                        )
+                        [progress] = await store_models_to_db([progress])
+                    if progress is not None:
+                        generated += await self._refill(progress)
+        return generated
+
+    async def _refill(self, progress: ContentStockProgress) -> int:
+        generated = 0
+        while progress.generated < progress.requested:
+            if not self.is_off_peak():
+                self.logger.log_debug("Peak hours started, pausing generation.")
+                return generated
+            count = min(self.batch_size, progress.requested - progress.generated)
+            models = await self._generate(progress.content_type, progress.language, count)
+            if models:
+                await store_models_to_db(models)
+                await notify_content_changed()
+            progress.generated += len(models)
+            progress.failed += count - len(models)
+            await self._save_progress(progress)
+            generated += len(models)
+            if not models:
+                self.logger.log_error(f"Could not generate {progress.content_type} content, backing off.")
+                return generated
+            await asyncio.sleep(self.batch_pause)
+
+        progress.finished_at = datetime.utcnow()
+        await self._save_progress(progress)
+        self.logger.log_debug(
+            f"Refilled {progress.content_type} ({progress.language}) stock with {progress.generated} items."
+        )
+        return generated
+
+    async def _generate(self, content_type: ContentType, lang: ContentLanguage, count: int) -> List[Content]:
+        async def generate_one():
+            async with self._semaphore:
+                return await gen_new_content_and_upload_for_public_access(content_type, lang)
+
+        results = await asyncio.gather(*[generate_one() for _ in range(count)], return_exceptions=True)
+        for result in results:
+            if isinstance(result, Exception):
+                self.logger.log_error(f"Content generation failed: {result}")
+        return [result for result in results if not isinstance(result, Exception)]
+
+    async def _get_unfinished_progress(
+        self, content_type: ContentType, lang: ContentLanguage
+    ) -> Optional[ContentStockProgress]:
+        query = (
+            sa.select(ContentStockProgress)
+            .where(
+                sa.and_(
+                    ContentStockProgress.content_type == content_type,
+                    ContentStockProgress.language == lang,
+                    ContentStockProgress.finished_at.is_(None),
+                )
+            )
+            .order_by(ContentStockProgress.created_at.desc())
+            .limit(1)
+        )
+        async with db_session_factory() as db:
+            return await db.scalar(query)
+
+    async def _save_progress(self, progress: ContentStockProgress):
+        progress.updated_at = datetime.utcnow()
+        query = (
+            sa.update(ContentStockProgress)
+            .where(ContentStockProgress.id == progress.id)
+            .values(
+                generated=progress.generated,
+                failed=progress.failed,
+                updated_at=progress.updated_at,
+                finished_at=progress.finished_at,
+            )
+        )
+        async with db_session_factory() as db:
+            await db.execute(query)
+            await db.commit()
+
+    @asynccontextmanager
+    async def _exclusive(self):
+        # The lock is held by a session for the whole refill. It gets a connection of its own, one out of the pool
+        # for that long would be missed by the requests of the process.
+        lock_engine = create_async_engine(engine_factory().url, poolclass=NullPool)
+        try:
+            async with lock_engine.connect() as conn:
+                acquired = await conn.scalar(sa.select(sa.func.pg_try_advisory_lock(STOCK_KEEPER_LOCK_KEY)))
+                await conn.commit()
+                try:
+                    yield acquired
+                finally:
+                    if acquired:
+                        await conn.scalar(sa.select(sa.func.pg_advisory_unlock(STOCK_KEEPER_LOCK_KEY)))
+                        await conn.commit()
+        finally:
+            await lock_engine.dispose()
+
+    async def run(self):
+        while True:
+            try:
+                generated = await self.run_once()
+                if generated:
+                    self.logger.log_info(f"Generated {generated} content items.")
+            except Exception as exc:
+                self.logger.log_error(f"Stock keeper run failed: {exc}")
+            await asyncio.sleep(self.check_interval)
+
+    def start(self):
+        self._task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+
+def parse_hours_range(hours_range: str) -> Tuple[int, int]:
+    start, end = hours_range.split("-")
+    return int(start), int(end)
+
+
+def stock_keeper_factory() -> StockKeeper:
+    return StockKeeper(
+        low_water_mark=Config.get_int("CONTENT_STOCK_LOW_WATER_MARK", 100),
+        target=Config.get_int("CONTENT_STOCK_TARGET", 200),
+        batch_size=Config.get_int("CONTENT_STOCK_BATCH_SIZE", 10),
+        concurrency=Config.get_int("CONTENT_STOCK_CONCURRENCY", 2),
+        batch_pause=Config.get_float("CONTENT_STOCK_BATCH_PAUSE", 5.0),
+        off_peak_hours=parse_hours_range(Config.get("CONTENT_STOCK_OFF_PEAK_HOURS", "1-6")),
+        check_interval=Config.get_float("CONTENT_STOCK_CHECK_INTERVAL", 600.0),
+        logger=logger_factory("Stock Keeper"),
+    )
@@ -1,5 +1,28 @@
-from .integrations import gcp
+from enum import Enum
 
+from app.config import get_settings
 
-def get_url_for_ai_reply_obj(obj_name):
-    return gcp.get_url_for_ai_reply_obj(obj_name)
+
+class AvailableBucket(Enum):
+    PUBLIC_CONTENT = "public_content"
+    AI_REPLIES = "ai_replies"
+
+
+def get_bucket_name(bucket: AvailableBucket) -> str:
+    settings = get_settings()
+    return {
+        AvailableBucket.PUBLIC_CONTENT: settings.gcp_public_content_bucket,
+        AvailableBucket.AI_REPLIES: settings.gcp_ai_replies_bucket,
+    }[bucket]
+
+
+def get_url_for_storage_object(bucket: AvailableBucket, obj_name: str) -> str:
+    return f"https://storage.googleapis.com/{get_bucket_name(bucket)}/{obj_name}"
+
+
+def get_url_for_public_content_obj(obj_name: str) -> str:
+    return get_url_for_storage_object(AvailableBucket.PUBLIC_CONTENT, obj_name)
+
+
+def get_url_for_ai_reply_obj(obj_name: str) -> str:
+    return get_url_for_storage_object(AvailableBucket.AI_REPLIES, obj_name)
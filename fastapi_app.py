@@ -1,15 +1,121 @@
 from fastapi import FastAPI
 
 # from exceptions import register_exceptions
-from app.api.content import router as content_router
+from app.api.content import router as content_router, get_content_pool
 from app.api.conversation import router as conversation_router
+from app.api.health import router as health_router
+from app.api.metrics import router as metrics_router, get_loop_monitor
+from app.api.profiling import ProfilingMiddleware
+from app.api.stats import router as stats_router
 from app.web.index import router as web_index_router
+from app.config import Config, get_settings
+from app.database.database import dispose_engine
+from app.logger import logger_factory
+from app.services.background import background_tasks
+from app.services.integrations.clients import close_shared_clients
+from app.services.lifecycle import server_state, warm_up
+from app.services.profiler import get_profiler
+from app.services.stock_keeper import stock_keeper_factory
 
 
 app = FastAPI()
+app.add_middleware(ProfilingMiddleware)
 app.include_router(content_router, prefix="/content")
 app.include_router(conversation_router, prefix="/conversation")
+app.include_router(metrics_router, prefix="/metrics")
+app.include_router(stats_router, prefix="/stats")
+app.include_router(health_router, prefix="")
 app.include_router(web_index_router, prefix="")
 
 # app.include_router(user_router, prefix="/users")
 # register_exceptions(app)
+
+stock_keeper = stock_keeper_factory() if Config.get_bool("CONTENT_STOCK_KEEPER_ENABLED", False) else None
+
+
+@app.on_event("startup")
+async def resolve_settings():
+    # a missing setting should fail the worker at startup, not its first conversation
+    get_settings()
+
+
+@app.on_event("startup")
+async def start_loop_monitor():
+    # before anything else runs on the loop, so slow startup work is caught too
+    get_loop_monitor().start()
+
+
+@app.on_event("startup")
+async def start_stub_backends():
+    if get_settings().stub_backends:
+        from app.services.integrations.stubs import get_stub_openai_server
+
+        await get_stub_openai_server().start()
+
+
+@app.on_event("startup")
+async def start_content_pool():
+    await get_content_pool().start()
+
+
+@app.on_event("startup")
+async def start_stock_keeper():
+    if stock_keeper is not None:
+        stock_keeper.start()
+
+
+@app.on_event("startup")
+async def warm_up_worker():
+    # runs last, the worker only takes connections once it's done
+    if Config.get_bool("SERVER_WARM_UP", True):
+        server_state.required_warm_up_steps = tuple(Config.get_list("SERVER_WARM_UP_REQUIRED", ["database"]))
+        server_state.warm_up_timeout = Config.get_float("SERVER_WARM_UP_TIMEOUT", 10.0)
+        server_state.warm_up_report = await warm_up(server_state.warm_up_timeout)
+    server_state.warmed_up = True
+
+
+@app.on_event("shutdown")
+async def finish_background_tasks():
+    # reply logs and phrase caching left running by the last turns, before the connections they use are closed
+    cancelled = await background_tasks.wait(Config.get_float("SERVER_BACKGROUND_TASKS_TIMEOUT", 5.0))
+    if cancelled:
+        logger_factory("Shutdown").log_error(f"Cancelled {cancelled} background tasks that did not finish in time.")
+
+
+@app.on_event("shutdown")
+async def stop_loop_monitor():
+    get_loop_monitor().stop()
+
+
+@app.on_event("shutdown")
+async def stop_content_pool():
+    await get_content_pool().stop()
+
+
+@app.on_event("shutdown")
+async def stop_stock_keeper():
+    if stock_keeper is not None:
+        await stock_keeper.stop()
+
+
+@app.on_event("shutdown")
+async def close_db_connections():
+    await dispose_engine()
+
+
+@app.on_event("shutdown")
+async def stop_stub_backends():
+    if get_settings().stub_backends:
+        from app.services.integrations.stubs import get_stub_openai_server
+
+        await get_stub_openai_server().stop()
+
+
+@app.on_event("shutdown")
+async def close_upstream_clients():
+    await close_shared_clients()
+
+
+@app.on_event("shutdown")
+async def write_background_profile():
+    await get_profiler().write_background()
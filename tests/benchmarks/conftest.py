@@ -0,0 +1,61 @@
+import asyncio
+import json
+import os
+import pytest
+import sqlalchemy as sa
+
+from sqlalchemy.exc import SQLAlchemyError
+
+from app.config import Config
+from app.database import db_session_factory
+from app.database.database import dispose_engine
+
+BASELINE_PATH = os.path.join(os.path.dirname(__file__), "baseline.json")
+
+
+@pytest.fixture(scope="session")
+def baseline():
+    with open(BASELINE_PATH) as baseline_file:
+        return json.load(baseline_file)
+
+
+@pytest.fixture
+def assert_within_baseline(benchmark, baseline):
+    """
+    Fails a benchmark whose median is over its baseline.json median times BENCHMARK_SLACK, which is generous enough
+    to pass on any dev machine and still catches a hot path that got several times slower.
+    """
+
+    def check():
+        if benchmark.stats is None:
+            # --benchmark-disable runs each benchmark once without timing it
+            return
+        allowed = baseline[benchmark.name] * Config.get_float("BENCHMARK_SLACK", 5.0)
+        median = benchmark.stats.stats.median
+        assert median <= allowed, f"{benchmark.name} median {median * 1e6:.1f}us is over {allowed * 1e6:.1f}us"
+
+    return check
+
+
+@pytest.fixture(scope="module")
+def loop():
+    loop = asyncio.new_event_loop()
+    yield loop
+    loop.close()
+
+
+@pytest.fixture(scope="module")
+def database(loop):
+    async def ping():
+        async with db_session_factory() as db:
+            await db.execute(sa.text("SELECT 1"))
+
+    if not Config.get("ASYNC_DB_CONNECT", ""):
+        pytest.skip("ASYNC_DB_CONNECT is not set")
+    try:
+        loop.run_until_complete(ping())
+    except (OSError, SQLAlchemyError) as exc:
+        loop.run_until_complete(dispose_engine())
+        pytest.skip(f"The database is unreachable: {exc}")
+    yield
+    loop.run_until_complete(dispose_engine())
@@ -0,0 +1,111 @@
+"""
+Hot path benchmarks against the stub backends, their dependencies are in requirements-dev.txt. Each one is checked
+against baseline.json, see assert_within_baseline. For finer comparisons save a run on the base branch and compare the
+change against it:
+
+    pytest tests/benchmarks --benchmark-autosave
+    pytest tests/benchmarks --benchmark-compare --benchmark-compare-fail=median:20%
+"""
+import pytest
+import sqlalchemy as sa
+
+from typing import List
+from uuid import UUID
+
+from app.database import db_session_factory, store_models_to_db
+from app.logger import logger_factory
+from app.models.content import Content, ContentLanguage, ContentType
+from app.services import content as content_service
+from app.services.integrations import stubs
+from app.services.integrations.openai import ChatRequest, CompletionRequest, RequestMaker
+
+STORE_BATCH_SIZE = 50
+BENCHMARK_AUDIO_URL = "benchmark.ogg"
+
+
+def request_maker(request_class: type) -> RequestMaker:
+    return request_class(auth_token="stub", logger=logger_factory("Benchmark"))
+
+
+def content_models(count: int) -> List[Content]:
+    return [
+        Content(
+            content={"text": stubs.STUB_REPLY},
+            content_type=ContentType.FACT,
+            language=ContentLanguage.ENGLISH,
+            audio_url=BENCHMARK_AUDIO_URL,
+        )
+        for _ in range(count)
+    ]
+
+
+async def delete_benchmark_content():
+    async with db_session_factory() as db:
+        await db.execute(sa.delete(Content).where(Content.audio_url == BENCHMARK_AUDIO_URL))
+        await db.commit()
+
+
+@pytest.mark.parametrize(
+    "request_class,chunk",
+    [
+        (CompletionRequest, stubs.completion_chunk(" sleep", None)),
+        (ChatRequest, stubs.chat_chunk(" sleep", None)),
+    ],
+    ids=["completion", "chat"],
+)
+def test_get_text_from_streaming_chunk(benchmark, assert_within_baseline, request_class, chunk):
+    req_maker = request_maker(request_class)
+    chunk = stubs.sse_event(chunk)
+
+    assert benchmark(req_maker.get_text_from_streaming_chunk, chunk) == " sleep"
+    assert_within_baseline()
+
+
+def test_assemble_sentences(benchmark, assert_within_baseline, loop):
+    # a whole reply, the way the stub OpenAI server streams it
+    req_maker = request_maker(CompletionRequest)
+    chunks = [stubs.sse_event(stubs.completion_chunk(token, None)) for token in stubs.tokenize(stubs.STUB_REPLY)]
+
+    async def stream_chunks():
+        for chunk in chunks:
+            yield chunk
+
+    async def assemble():
+        return [sentence async for sentence in req_maker.assemble_sentences(stream_chunks())]
+
+    sentences = benchmark(lambda: loop.run_until_complete(assemble()))
+    assert "".join(sentences).split() == stubs.STUB_REPLY.split()
+    assert_within_baseline()
+
+
+@pytest.fixture(scope="module")
+def stored_content(loop, database):
+    loop.run_until_complete(store_models_to_db(content_models(STORE_BATCH_SIZE)))
+    yield
+    loop.run_until_complete(delete_benchmark_content())
+
+
+def test_get_random_content_item(benchmark, assert_within_baseline, loop, stored_content):
+    def get_item():
+        return loop.run_until_complete(
+            content_service.get_random_content_item(ContentType.FACT, ContentLanguage.ENGLISH, None)
+        )
+
+    assert benchmark(get_item) is not None
+    assert_within_baseline()
+
+
+def test_store_models_to_db(benchmark, assert_within_baseline, loop, database):
+    # per batch of STORE_BATCH_SIZE models, the stored rows are deleted again
+    stored_ids: List[UUID] = []
+
+    def store():
+        models = loop.run_until_complete(store_models_to_db(content_models(STORE_BATCH_SIZE)))
+        stored_ids.extend(model.id for model in models)
+
+    try:
+        benchmark.pedantic(store, rounds=20, warmup_rounds=1)
+        assert stored_ids and len(stored_ids) % STORE_BATCH_SIZE == 0
+    finally:
+        loop.run_until_complete(delete_benchmark_content())
+    assert_within_baseline()
@@ -0,0 +1,4 @@
+import os
+
+# the suite runs against the stub backends, which need no credentials
+os.environ["STUB_BACKENDS"] = "true"